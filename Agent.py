@@ -7,12 +7,13 @@ import torch.nn.utils.prune
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
-from PER import PER
+from PER import PER, ShardedPER, PrefetchSampler
 # from torchsummary import summary
 from networks import ImpalaCNNLarge, ImpalaCNNLargeIQN, NatureIQN, ImpalaCNNLargeC51, FactorizedNoisyLinear, NatureC51
 import networks
 from copy import deepcopy
 from functools import partial
+from contextlib import nullcontext
 from Analytic import Analytics
 import matplotlib.pyplot as plt
 import math
@@ -27,8 +28,12 @@ class EpsilonGreedy:
         self.eps_final = eps_final
         self.action_space = action_space
 
-    def update_eps(self):
-        self.eps = max(self.eps - (self.eps - self.eps_final) / self.steps, self.eps_final)
+    def update_eps(self, count=1):
+        # the decay is geometric towards eps_final, so several steps can be taken at once
+        if count == 1:
+            self.eps = max(self.eps - (self.eps - self.eps_final) / self.steps, self.eps_final)
+        else:
+            self.eps = max(self.eps_final + (self.eps - self.eps_final) * (1 - 1 / self.steps) ** count, self.eps_final)
 
     def choose_action(self):
         if np.random.random() > self.eps:
@@ -37,6 +42,51 @@ class EpsilonGreedy:
             return np.random.choice(self.action_space)
 
 
+class EMA:
+    """
+    Soft updates of a target network towards an online network, θ_target = τ*θ_local + (1 - τ)*θ_target, as one
+    torch._foreach_lerp_ over all parameters.
+
+    Parameters are paired by name once. With spectral norm that pairs the raw weights (weight_orig, or
+    parametrizations.weight.original), and the power iteration vectors, which are buffers, stay each network's own.
+    """
+    def __init__(self, target_net, online_net):
+        online_params = dict(online_net.named_parameters())
+        self.target_params = []
+        self.online_params = []
+        for name, param in target_net.named_parameters():
+            self.target_params.append(param)
+            self.online_params.append(online_params[name])
+
+    @torch.no_grad()
+    def update(self, tau):
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(self.target_params, self.online_params, tau)
+        else:
+            for target_param, online_param in zip(self.target_params, self.online_params):
+                target_param.lerp_(online_param, tau)
+
+
+class TargetCopy:
+    """
+    Copies an online network's parameters and buffers into a target network in place, the same tensors
+    load_state_dict(state_dict()) would copy, paired once by their state_dict names.
+    """
+    def __init__(self, target_net, online_net):
+        online_state = online_net.state_dict(keep_vars=True)
+        target_state = target_net.state_dict(keep_vars=True)
+        self.target_tensors = list(target_state.values())
+        self.online_tensors = [online_state[name] for name in target_state]
+
+    @torch.no_grad()
+    def copy(self):
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(self.target_tensors, self.online_tensors)
+        else:
+            for target_tensor, online_tensor in zip(self.target_tensors, self.online_tensors):
+                target_tensor.copy_(online_tensor)
+
+
 def randomise_action_batch(x, probs, n_actions):
     mask = torch.rand(x.shape) < probs
 
@@ -111,7 +161,9 @@ class Agent:
                  per_beta_anneal=False, layer_norm=False, max_mem_size=1048576, c51=False,
                  eps_steps=2000000, eps_disable=True, stoch=False, perturb=False,
                  activation="relu", selfnorm=False, pessimistic=False, n=3, munch_alpha=0.9, sam=False,
-                 grad_clip=10, chain=False):
+                 grad_clip=10, chain=False, prefetch=0, fused_encoder=True,
+                 mixed_precision=False, compile_actions=False, fixed_taus=False,
+                 memmap_dir=None, hot_frames=0, compress_frames=None, global_weight_norm=False, per_splits=1):
 
         if rainbow:
             lr = 6.25e-5
@@ -135,6 +187,9 @@ class Agent:
         self.procgen = True if input_dims[1] == 64 else False
         self.grad_clip = grad_clip
 
+        # IQN + munchausen: run the online encoder over states once per step, for both its passes
+        self.fused_encoder = fused_encoder
+
         self.chain = chain
         if self.chain:
             self.chain_bs = 64
@@ -230,7 +285,7 @@ class Agent:
         # to perform the same and is faster
         self.non_factorised = non_factorised
 
-        self.per_splits = 1
+        self.per_splits = per_splits
         if self.per_splits > num_envs:
             self.per_splits = num_envs
 
@@ -260,6 +315,8 @@ class Agent:
         self.max_mem_size = max_mem_size
 
         self.soft_update_tau = ema_tau  # 0.001 for non-sample-eff
+        self.ema = None  # the EMA updater is made on the first soft update
+        self.target_copy = None  # and the target copier on the first replace
         self.replace_target_cnt = target_replace  # This is the number of grad steps - could be a little jank
         # when changing num_envs/batch size/replay ratio
 
@@ -323,8 +380,26 @@ class Agent:
 
         self.framestack = framestack
         self.rgb = rgb
-        self.memory = PER(self.max_mem_size, device, self.n, num_envs, self.gamma, alpha=self.per_alpha,
-                          beta=self.per_beta, framestack=self.framestack, rgb=self.rgb, imagex=imagex, imagey=imagey)
+        memory_kwargs = dict(alpha=self.per_alpha, beta=self.per_beta, framestack=self.framestack, rgb=self.rgb,
+                             imagex=imagex, imagey=imagey, memmap_dir=memmap_dir, hot_frames=hot_frames,
+                             compress_frames=compress_frames, global_weight_norm=global_weight_norm)
+        # per_splits > 1 shards the memory by env. It locks each shard and stages one sample at a time itself,
+        # so appends and samples need no shared lock. Sampling and priority updates cost a little more, so it only
+        # pays when actors append from their own threads
+        if self.per_splits > 1:
+            self.memory = ShardedPER(self.per_splits, self.max_mem_size, device, self.n, num_envs, self.gamma,
+                                     **memory_kwargs)
+        else:
+            self.memory = PER(self.max_mem_size, device, self.n, num_envs, self.gamma, **memory_kwargs)
+
+        # prefetch > 0 samples that many batches ahead on a background thread
+        if prefetch > 0:
+            self.sampler = PrefetchSampler(self.memory, self.batch_size, depth=prefetch,
+                                           lock=nullcontext() if self.per_splits > 1 else None)
+            self.memory_lock = self.sampler.lock
+        else:
+            self.sampler = None
+            self.memory_lock = nullcontext()
 
         self.network_creator_fn = partial(create_network, self.impala, self.iqn, self.input_dims, self.n_actions,
                                           self.spectral_norm, self.device,
@@ -337,6 +412,27 @@ class Agent:
         self.net = self.network_creator_fn()
         self.tgt_net = self.network_creator_fn()
 
+        # register the noisy layers now, as this rebinds their noise buffers which the target copier pairs up
+        self.noise_manager(self.net)
+        self.noise_manager(self.tgt_net)
+
+        # bfloat16 autocast for the networks' passes when learning and acting, their outputs are still fp32
+        self.mixed_precision = mixed_precision
+        self.net.mixed_precision = mixed_precision
+        self.tgt_net.mixed_precision = mixed_precision
+
+        # IQN acting can average the quantiles at fixed, evenly spaced taus, whose embedding the network caches
+        self.fixed_taus = fixed_taus and isinstance(self.net, (ImpalaCNNLargeIQN, NatureIQN))
+
+        # acting runs a torch.compile'd qvals when asked for, falling back to the eager network if compiling fails
+        self.compiled_qvals = None
+        if compile_actions:
+            if hasattr(torch, "compile"):
+                self.compiled_qvals = torch.compile(self.net.qvals)
+            else:
+                print("torch.compile is not available, choose_action will run eagerly")
+        self.obs_buffer = None
+
         self.sam = sam
         if self.adamw:
             self.optimizer = optim.AdamW(self.net.parameters(), lr=self.lr, eps=0.005 / self.batch_size,
@@ -400,6 +496,8 @@ class Agent:
 
         apply_sparsity = (cur_sparsity - self.last_sparsity) / (1 - self.last_sparsity)
         apply_pruning(self.net, apply_sparsity)
+        # pruning registers new masks, so the target copier has to pair the tensors again
+        self.target_copy = None
 
         self.last_sparsity = cur_sparsity
 
@@ -412,15 +510,17 @@ class Agent:
 
     @torch.no_grad()
     def reset_noise(self, net):
-        for m in net.modules():
-            if isinstance(m, networks.FactorizedNoisyLinear):
-                m.reset_noise()
+        self.noise_manager(net).reset_noise()
 
     @torch.no_grad()
     def disable_noise(self, net):
-        for m in net.modules():
-            if isinstance(m, networks.FactorizedNoisyLinear):
-                m.disable_noise()
+        self.noise_manager(net).disable_noise()
+
+    def noise_manager(self, net):
+        # the noisy layers of a network are registered the first time its noise is touched
+        if getattr(net, "noise_manager", None) is None:
+            net.noise_manager = networks.NoiseManager(net)
+        return net.noise_manager
 
     def choose_action(self, observation):
         # this chooses an action for a batch. Can be used with a batch of 1 if needed though
@@ -438,14 +538,14 @@ class Agent:
             #         #state[i, j] = TF.adjust_contrast(state[i, j], 0.1)
             ##################################
 
-            state = T.tensor(observation, dtype=T.float).to(self.net.device)
+            state = self.stage_observation(observation)
 
             if self.stoch:
-                qvals = self.net.qvals(state, advantages_only=False)
+                qvals = self.act_qvals(state, advantages_only=False)
                 probs = F.softmax(qvals / self.entropy_tau, dim=1)
                 x = torch.multinomial(probs, num_samples=1).cpu()
             else:
-                qvals = self.net.qvals(state, advantages_only=True)
+                qvals = self.act_qvals(state, advantages_only=True)
                 x = T.argmax(qvals, dim=1).cpu()
 
                 ############## code for action swaps and action gaps
@@ -472,6 +572,29 @@ class Agent:
 
             return x
 
+    def stage_observation(self, observation):
+        # observations stay uint8 until they are on the device, the networks do the float conversion themselves.
+        # on cuda they are copied into the same preallocated buffer every step
+        observation = torch.as_tensor(observation)
+        if torch.device(self.net.device).type == 'cpu':
+            return observation
+
+        if self.obs_buffer is None or self.obs_buffer.shape != observation.shape or self.obs_buffer.dtype != observation.dtype:
+            self.obs_buffer = torch.empty(observation.shape, dtype=observation.dtype, device=self.net.device)
+        self.obs_buffer.copy_(observation, non_blocking=True)
+        return self.obs_buffer
+
+    def act_qvals(self, state, advantages_only):
+        kwargs = {"fixed_taus": True} if self.fixed_taus else {}
+        if self.compiled_qvals is not None:
+            try:
+                return self.compiled_qvals(state, advantages_only=advantages_only, **kwargs)
+            except Exception as e:
+                print(f"Compiled qvals failed, choose_action will run eagerly: {e}")
+                self.compiled_qvals = None
+
+        return self.net.qvals(state, advantages_only=advantages_only, **kwargs)
+
     def store_transition(self, state, action, reward, next_state, done, trun, stream, prio=True):
 
         if self.rgb:
@@ -479,13 +602,29 @@ class Agent:
             state = np.expand_dims(state, axis=0)
             next_state = np.expand_dims(next_state, axis=0)
 
-        self.memory.append(state, action, reward, next_state, done, trun, stream, prio=prio)
+        with self.memory_lock:
+            self.memory.append(state, action, reward, next_state, done, trun, stream, prio=prio)
 
         self.epsilon.update_eps()
         self.env_steps += 1
 
+    def store_transitions_batch(self, states, actions, rewards, next_states, dones, truns):
+        # stores one transition for every env, arrays have a leading num_envs dimension
+
+        if self.rgb:
+            states = np.expand_dims(states, axis=1)
+            next_states = np.expand_dims(next_states, axis=1)
+
+        with self.memory_lock:
+            self.memory.append_batch(states, actions, rewards, next_states, dones, truns)
+
+        self.epsilon.update_eps(len(rewards))
+        self.env_steps += len(rewards)
+
     def replace_target_network(self):
-        self.tgt_net.load_state_dict(self.net.state_dict())
+        if self.target_copy is None:
+            self.target_copy = TargetCopy(self.tgt_net, self.net)
+        self.target_copy.copy()
 
     def save_model(self):
         self.net.save_checkpoint(self.agent_name + "_" + str(int((self.env_steps // 250000))) + "M")
@@ -494,6 +633,16 @@ class Agent:
         self.net.load_checkpoint(name)
         self.tgt_net.load_checkpoint(name)
 
+    def save_memory(self, path):
+        with self.memory_lock:
+            self.memory.save(path)
+
+    def load_memory(self, path):
+        with self.memory_lock:
+            self.memory.load(path)
+        # the restored memory is already past the warm-up, so learning resumes straight away
+        self.min_sampling_size = min(self.min_sampling_size, self.env_steps)
+
     def soft_update(self):
         """Soft update model parameters.
         θ_target = τ*θ_local + (1 - τ)*θ_target
@@ -503,10 +652,9 @@ class Agent:
             target_model (PyTorch model): weights will be copied to
             tau (float): interpolation parameter
         """
-        with torch.no_grad():
-            for target_param, local_param in zip(self.tgt_net.parameters(), self.net.parameters()):
-                target_param.data.copy_(
-                    self.soft_update_tau * local_param.data + (1.0 - self.soft_update_tau) * target_param.data)
+        if self.ema is None:
+            self.ema = EMA(self.tgt_net, self.net)
+        self.ema.update(self.soft_update_tau)
 
     def activation_hook(self, module, input, output):
         if self.use_hooks:
@@ -535,8 +683,7 @@ class Agent:
 
         if self.discount_anneal:
             self.gamma = min(self.gamma + self.gamma_inc, self.final_gamma)
-            for i in self.memories:
-                i.discount = self.gamma
+            self.memory.gamma = self.gamma
 
         if self.noisy:
             self.reset_noise(self.tgt_net)
@@ -560,7 +707,10 @@ class Agent:
             perturb(self.net, self.optimizer, 0.2)
             perturb(self.tgt_net, self.optimizer, 0.2)
 
-        idxs, states, actions, rewards, next_states, dones, weights = self.memory.sample(self.batch_size)
+        if self.sampler is not None:
+            idxs, states, actions, rewards, next_states, dones, weights = self.sampler.sample()
+        else:
+            idxs, states, actions, rewards, next_states, dones, weights = self.memory.sample(self.batch_size)
 
         if self.pessimistic:
             rewards[dones] -= 1 * self.pess_scale
@@ -600,12 +750,9 @@ class Agent:
 
                 next_best_distr_v = next_distr_v[range(self.batch_size), next_actions_v.data]
                 next_best_distr_v = self.tgt_net.apply_softmax(next_best_distr_v)
-                next_best_distr = next_best_distr_v.data.cpu()
-
-                proj_distr = distr_projection(next_best_distr, rewards.cpu(), dones.cpu(), self.Vmin, self.Vmax,
-                                              self.N_ATOMS, self.gamma ** self.n)
 
-                proj_distr_v = proj_distr.to(self.net.device)
+                proj_distr_v = distr_projection(next_best_distr_v, rewards, dones, self.Vmin, self.Vmax,
+                                                self.N_ATOMS, self.gamma ** self.n)
 
             loss_v = -state_log_sm_v * proj_distr_v
             if self.per:
@@ -755,6 +902,9 @@ class Agent:
             loss = loss.mean()
 
         elif self.iqn and self.munchausen:
+            if self.fused_encoder:
+                state_features = self.net.encode(states)
+
             with torch.no_grad():
 
                 if self.trust_regions:
@@ -784,7 +934,10 @@ class Agent:
 
                 # assert Q_target.shape == (self.batch_size, 1, self.num_tau)
 
-                q_k_target = self.net.qvals(states)
+                if self.fused_encoder:
+                    q_k_target = self.net.head(state_features.detach())[0].mean(dim=1)
+                else:
+                    q_k_target = self.net.qvals(states)
                 v_k_target = q_k_target.max(1)[0].unsqueeze(-1)
                 tau_log_pik = q_k_target - v_k_target - self.entropy_tau * torch.logsumexp(
                     (q_k_target - v_k_target) / self.entropy_tau, 1).unsqueeze(-1)
@@ -801,7 +954,10 @@ class Agent:
                 Q_targets = munchausen_reward + Q_target
 
             # Get expected Q values from local model
-            q_k, taus = self.net(states)
+            if self.fused_encoder:
+                q_k, taus = self.net.head(state_features)
+            else:
+                q_k, taus = self.net(states)
             Q_expected = q_k.gather(2, actions.unsqueeze(-1).expand(self.batch_size, self.num_tau, 1))
             # assert Q_expected.shape == (self.batch_size, self.num_tau, 1)
 
@@ -826,7 +982,10 @@ class Agent:
             self.running_Q_loss += loss
             self.perform_chain(loss)
 
-        self.memory.update_priorities(idxs, loss_v.cpu().detach().numpy())
+        if self.sampler is not None:
+            self.sampler.update_priorities(idxs, loss_v.cpu().detach().numpy())
+        else:
+            self.memory.update_priorities(idxs, loss_v.cpu().detach().numpy())
 
         if self.analytics:
             with torch.no_grad():
@@ -850,7 +1009,8 @@ class Agent:
                 self.analytic_object.add_qvals(qvals.cpu().detach())
 
                 if self.grad_steps % 1 == 0:
-                    _, churn_states, _, _, _, _, _ = self.memory.sample(self.batch_size)
+                    with self.memory_lock:
+                        _, churn_states, _, _, _, _, _ = self.memory.sample(self.batch_size)
 
                     churn_qvals_before = self.net.qvals(churn_states)
                     churn_actions_before = T.argmax(churn_qvals_before, dim=1).cpu()
@@ -900,7 +1060,8 @@ class Agent:
             loss += coef * chain_loss
             #loss += self.chain_pi_coef * torch.sum(self.chain_argmaxs != new_argmaxs) * (1/self.chain_bs)
 
-        _, self.chain_refs, _, _, _, _, _ = self.memory.sample(self.chain_bs)
+        with self.memory_lock:
+            _, self.chain_refs, _, _, _, _, _ = self.memory.sample(self.chain_bs)
 
         with torch.no_grad():
             self.chain_qvals = self.net.qvals(self.chain_refs)
@@ -1021,37 +1182,35 @@ def distr_projection(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma):
     """
     Perform distribution projection aka Catergorical Algorithm from the
     "A Distributional Perspective on RL" paper
+
+    All atoms are projected at once on the device of next_distr. Terminal rows project a single atom holding
+    all the mass onto the reward, so they need no separate pass.
     """
     batch_size = len(rewards)
-    proj_distr = T.zeros((batch_size, n_atoms), dtype=T.float32)
+    device = next_distr.device
     delta_z = (Vmax - Vmin) / (n_atoms - 1)
-    for atom in range(n_atoms):
-        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards + (Vmin + atom * delta_z) * gamma))
-        b_j = (tz_j - Vmin) / delta_z
-        l = np.floor(b_j).type(T.int64)
-        u = np.ceil(b_j).type(T.int64)
-        eq_mask = u == l
-        proj_distr[eq_mask, l[eq_mask]] += next_distr[eq_mask, atom]
-        ne_mask = u != l
-        proj_distr[ne_mask, l[ne_mask]] += next_distr[ne_mask, atom] * (u - b_j)[ne_mask]
-        proj_distr[ne_mask, u[ne_mask]] += next_distr[ne_mask, atom] * (b_j - l)[ne_mask]
-    if dones.any():
-        proj_distr[dones] = 0.0
-        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards[dones]))
-        b_j = (tz_j - Vmin) / delta_z
-        l = np.floor(b_j).type(T.int64)
-        u = np.ceil(b_j).type(T.int64)
-        eq_mask = u == l
-        eq_dones = T.clone(dones)
-        eq_dones[dones] = eq_mask
-        if eq_dones.any():
-            proj_distr[eq_dones, l[eq_mask]] = 1.0
-        ne_mask = u != l
-        ne_dones = T.clone(dones)
-        ne_dones[dones] = ne_mask
-        if ne_dones.any():
-            proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
-            proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
+    support = T.tensor([(Vmin + atom * delta_z) * gamma for atom in range(n_atoms)], dtype=T.float32, device=device)
+
+    dones = dones.unsqueeze(1)
+    tz_j = T.clamp(rewards.unsqueeze(1) + support * ~dones, Vmin, Vmax)
+    b_j = (tz_j - Vmin) / delta_z
+    l = T.floor(b_j).type(T.int64)
+    u = T.ceil(b_j).type(T.int64)
+
+    terminal_distr = T.zeros((1, n_atoms), dtype=next_distr.dtype, device=device)
+    terminal_distr[0, 0] = 1.0
+    next_distr = T.where(dones, terminal_distr, next_distr)
+
+    # when b_j lands on an atom all of its mass goes to l, otherwise it is split between l and u
+    eq_mask = u == l
+    l_mass = T.where(eq_mask, next_distr, next_distr * (u - b_j))
+    u_mass = T.where(eq_mask, T.zeros_like(next_distr), next_distr * (b_j - l))
+
+    # interleave l and u per atom so the sums are accumulated in the same order as the atom by atom loop
+    index = T.stack((l, u), dim=2).view(batch_size, 2 * n_atoms)
+    mass = T.stack((l_mass, u_mass), dim=2).view(batch_size, 2 * n_atoms)
+    proj_distr = T.zeros((batch_size, n_atoms), dtype=T.float32, device=device)
+    proj_distr.scatter_add_(1, index, mass)
     return proj_distr
 
 
@@ -0,0 +1,221 @@
+"""
+Evaluation workers that live for the whole run.
+
+Each worker process creates its evaluation envs and network once, then waits for evaluation requests. Weights are
+broadcast through a set of shared memory tensors per worker, which the main process fills before handing that worker
+an evaluation, so nothing is pickled but the request itself. Results stream back on a queue and are written to the
+evaluation file by a single thread in the main process, so overlapping evaluations never race on it.
+"""
+import multiprocessing as mp
+import os
+import queue
+import threading
+import traceback
+
+import numpy as np
+import torch
+
+from Agent import choose_eval_action, apply_pruning
+
+
+def run_eval_episodes(eval_env, eval_net, num_eval_episodes: int, n_actions: int, device, rng: float) -> list:
+    """Play num_eval_episodes episodes over the envs of eval_env from a fresh reset, returning their scores."""
+    eval_envs = eval_env.num_envs
+    evals = []
+    eval_episodes = 0
+    eval_scores = np.array([0 for i in range(eval_envs)])
+    eval_observation, eval_info = eval_env.reset()
+
+    while eval_episodes < num_eval_episodes:
+
+        eval_action = choose_eval_action(eval_observation, eval_net, n_actions, device, rng)
+        eval_observation_, eval_reward, eval_done_, eval_trun_, eval_info = eval_env.step(eval_action)
+        eval_done_ = np.logical_or(eval_done_, eval_trun_)
+
+        for i in range(eval_envs):
+            eval_scores[i] += eval_reward[i]
+            if eval_done_[i]:
+                eval_episodes += 1
+                evals.append(eval_scores[i])
+                eval_scores[i] = 0
+                if eval_episodes >= num_eval_episodes:
+                    break
+
+        eval_observation = eval_observation_
+
+    return evals
+
+
+def _eval_worker(worker_id: int, tasks, results, weights: dict, network_creator, env_fn, n_actions: int, device,
+                 pruning: bool) -> None:
+    """
+    Worker loop of `EvalPool`. A task is (index, num_eval_episodes), or None to exit; the reply is
+    (worker_id, index, scores, None), or (worker_id, index, None, formatted traceback). A worker that fails to start
+    replies (worker_id, None, None, formatted traceback) and exits.
+    """
+    eval_env = None
+    try:
+        try:
+            eval_env = env_fn()
+            eval_net = network_creator()
+            if pruning:
+                apply_pruning(eval_net, 0.0)
+            eval_state = eval_net.state_dict(keep_vars=True)
+        except Exception:
+            results.put((worker_id, None, None, traceback.format_exc()))
+            return
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, num_eval_episodes = task
+            try:
+                # weights are copied out of shared memory, so the main process can refill it for the next task
+                with torch.no_grad():
+                    for name, tensor in eval_state.items():
+                        tensor.copy_(weights[name])
+
+                # this massively helps speed up training since agents get stuck in some games, causing evals to last
+                # a very long time
+                rng = 0.01 if index <= 125 else 0.0
+                evals = run_eval_episodes(eval_env, eval_net, num_eval_episodes, n_actions, device, rng)
+                results.put((worker_id, index, evals, None))
+            except Exception:
+                results.put((worker_id, index, None, traceback.format_exc()))
+    finally:
+        if eval_env is not None:
+            eval_env.close()
+
+
+class EvalResults:
+    """
+    The evaluation file, one row of episode scores per evaluation. Rows are written under a lock, and the file is
+    replaced atomically, so a reader never sees a half written file.
+    """
+    def __init__(self, fname: str, shape: tuple):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.data = np.zeros(shape)
+        self._save()
+
+    def write(self, index: int, evals: list) -> None:
+        with self.lock:
+            if index >= len(self.data):
+                print(f"Evaluation {index + 1} does not fit in {self.fname}, which has {len(self.data)} rows")
+                return
+            self.data[index] = evals
+            self._save()
+
+    def _save(self) -> None:
+        tmp = self.fname + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, self.data)
+        os.replace(tmp, self.fname)
+
+
+class EvalPool:
+    """
+    A fixed set of evaluation worker processes, see the module docstring.
+
+    `submit` blocks only while every worker is busy. `close` waits for the evaluations that are still running.
+    """
+    def __init__(self, num_workers: int, network_creator, env_fn, state_dict: dict, n_actions: int, device,
+                 eval_results: EvalResults = None, pruning: bool = False):
+        """
+        Start the workers.
+
+        Args:
+            num_workers (int): Number of worker processes, each with its own envs and network
+            network_creator: Called in each worker to create its network
+            env_fn: Called in each worker to create its vectorised eval env
+            state_dict (dict): A state dict of the network, giving the names and shapes of the shared weights
+            n_actions (int): Number of actions
+            device: Device the workers run their networks on
+            eval_results (EvalResults): Where scores are written, None to only print them. Defaults to None
+            pruning (bool): Whether the networks have pruning masks. Defaults to False
+        """
+        self.eval_results = eval_results
+        self.results = mp.Queue()
+        self.idle = queue.Queue()
+        # workers that failed to start, and the evaluation each busy worker was given, both under assign_lock
+        self.failed = set()
+        self.assigned = {}
+        self.assign_lock = threading.Lock()
+        self.weights = []
+        self.tasks = []
+        self.processes = []
+
+        for worker_id in range(num_workers):
+            weights = {name: tensor.detach().cpu().clone().share_memory_() for name, tensor in state_dict.items()}
+            tasks = mp.Queue()
+            # not a daemon, the async eval env starts processes of its own
+            process = mp.Process(target=_eval_worker,
+                                 args=(worker_id, tasks, self.results, weights, network_creator, env_fn, n_actions,
+                                       device, pruning))
+            process.start()
+            self.weights.append(weights)
+            self.tasks.append(tasks)
+            self.processes.append(process)
+            self.idle.put(worker_id)
+
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, state_dict: dict, index: int, num_eval_episodes: int) -> None:
+        """Evaluate the weights in state_dict as evaluation number index, on the next free worker."""
+        while True:
+            try:
+                worker_id = self.idle.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise RuntimeError("Every evaluation worker has exited")
+                continue
+
+            with self.assign_lock:
+                # a worker that failed to start or has exited would never pick the task up, so its id is dropped
+                if worker_id in self.failed or not self.processes[worker_id].is_alive():
+                    continue
+
+                with torch.no_grad():
+                    for name, tensor in self.weights[worker_id].items():
+                        tensor.copy_(state_dict[name])
+                self.assigned[worker_id] = index
+                self.tasks[worker_id].put((index, num_eval_episodes))
+                return
+
+    def _collect(self) -> None:
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            worker_id, index, evals, error = message
+
+            if error is not None:
+                if index is None:
+                    print(f"Evaluation worker {worker_id} failed to start:\n{error}")
+                    with self.assign_lock:
+                        self.failed.add(worker_id)
+                        lost = self.assigned.pop(worker_id, None)
+                    if lost is not None:
+                        print(f"Evaluation {lost + 1} was given to worker {worker_id} and will not run")
+                    continue
+                print(f"Evaluation {index + 1} failed:\n{error}")
+            else:
+                print("Evaluation " + str(index + 1) + "M Complete, average score:")
+                print(np.mean(evals))
+                if self.eval_results is not None:
+                    self.eval_results.write(index, evals)
+
+            with self.assign_lock:
+                self.assigned.pop(worker_id, None)
+            self.idle.put(worker_id)
+
+    def close(self) -> None:
+        """Let the workers finish their evaluations, then stop them and the collector."""
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
@@ -5,6 +5,8 @@ from gymnasium.core import WrapperActType, WrapperObsType
 from gymnasium.spaces import Box
 from typing import Any, SupportsFloat
 
+# Wrappers which only do bookkeeping and can be bypassed when stepping several frames natively
+PASSTHROUGH_WRAPPERS = (gym.wrappers.TimeLimit, gym.wrappers.OrderEnforcing, gym.wrappers.PassiveEnvChecker)
 
 class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
     """Preprocessing for Punch Out environment.
@@ -23,6 +25,7 @@ class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
         grayscale_obs: bool = True,
         grayscale_newaxis: bool = False,
         scale_obs: bool = False,
+        native_frame_skip: bool = True,
     ):
         """Initialize MarioPreprocessing wrapper.
 
@@ -33,6 +36,7 @@ class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
             grayscale_obs (bool): Whether to convert frames to grayscale.
             grayscale_newaxis (bool): Add a channel axis to grayscale frames.
             scale_obs (bool): Normalize observation values to [0, 1].
+            native_frame_skip (bool): Use the base environment's `step_n` to run all skipped frames in one call when available.
         """
         gym.utils.RecordConstructorArgs.__init__(
             self,
@@ -41,6 +45,7 @@ class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
             grayscale_obs=grayscale_obs,
             grayscale_newaxis=grayscale_newaxis,
             scale_obs=scale_obs,
+            native_frame_skip=native_frame_skip,
         )
         gym.Wrapper.__init__(self, env)
 
@@ -50,6 +55,11 @@ class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
         self.grayscale_newaxis = grayscale_newaxis
         self.scale_obs = scale_obs
 
+        # Multi-frame step of the base env, along with the time limit that has to be enforced here instead
+        self._max_episode_frames = None
+        self._elapsed_frames = 0
+        self._step_n = self._find_step_n(env) if native_frame_skip else None
+
         if self.grayscale_obs:
             # Buffer for grayscale frames
             self.obs_buffer = [
@@ -71,10 +81,24 @@ class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
             
         self.observation_space = Box(low=_low, high=_high, shape=_shape, dtype=_obs_dtype)
 
+    def _find_step_n(self, env: gym.Env):
+        """Return the base environment's `step_n` if only passthrough wrappers sit in between, else None."""
+        while isinstance(env, gym.Wrapper):
+            if not isinstance(env, PASSTHROUGH_WRAPPERS):
+                return None
+            if isinstance(env, gym.wrappers.TimeLimit):
+                self._max_episode_frames = env._max_episode_steps
+            env = env.env
+
+        return getattr(env, "step_n", None)
+
     def step(
         self, action: WrapperActType
     ) -> tuple[WrapperObsType, SupportsFloat, bool, bool, dict[str, Any]]:
         """Step the environment with preprocessing."""
+        if self._step_n is not None:
+            return self._native_step(action)
+
         total_reward = 0.0
         terminated = False
         truncated = False
@@ -102,9 +126,31 @@ class ObsPreprocessing(gym.Wrapper, gym.utils.RecordConstructorArgs):
 
         return self._get_obs(), total_reward, terminated, truncated, info
 
+    def _native_step(
+        self, action: WrapperActType
+    ) -> tuple[WrapperObsType, SupportsFloat, bool, bool, dict[str, Any]]:
+        """Step all skipped frames in a single `step_n` call, which only hands back the last two frames."""
+        n = self.frame_skip
+        if self._max_episode_frames is not None:
+            # at least one frame, step_n rejects n < 1 and a step past the limit is still truncated below
+            n = max(1, min(n, self._max_episode_frames - self._elapsed_frames))
+
+        frames, total_reward, terminated, truncated, info = self._step_n(action, n, keep_last=2)
+
+        self._elapsed_frames += n
+        if self._max_episode_frames is not None and self._elapsed_frames >= self._max_episode_frames:
+            truncated = True
+
+        self.obs_buffer[0] = frames[-1]
+        # Fill missing frames with the last valid observation if the episode ended
+        self.obs_buffer[1] = frames[-1] if truncated else frames[-2]
+
+        return self._get_obs(), total_reward, terminated, truncated, info
+
     def reset(self, **kwargs) -> tuple[WrapperObsType, dict[str, Any]]:
         """Reset the environment with preprocessing."""
         obs, info = self.env.reset(**kwargs)
+        self._elapsed_frames = 0
 
         if self.grayscale_obs:
             obs = cv2.cvtColor(obs, cv2.COLOR_RGB2GRAY)
@@ -1,47 +1,70 @@
+import os
+import hashlib
+import zlib
 import numpy as np
 from collections import deque
+import queue
+import threading
 import torch
 import time
 import gymnasium as gym
 import numpy
 from math import sqrt
+from functools import partial
 
 
 # SumTree
 # a binary tree data structure where the parent’s value is the sum of its children
 class SumTree():
-  def __init__(self, size, procgen=False):
+  def __init__(self, size, procgen=False, track_min=False):
     self.index = 0
     self.size = size
     self.full = False  # Used to track actual capacity
     self.tree_start = 2**(size-1).bit_length()-1  # Put all used node leaves on last tree level
+    self.tree_levels = (size-1).bit_length()  # Number of levels below the root
     self.sum_tree = np.zeros((self.tree_start + self.size,), dtype=np.float32)
     self.max = 1  # Initial max value to return (1 = 1^ω)
+    # Optional min-tree over the same nodes, kept in the same passes. Empty leaves are inf so they never count
+    self.min_tree = np.full(self.sum_tree.shape, np.inf, dtype=np.float32) if track_min else None
 
   # Updates nodes values from current tree
   def _update_nodes(self, indices):
-    children_indices = indices * 2 + np.expand_dims([1, 2], axis=1)
-    self.sum_tree[indices] = np.sum(self.sum_tree[children_indices], axis=0)
+    left = indices * 2 + 1
+    self.sum_tree[indices] = self.sum_tree[left] + self.sum_tree[left + 1]
+    if self.min_tree is not None:
+      self.min_tree[indices] = np.minimum(self.min_tree[left], self.min_tree[left + 1])
 
-  # Propagates changes up tree given tree indices
+  # Propagates changes up tree given tree indices, one level per iteration
+  # All indices must be on the same level (leaves), so every level is a sorted array of unique parents
   def _propagate(self, indices):
-    parents = (indices - 1) // 2
-    unique_parents = np.unique(parents)
-    self._update_nodes(unique_parents)
-    if parents[0] != 0:
-      self._propagate(parents)
+    parents = np.unique((indices - 1) // 2)
+    while True:
+      self._update_nodes(parents)
+      if parents[0] == 0:
+        break
+      parents = (parents - 1) // 2
+      parents = parents[np.concatenate(([True], parents[1:] != parents[:-1]))]  # Drop repeats without re-sorting
 
   # Propagates single value up tree given a tree index for efficiency
+  # Walks memoryviews of the trees, whose items are python floats rather than numpy scalars. A sum of two float32
+  # values rounded from double precision back to float32 is the float32 sum, so the tree is unchanged
   def _propagate_index(self, index):
     parent = (index - 1) // 2
-    left, right = 2 * parent + 1, 2 * parent + 2
-    self.sum_tree[parent] = self.sum_tree[left] + self.sum_tree[right]
-    if parent != 0:
-      self._propagate_index(parent)
+    sum_tree = memoryview(self.sum_tree)
+    min_tree = None if self.min_tree is None else memoryview(self.min_tree)
+    while True:
+      sum_tree[parent] = sum_tree[2 * parent + 1] + sum_tree[2 * parent + 2]
+      if min_tree is not None:
+        min_tree[parent] = min(min_tree[2 * parent + 1], min_tree[2 * parent + 2])
+      if parent == 0:
+        break
+      parent = (parent - 1) // 2
 
   # Updates values given tree indices
   def update(self, indices, values):
     self.sum_tree[indices] = values  # Set new values
+    if self.min_tree is not None:
+      self.min_tree[indices] = values
     self._propagate(indices)  # Propagate values
     current_max_value = np.max(values)
     self.max = max(current_max_value, self.max)
@@ -49,6 +72,8 @@ class SumTree():
   # Updates single value given a tree index for efficiency
   def _update_index(self, index, value):
     self.sum_tree[index] = value  # Set new value
+    if self.min_tree is not None:
+      self.min_tree[index] = value
     self._propagate_index(index)  # Propagate value
     self.max = max(value, self.max)
 
@@ -58,34 +83,213 @@ class SumTree():
     self.full = self.full or self.index == 0  # Save when capacity reached
     self.max = max(value, self.max)
 
-  # Searches for the location of values in sum tree
+  # Appends several values at once, propagating each parent only once
+  def append_batch(self, values):
+    indices = (self.index + np.arange(values.size)) % self.size
+    self.update(indices + self.tree_start, values)  # Update tree
+    self.full = self.full or self.index + values.size >= self.size  # Save when capacity reached
+    self.index = (self.index + values.size) % self.size  # Update index
+
+  # Searches for the location of values in sum tree, descending one level per iteration
   def _retrieve(self, indices, values):
-    children_indices = (indices * 2 + np.expand_dims([1, 2], axis=1)) # Make matrix of children indices
-    # If indices correspond to leaf nodes, return them
-    if children_indices[0, 0] >= self.sum_tree.shape[0]:
-      return indices
-    # If children indices correspond to leaf nodes, bound rare outliers in case total slightly overshoots
-    elif children_indices[0, 0] >= self.tree_start:
-      children_indices = np.minimum(children_indices, self.sum_tree.shape[0] - 1)
-    left_children_values = self.sum_tree[children_indices[0]]
-    successor_choices = np.greater(values, left_children_values).astype(np.int32)  # Classify which values are in left or right branches
-    successor_indices = children_indices[successor_choices, np.arange(indices.size)] # Use classification to index into the indices matrix
-    successor_values = values - successor_choices * left_children_values  # Subtract the left branch values when searching in the right branch
-    return self._retrieve(successor_indices, successor_values)
+    last = self.sum_tree.shape[0] - 1
+    for _ in range(self.tree_levels):
+      children = indices * 2 + 1
+      np.minimum(children, last, out=children)  # Bound rare outliers in case total slightly overshoots
+      left_children_values = self.sum_tree[children]
+      go_right = np.greater(values, left_children_values)  # Classify which values are in left or right branches
+      values = values - go_right * left_children_values  # Subtract the left branch values when searching in the right branch
+      children += go_right
+      np.minimum(children, last, out=children)
+      indices = children
+    return indices
 
   # Searches for values in sum tree and returns values, data indices and tree indices
   def find(self, values):
-    indices = self._retrieve(np.zeros(values.shape, dtype=np.int32), values)
+    indices = self._retrieve(np.zeros(values.shape, dtype=np.int64), values)
     data_index = indices - self.tree_start
     return (self.sum_tree[indices], data_index, indices)  # Return values, data indices, tree indices
 
   def total(self):
     return self.sum_tree[0]
 
+  # Smallest value stored, only with track_min
+  def min(self):
+    return self.min_tree[0]
+
+def frame_codec(name):
+    """
+    The (compress, decompress) functions of a frame codec: "lz4", "zstd" or "zlib". lz4 and zstd are optional
+    packages, without them the codec falls back to zlib, which is always available.
+    """
+    if name == "lz4":
+        try:
+            import lz4.block
+            return lz4.block.compress, lz4.block.decompress
+        except ImportError:
+            print("lz4 is not installed, compressing frames with zlib")
+    elif name == "zstd":
+        try:
+            import zstandard
+            return zstandard.ZstdCompressor(level=1).compress, zstandard.ZstdDecompressor().decompress
+        except ImportError:
+            print("zstandard is not installed, compressing frames with zlib")
+    elif name != "zlib":
+        raise ValueError(f"Unknown frame codec {name}")
+    return partial(zlib.compress, level=1), zlib.decompress
+
+def ring_segments(end, count, length):
+    """ The (lo, hi) slices holding the last count slots of a ring of length that ends at end, oldest first. """
+    if count == 0:
+        return ()
+    start = (end - count) % length
+    return ((start, end),) if start < end else ((start, length), (0, end))
+
+def write_npz(fname, arrays):
+    """ np.savez to fname through a temporary file, so fname is either the old file or the whole new one. """
+    tmp = fname[:-len(".npz")] + ".tmp.npz"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, fname)
+
+
+class CompressedFrameStore:
+    """
+    Frame memory that keeps every frame compressed, indexed like the uint8 array it replaces.
+
+    Identical frames (title screens, pauses, a static playfield) are stored once: a frame is hashed before it is
+    compressed, and a slot whose frame is already held just references the same blob. Blobs are counted, and dropped
+    when their last slot is overwritten. Reads decompress each distinct frame asked for once.
+    """
+    def __init__(self, size, frame_shape, codec="lz4"):
+        self.shape = (size,) + tuple(frame_shape)
+        self.dtype = np.dtype(np.uint8)
+        self.frame_shape = tuple(frame_shape)
+        self.compress, self.decompress = frame_codec(codec)
+        self.empty = self.compress(np.zeros(self.frame_shape, dtype=np.uint8).tobytes())
+
+        self.slots = [None for _ in range(size)]  # the digest of each slot's frame
+        self.blobs = {}  # digest -> [compressed frame, number of slots holding it]
+        self.compressed_bytes = 0
+        self.frames_held = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _store(self, idx, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        digest = hashlib.blake2b(frame, digest_size=16).digest()
+        old = self.slots[idx]
+        if old == digest:
+            return
+
+        blob = self.blobs.get(digest)
+        if blob is None:
+            blob = self.blobs[digest] = [self.compress(frame.tobytes()), 0]
+            self.compressed_bytes += len(blob[0])
+        blob[1] += 1
+        self.slots[idx] = digest
+
+        if old is None:
+            self.frames_held += 1
+        else:
+            old_blob = self.blobs[old]
+            old_blob[1] -= 1
+            if old_blob[1] == 0:
+                self.compressed_bytes -= len(old_blob[0])
+                del self.blobs[old]
+
+    def __setitem__(self, idxs, frames):
+        if isinstance(idxs, (int, np.integer)):
+            self._store(int(idxs), frames)
+            return
+        idxs = np.arange(len(self))[idxs].ravel() if isinstance(idxs, slice) else np.asarray(idxs).ravel()
+        frames = np.asarray(frames).reshape((-1,) + self.frame_shape)
+        for idx, frame in zip(idxs.tolist(), frames):
+            self._store(idx, frame)
+
+    def __getitem__(self, idxs):
+        if isinstance(idxs, (int, np.integer)):
+            return self.take(np.array([idxs]))[0]
+        if isinstance(idxs, slice):
+            idxs = np.arange(len(self))[idxs]
+        return self.take(np.asarray(idxs))
+
+    def take(self, idxs, out=None):
+        """ The frames at idxs, any shape of indices, decompressing each distinct frame once. """
+        if out is None:
+            out = np.empty(idxs.shape + self.frame_shape, dtype=np.uint8)
+        flat_out = out.reshape((-1,) + self.frame_shape)
+        decoded = {}
+        for i, idx in enumerate(idxs.ravel().tolist()):
+            digest = self.slots[idx]
+            frame = decoded.get(digest)
+            if frame is None:
+                blob = self.empty if digest is None else self.blobs[digest][0]
+                frame = decoded[digest] = np.frombuffer(self.decompress(blob), dtype=np.uint8).reshape(self.frame_shape)
+            flat_out[i] = frame
+        return out
+
+    def compression_ratio(self):
+        """ Bytes the frames held would take raw, over the bytes of their distinct compressed blobs. """
+        return self.frames_held * int(np.prod(self.frame_shape)) / max(self.compressed_bytes, 1)
+
+
+class StagingBuffers:
+    """
+    Moves batches of uint8 states and n-states to the device.
+
+    With cuda, frames are gathered straight into pinned host buffers and copied with non_blocking=True.
+    Two sets of buffers per batch size are used in turn, and a set is only refilled once the event
+    recorded after its last copy has completed. On cpu the gathered arrays are returned directly.
+
+    Not thread safe, a memory sampled from several threads must stage one batch at a time.
+    """
+    def __init__(self, device, pinned):
+        self.device = device
+        self.pinned = pinned
+        self.buffers = {}
+        self.turn = 0
+
+    def stage(self, shape, gather):
+        """
+        Move a batch of states and n-states of the given shape to the device. gather(states_out, n_states_out)
+        fills the host arrays, or returns new ones when they are None.
+        """
+        if not self.pinned:
+            states, n_states = gather()
+            return torch.from_numpy(states).to(self.device), torch.from_numpy(n_states).to(self.device)
+
+        batch_size = shape[0]
+        if batch_size not in self.buffers:
+            self.buffers[batch_size] = [[torch.empty(shape, dtype=torch.uint8).pin_memory(),
+                                         torch.empty(shape, dtype=torch.uint8).pin_memory(), None] for _ in range(2)]
+
+        self.turn ^= 1
+        slot = self.buffers[batch_size][self.turn]
+        states_host, n_states_host, copied = slot
+        if copied is not None:
+            copied.synchronize()
+
+        gather(states_host.numpy(), n_states_host.numpy())
+
+        states = states_host.to(self.device, non_blocking=True)
+        n_states = n_states_host.to(self.device, non_blocking=True)
+
+        slot[2] = torch.cuda.Event()
+        slot[2].record()
+
+        return states, n_states
+
+
 class PER:
-    def __init__(self, size, device, n, envs, gamma, alpha=0.2, beta=0.4, framestack=4, imagex=84, imagey=84, rgb=False):
+    def __init__(self, size, device, n, envs, gamma, alpha=0.2, beta=0.4, framestack=4, imagex=84, imagey=84, rgb=False,
+                 uint8_states=True, memmap_dir=None, hot_frames=0, compress_frames=None, global_weight_norm=False):
 
-        self.st = SumTree(size)
+        # global_weight_norm normalises the importance-sampling weights by the largest weight of any stored
+        # transition rather than of the batch, which needs the min-tree for the lowest priority
+        self.global_weight_norm = global_weight_norm
+        self.st = SumTree(size, track_min=global_weight_norm)
         self.data = [None for _ in range(size)]
         self.index = 0
         self.size = size
@@ -99,13 +303,32 @@ class PER:
             self.storage_size = int(size * 4)
         else:
             self.storage_size = int(size * 1.25)
+
+        # with memmap_dir the frame, action, reward and done memory live in np.memmap files in that directory, and
+        # the newest hot_frames frames are also kept in RAM. The storage is rounded up to a multiple of hot_frames,
+        # so the newest frames always map to distinct slots of the hot cache
+        self.memmap_dir = memmap_dir
+        self.hot_frames = hot_frames if memmap_dir is not None and compress_frames is None else 0
+        if self.hot_frames > 0:
+            self.storage_size = -(-self.storage_size // self.hot_frames) * self.hot_frames
         self.gamma = gamma
+        self._discounts = None
+        self._discounts_gamma = None
         self.capacity = 0
 
         self.point_mem_idx = 0
+        self.transitions_added = 0
 
         self.state_mem_idx = 0
         self.reward_mem_idx = 0
+        # frames and steps ever written, so a snapshot knows which part of the memory rings changed since the last
+        self.frames_added = 0
+        self.rewards_added = 0
+        self.snapshot = None
+        self.save_thread = None
+        self.save_error = None
+        # held by appends, and by a background save while it copies a chunk of a ring or checks which slots raced
+        self.write_lock = threading.Lock()
 
         self.imagex = imagex
         self.imagey = imagey
@@ -119,157 +342,244 @@ class PER:
         self.eps = 1e-6  # small constant to stop 0 probability
         self.device = device
 
-        self.last_terminal = [True for i in range(envs)]
-        self.tstep_counter = [0 for i in range(envs)]
+        # sampled frames are sent to the device as uint8, the networks do the float conversion and /255 themselves.
+        # with cuda they are gathered into reused pinned buffers and copied asynchronously
+        self.uint8_states = uint8_states
+        self.pin_staging = uint8_states and torch.cuda.is_available() and torch.device(device).type == 'cuda'
+        self.staging = StagingBuffers(device, self.pin_staging)
+
+        self.last_terminal = np.ones(envs, dtype=bool)
 
+        # per stream rings of the frame and reward pointers not yet in a transition. Frames and rewards leave
+        # together, so both rings share a head; it wraps at a multiple of both ring lengths
         self.n_step = n
-        self.state_buffer = [[] for i in range(envs)]
-        self.reward_buffer = [[] for i in range(envs)]
+        self.all_streams = np.arange(envs)
+        self.ring_len = self.framestack + self.n_step
+        self.state_ring = np.zeros((envs, self.ring_len), dtype=np.int32)
+        self.reward_ring = np.zeros((envs, self.n_step), dtype=np.int32)
+        self.ring_period = self.ring_len * self.n_step
+        self.stream_head = np.zeros(envs, dtype=np.int64)
+        self.stream_rewards = np.zeros(envs, dtype=np.int64)
+        # a view of each stream's rows, so append reaches a stream's rings without creating one per call
+        self.state_rows = tuple(self.state_ring)
+        self.reward_rows = tuple(self.reward_ring)
+        self.ring_cols = np.arange(self.framestack)
+        self.reward_cols = np.arange(self.n_step)
+        # ring columns of the framestack / n_step window starting at each ring position, as tuples of rows so append
+        # picks one without creating a numpy view
+        self.state_windows = tuple((np.arange(self.ring_len)[:, None] + self.ring_cols) % self.ring_len)
+        self.reward_windows = tuple((self.reward_cols[:, None] + self.reward_cols) % self.n_step)
 
         if rgb:
-            self.state_mem = np.zeros((self.storage_size, 3, self.imagex, self.imagey), dtype=np.uint8)
+            frame_shape = (3, self.imagex, self.imagey)
         else:
-            self.state_mem = np.zeros((self.storage_size, self.imagex, self.imagey), dtype=np.uint8)
-        self.action_mem = np.zeros(self.storage_size, dtype=np.int64)
-        self.reward_mem = np.zeros(self.storage_size, dtype=float)
-        self.done_mem = np.zeros(self.storage_size, dtype=bool)
-        self.trun_mem = np.zeros(self.storage_size, dtype=bool)
+            frame_shape = (self.imagex, self.imagey)
+        # compress_frames names a codec for a CompressedFrameStore, which then holds the frames in RAM
+        self.compress_frames = compress_frames
+        if compress_frames is not None:
+            self.state_mem = CompressedFrameStore(self.storage_size, frame_shape, codec=compress_frames)
+        else:
+            self.state_mem = self.storage("state_mem", (self.storage_size,) + frame_shape, np.uint8)
+        self.action_mem = self.storage("action_mem", (self.storage_size,), np.int64)
+        self.reward_mem = self.storage("reward_mem", (self.storage_size,), float)
+        self.done_mem = self.storage("done_mem", (self.storage_size,), bool)
+        self.trun_mem = self.storage("trun_mem", (self.storage_size,), bool)
+        self.hot_mem = np.zeros((self.hot_frames,) + frame_shape, dtype=np.uint8) if self.hot_frames > 0 else None
+
+        # append reads and writes single items of the stream state, rings and step memories through memoryviews,
+        # which is cheaper than numpy scalar indexing. The arrays behind them are only ever changed in place
+        self.stream_views = tuple(memoryview(a) for a in (self.stream_head, self.stream_rewards, self.last_terminal))
+        self.state_row_views = tuple(memoryview(row) for row in self.state_ring)
+        self.reward_row_views = tuple(memoryview(row) for row in self.reward_ring)
+        self.step_views = tuple(memoryview(mem) for mem in (self.action_mem, self.reward_mem, self.done_mem,
+                                                            self.trun_mem))
 
         # everything here is stored as ints as they are just pointers to the actual memory
         # reward contains N values. The first value contains the action. The set of N contains the pointers for both
-        # the reward and dones
-        self.trans_dtype = np.dtype([('state', int, self.framestack), ('n_state', int, self.framestack),
-                                     ('reward', int, self.n_step)])
-
-        self.blank_trans = (np.zeros(self.framestack, dtype=int), np.zeros(self.framestack, dtype=int),
-                            np.zeros(self.n_step, dtype=int))
-
-        self.pointer_mem = np.array([self.blank_trans] * size, dtype=self.trans_dtype)
+        # the reward and dones. int32 is plenty for the frame storage size and halves the memory of int64
+        self.state_pointer_mem = np.zeros((size, self.framestack), dtype=np.int32)
+        self.n_state_pointer_mem = np.zeros((size, self.framestack), dtype=np.int32)
+        self.reward_pointer_mem = np.zeros((size, self.n_step), dtype=np.int32)
 
         self.overlap = self.framestack - self.n_step
 
-        #self.priority_min = [float('inf') for _ in range(2 * self.size)]
-        #print("Prio Size: " + str(len(self.priority_min)))
-
     def append(self, state, action, reward, n_state, done, trun, stream, prio=True):
+        with self.write_lock:
+            self._append(state, action, reward, n_state, done, trun, stream)
+
+    def _append(self, state, action, reward, n_state, done, trun, stream):
+        framestack = self.framestack
+        state_mem = self.state_mem
+        hot_mem = self.hot_mem
+        stream_head, stream_rewards, last_terminal = self.stream_views
+        state_ring = self.state_row_views[stream]
+        reward_ring = self.reward_row_views[stream]
+        state_mem_idx = self.state_mem_idx
 
         # append to memory
-        self.append_memory(state, action, reward, n_state, done, trun, stream)
-
-        # append to pointer
-        self.append_pointer(stream, prio)
-
-        if done or trun:
-            self.finalize_experiences(stream)
-            self.state_buffer[stream] = []
-            self.reward_buffer[stream] = []
-
-        self.last_terminal[stream] = done or trun
-
-    # def _set_priority_min(self, idx, priority_alpha):
-    #     idx += self.size
-    #     self.priority_min[idx] = priority_alpha
-    #     while idx >= 2:
-    #         idx //= 2
-    #         self.priority_min[idx] = min(self.priority_min[2 * idx], self.priority_min[2 * idx + 1])
-
-    def append_pointer(self, stream, prio):
-
-        while len(self.state_buffer[stream]) >= self.framestack + self.n_step and len(self.reward_buffer[stream]) >= self.n_step:
-            # First array in the experience
-            state_array = self.state_buffer[stream][:self.framestack]
-
-            # Second array in the experience (starts after N frames)
-            n_state_array = self.state_buffer[stream][self.n_step:self.n_step + self.framestack]
-
-            # Reward array (first N rewards)
-            reward_array = self.reward_buffer[stream][:self.n_step]
-
-            #print("Added Experience: (" + str(self.point_mem_idx) + ")")
-            #print((np.array(state_array, dtype=int), np.array(n_state_array, dtype=int), np.array(reward_array, dtype=int)))
-
-            # Add the experience to the list
-            self.pointer_mem[self.point_mem_idx] = (np.array(state_array, dtype=int), np.array(n_state_array, dtype=int),
-                                                             np.array(reward_array, dtype=int))
-
-            #self._set_priority_min(self.point_mem_idx, sqrt(self.max_prio))
-            self.st.append(self.max_prio ** self.alpha)
-
-            self.capacity = min(self.size, self.capacity + 1)
-            self.point_mem_idx = (self.point_mem_idx + 1) % self.size
-
-            # Remove the first state and reward from the buffers to slide the window
-            self.state_buffer[stream].pop(0)
-            self.reward_buffer[stream].pop(0)
+        if last_terminal[stream]:
+            # add full transition
+            head, held = 0, 0
+            for i in range(framestack):
+                state_mem[state_mem_idx] = state[i]
+                if hot_mem is not None:
+                    hot_mem[state_mem_idx % self.hot_frames] = state[i]
+                state_ring[i] = state_mem_idx
+                state_mem_idx = (state_mem_idx + 1) % self.storage_size
+            self.frames_added += framestack
+        else:
+            head, held = stream_head[stream], stream_rewards[stream]
+
+        # remember n_step is not applied in this memory
+        state_mem[state_mem_idx] = n_state[framestack - 1]
+        if hot_mem is not None:
+            hot_mem[state_mem_idx % self.hot_frames] = n_state[framestack - 1]
+        state_ring[(head + framestack + held) % self.ring_len] = state_mem_idx
+        self.state_mem_idx = (state_mem_idx + 1) % self.storage_size
+        self.frames_added += 1
+
+        reward_mem_idx = self.reward_mem_idx
+        action_mem, reward_mem, done_mem, trun_mem = self.step_views
+        action_mem[reward_mem_idx] = action
+        reward_mem[reward_mem_idx] = reward
+        done_mem[reward_mem_idx] = done
+        trun_mem[reward_mem_idx] = trun
+
+        reward_ring[(head + held) % self.n_step] = reward_mem_idx
+        self.reward_mem_idx = (reward_mem_idx + 1) % self.storage_size
+        self.rewards_added += 1
+        held += 1
+
+        # append to pointer, sliding the window once it is full
+        if held >= self.n_step:
+            self.add_transition(self.state_rows[stream], self.reward_rows[stream], head, held)
+            head += 1
+            held -= 1
             self.beta = 0
 
-    def finalize_experiences(self, stream):
-        # Process remaining states and rewards at the end of an episode
-        while len(self.state_buffer[stream]) >= self.framestack and len(self.reward_buffer[stream]) > 0:
-            # First array in the experience
-            first_array = self.state_buffer[stream][:self.framestack]
-
-            # Second array in the experience (Final `framestack` elements)
-            second_array = self.state_buffer[stream][-self.framestack:]
-            #print(second_array)
-
-            # Reward array
-            reward_array = self.reward_buffer[stream][:]
-            while len(reward_array) < self.n_step:
-                reward_array.extend([0])
-
-            # Add the experience
-            self.pointer_mem[self.point_mem_idx] = (np.array(first_array, dtype=int), np.array(second_array, dtype=int),
-                                                             np.array(reward_array, dtype=int))
-
-            #self._set_priority_min(self.point_mem_idx, sqrt(self.max_prio))
-            self.st.append(self.max_prio ** self.alpha)
+        # at the end of an episode every reward still held starts a transition
+        ended = bool(done or trun)
+        if ended:
+            while held > 0:
+                self.add_transition(self.state_rows[stream], self.reward_rows[stream], head, held)
+                head += 1
+                held -= 1
+            head = 0
 
-            self.point_mem_idx = (self.point_mem_idx + 1) % self.size
-            self.capacity = min(self.size, self.capacity + 1)
+        stream_head[stream] = head % self.ring_period
+        stream_rewards[stream] = held
+        last_terminal[stream] = ended
 
-            # Remove the first state and reward from the buffers to slide the window
-            self.state_buffer[stream].pop(0)
-            if len(self.reward_buffer[stream]) > 0:
-                self.reward_buffer[stream].pop(0)
+    def add_transition(self, state_ring, reward_ring, head, held):
+        """
+        Add the transition starting at the head of a stream's rings. The n-step state ends at the newest frame held,
+        which is n frames on for a full window or the final frames of the episode when it ended early.
+        """
+        point = self.point_mem_idx
+        self.state_pointer_mem[point] = state_ring[self.state_windows[head % self.ring_len]]
+        self.n_state_pointer_mem[point] = state_ring[self.state_windows[(head + held) % self.ring_len]]
 
-    def append_memory(self, state, action, reward, n_state, done, trun, stream):
+        # rewards past the end of the episode point at slot 0, they are masked by the done / truncation
+        self.reward_pointer_mem[point] = reward_ring[self.reward_windows[head % self.n_step]]
+        if held < self.n_step:
+            self.reward_pointer_mem[point, held:] = 0
 
-        if self.last_terminal[stream]:
-            # add full transition
-            for i in range(self.framestack):
-                self.state_mem[self.state_mem_idx] = state[i]
-                self.state_buffer[stream].append(self.state_mem_idx)
-                self.state_mem_idx = (self.state_mem_idx + 1) % self.storage_size
+        self.st.append(self.max_prio ** self.alpha)
 
-            # remember n_step is not applied in this memory
-            self.state_mem[self.state_mem_idx] = n_state[self.framestack - 1]
-            self.state_buffer[stream].append(self.state_mem_idx)
-            self.state_mem_idx = (self.state_mem_idx + 1) % self.storage_size
+        self.point_mem_idx = (point + 1) % self.size
+        self.capacity = min(self.size, self.capacity + 1)
+        self.transitions_added += 1
 
-            self.action_mem[self.reward_mem_idx] = action
-            self.reward_mem[self.reward_mem_idx] = reward
-            self.done_mem[self.reward_mem_idx] = done
-            self.trun_mem[self.reward_mem_idx] = trun
+    def append_batch(self, states, actions, rewards, n_states, dones, truns):
+        """
+        Append one transition for every stream at once. The memory ends up exactly as if append had been
+        called for stream 0, 1, ... in turn.
 
-            self.reward_buffer[stream].append(self.reward_mem_idx)
-            self.reward_mem_idx = (self.reward_mem_idx + 1) % self.storage_size
+        states and n_states have shape (envs, framestack, ...), the rest have shape (envs,).
+        """
+        with self.write_lock:
+            self._append_batch(states, actions, rewards, n_states, dones, truns)
 
-            self.tstep_counter[stream] = 0
+    def _append_batch(self, states, actions, rewards, n_states, dones, truns):
+        envs = self.last_terminal.size
+        framestack = self.framestack
+        ring_len = self.ring_len
+        ended = np.logical_or(dones, truns)
 
-        else:
-            # just add relevant info
-            self.state_mem[self.state_mem_idx] = n_state[self.framestack - 1]
-            self.state_buffer[stream].append(self.state_mem_idx)
-            self.state_mem_idx = (self.state_mem_idx + 1) % self.storage_size
+        # append to memory
+        # streams starting an episode store their whole first state, the rest only the newest frame
+        first = self.last_terminal
+        frame_counts = np.where(first, framestack + 1, 1)
+        frame_offsets = np.cumsum(frame_counts) - frame_counts
+        num_frames = int(frame_counts.sum())
+        frame_idxs = (self.state_mem_idx + np.arange(num_frames)) % self.storage_size
+        self.state_mem_idx = (self.state_mem_idx + num_frames) % self.storage_size
+        self.frames_added += num_frames
+
+        newest_idxs = frame_idxs[frame_offsets + frame_counts - 1]
+        self.state_mem[newest_idxs] = n_states[:, framestack - 1]
+        if self.hot_mem is not None:
+            self.hot_mem[newest_idxs % self.hot_frames] = n_states[:, framestack - 1]
+
+        reward_idxs = (self.reward_mem_idx + np.arange(envs)) % self.storage_size
+        self.reward_mem_idx = (self.reward_mem_idx + envs) % self.storage_size
+        self.rewards_added += envs
+        self.action_mem[reward_idxs] = actions
+        self.reward_mem[reward_idxs] = rewards
+        self.done_mem[reward_idxs] = dones
+        self.trun_mem[reward_idxs] = truns
+
+        # push onto the stream rings
+        heads = np.where(first, 0, self.stream_head)
+        held = np.where(first, 0, self.stream_rewards)
+        if first.any():
+            starting = np.flatnonzero(first)
+            start_idxs = frame_idxs[frame_offsets[starting, None] + self.ring_cols]
+            self.state_mem[start_idxs] = states[starting]
+            if self.hot_mem is not None:
+                self.hot_mem[start_idxs % self.hot_frames] = states[starting]
+            self.state_ring[starting, :framestack] = start_idxs
+
+        self.state_ring[self.all_streams, (heads + framestack + held) % ring_len] = newest_idxs
+        self.reward_ring[self.all_streams, (heads + held) % self.n_step] = reward_idxs
+        held = held + 1
 
-            self.action_mem[self.reward_mem_idx] = action
-            self.reward_mem[self.reward_mem_idx] = reward
-            self.done_mem[self.reward_mem_idx] = done
-            self.trun_mem[self.reward_mem_idx] = trun
+        # append to pointer
+        # a full window gives one transition, an ended episode one for every reward still held
+        full = held >= self.n_step
+        counts = np.where(ended, held, full)
+        total = int(counts.sum())
+
+        if total > 0:
+            # record j of a stream is the transition j steps on from its head, as add_transition would build it
+            rec_streams = np.repeat(self.all_streams, counts)
+            rec_j = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            rec_heads = heads[rec_streams] + rec_j
+            rec_held = held[rec_streams] - rec_j
+            rings = rec_streams[:, None]
+
+            n_state_cols = (rec_heads + rec_held)[:, None] + self.ring_cols
+            reward_array = self.reward_ring[rings, (rec_heads[:, None] + self.reward_cols) % self.n_step]
+            reward_array[self.reward_cols >= rec_held[:, None]] = 0
+
+            point_idxs = (self.point_mem_idx + np.arange(total)) % self.size
+            self.state_pointer_mem[point_idxs] = self.state_ring[rings, (rec_heads[:, None] + self.ring_cols) % ring_len]
+            self.n_state_pointer_mem[point_idxs] = self.state_ring[rings, n_state_cols % ring_len]
+            self.reward_pointer_mem[point_idxs] = reward_array
+
+            self.st.append_batch(np.full(total, self.max_prio ** self.alpha))
+
+            self.point_mem_idx = (self.point_mem_idx + total) % self.size
+            self.capacity = min(self.size, self.capacity + total)
+            self.transitions_added += total
+
+        if full.any():
+            self.beta = 0
 
-            self.reward_buffer[stream].append(self.reward_mem_idx)
-            self.reward_mem_idx = (self.reward_mem_idx + 1) % self.storage_size
+        # slide the windows, ended streams start again from their next state
+        self.stream_head[:] = np.where(ended, 0, (heads + full) % self.ring_period)
+        self.stream_rewards[:] = np.where(ended, 0, held - full)
+        self.last_terminal[:] = ended
 
     def sample(self, batch_size):
 
@@ -291,51 +601,39 @@ class PER:
 
         probs = (prios + 1e-6) / (p_total + 1e-6)
 
-        # fetch the pointers by using indices
-        pointers = self.pointer_mem[idxs]
-
-        # Extract the pointers into separate arrays
-        state_pointers = np.array([p[0] for p in pointers])
-        n_state_pointers = np.array([p[1] for p in pointers])
-        reward_pointers = np.array([p[2] for p in pointers])
-        if self.n_step > 1:
-            action_pointers = np.array([p[2][0] for p in pointers])
-        else:
-            action_pointers = np.array([p[2] for p in pointers])
+        state_pointers, n_state_pointers, actions, rewards, dones = self.transitions(idxs)
 
         # get state info
-        states = torch.tensor(self.state_mem[state_pointers], dtype=torch.uint8)
-        n_states = torch.tensor(self.state_mem[n_state_pointers], dtype=torch.uint8)
-
-        # reward and dones just use the same pointer. actions just use the first one
-        rewards = self.reward_mem[reward_pointers]
-        dones = self.done_mem[reward_pointers]
-        truns = self.trun_mem[reward_pointers]
-        actions = self.action_mem[action_pointers]
-
-        # apply n_step cumulation to rewards and dones
-        if self.n_step > 1:
-            rewards, dones = self.compute_discounted_rewards_batch(rewards, dones, truns)
-
-        #prob_min = self.priority_min[1] / p_total
-        #max_weight = (prob_min * self.capacity) ** (-self.beta)
+        if self.uint8_states:
+            states, n_states = self.stage_states(state_pointers, n_state_pointers)
+        else:
+            states, n_states = self.gather_frames(state_pointers, n_state_pointers)
+            states = torch.tensor(states, dtype=torch.uint8)
+            n_states = torch.tensor(n_states, dtype=torch.uint8)
 
         # Compute importance-sampling weights w
         weights = (self.capacity * probs) ** -self.alpha  # self.beta originally this was an accident but actually performed better
         # seems to perform better without this for some reason? This is disabled from the agent class
 
-        weights = torch.tensor(weights / weights.max(), dtype=torch.float32,
-                               device=self.device)  # Normalise by max importance-sampling weight from batch
+        if self.global_weight_norm:
+            # Normalise by the max importance-sampling weight of the whole memory, which the lowest priority gets
+            prob_min = (self.st.min() + 1e-6) / (p_total + 1e-6)
+            weights = weights / (self.capacity * prob_min) ** -self.alpha
+        else:
+            weights = weights / weights.max()  # Normalise by max importance-sampling weight from batch
 
-        if torch.isnan(weights).any():
+        # checked on the host so that sampling never waits for the device
+        if np.isnan(weights).any():
             print("Nan Found is sample!")
             print(f"Prios {prios}")
             print(f"Probs {probs}")
             print(f"Weights {weights}")
 
         # move to pytorch GPU tensors
-        states = states.to(torch.float32).to(self.device)
-        n_states = n_states.to(torch.float32).to(self.device)
+        if not self.uint8_states:
+            states = states.to(torch.float32).to(self.device)
+            n_states = n_states.to(torch.float32).to(self.device)
+        weights = torch.tensor(weights, dtype=torch.float32, device=self.device)
         rewards = torch.tensor(rewards, dtype=torch.float32, device=self.device)
         dones = torch.tensor(dones, dtype=torch.bool, device=self.device)
         actions = torch.tensor(actions, dtype=torch.int64, device=self.device)
@@ -343,40 +641,126 @@ class PER:
         # return batch
         return tree_idxs, states, actions, rewards, n_states, dones, weights
 
+    def transitions(self, idxs):
+        """ The frame pointers, first actions, n-step discounted rewards and dones of the transitions at idxs. """
+        # fetch the pointers by using indices
+        state_pointers = self.state_pointer_mem[idxs]
+        n_state_pointers = self.n_state_pointer_mem[idxs]
+        reward_pointers = self.reward_pointer_mem[idxs]
+        if self.n_step > 1:
+            action_pointers = reward_pointers[:, 0]
+        else:
+            action_pointers = reward_pointers
+
+        # reward and dones just use the same pointer. actions just use the first one
+        rewards = self.reward_mem[reward_pointers]
+        dones = self.done_mem[reward_pointers]
+        truns = self.trun_mem[reward_pointers]
+        actions = self.action_mem[action_pointers]
+
+        # apply n_step cumulation to rewards and dones
+        if self.n_step > 1:
+            rewards, dones = self.compute_discounted_rewards_batch(rewards, dones, truns)
+
+        return state_pointers, n_state_pointers, actions, rewards, dones
+
+    def stage_states(self, state_pointers, n_state_pointers):
+        """ Gather the sampled frames as uint8 and move them to the device, see StagingBuffers. """
+        return self.staging.stage(state_pointers.shape + self.state_mem.shape[1:],
+                                  partial(self.gather_frames, state_pointers, n_state_pointers))
+
+    def gather_frames(self, state_pointers, n_state_pointers, states_out=None, n_states_out=None):
+        """
+        Gather the frames of the sampled states and n-states, into states_out and n_states_out if given.
+
+        From RAM this is one np.take each. From a memmap, the frames both use are read once and in file order, so
+        every page is faulted in at most once per batch and the reads run forwards through the file; frames still in
+        the hot cache are read from there instead. Compressed frames are likewise decompressed once per batch.
+        """
+        if self.memmap_dir is None and self.compress_frames is None:
+            # 'clip' lets take write straight into the output instead of buffering, pointers are always in range
+            return (np.take(self.state_mem, state_pointers, axis=0, out=states_out, mode='clip'),
+                    np.take(self.state_mem, n_state_pointers, axis=0, out=n_states_out, mode='clip'))
+
+        frames, inverse = np.unique(np.stack((state_pointers, n_state_pointers)), return_inverse=True)
+        inverse = inverse.reshape((2,) + state_pointers.shape)
+        gathered = np.empty((frames.size,) + self.state_mem.shape[1:], dtype=np.uint8)
+        if self.compress_frames is not None:
+            self.state_mem.take(frames, out=gathered)
+        elif self.hot_mem is not None:
+            hot = (self.state_mem_idx - 1 - frames) % self.storage_size < self.hot_frames
+            gathered[hot] = self.hot_mem[frames[hot] % self.hot_frames]
+            gathered[~hot] = self.state_mem[frames[~hot]]
+        else:
+            gathered[:] = self.state_mem[frames]
+
+        return (np.take(gathered, inverse[0], axis=0, out=states_out, mode='clip'),
+                np.take(gathered, inverse[1], axis=0, out=n_states_out, mode='clip'))
+
+    def storage(self, name, shape, dtype):
+        """ A zeroed array for one of the memories, in RAM or in a memmap file under memmap_dir. """
+        if self.memmap_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        os.makedirs(self.memmap_dir, exist_ok=True)
+        return np.memmap(os.path.join(self.memmap_dir, name + ".dat"), dtype=dtype, mode="w+", shape=shape)
+
     def compute_discounted_rewards_batch(self, rewards_batch, dones_batch, truns_batch):
         """
         Compute discounted rewards for a batch of rewards and dones.
 
+        Rewards after the first done or truncation in a row are ignored.
+
         Parameters:
         rewards_batch (np.ndarray): 2D array of rewards with shape (batch_size, n_step)
         dones_batch (np.ndarray): 2D array of dones with shape (batch_size, n_step)
+        truns_batch (np.ndarray): 2D array of truncations with shape (batch_size, n_step)
 
         Returns:
         np.ndarray: 1D array of discounted rewards for each element in the batch
         np.ndarray: 1D array of cumulative dones (True if any done is True in the sequence)
         """
         batch_size, n_step = rewards_batch.shape
+        discounts = self.discount_vector(n_step)
+
+        # A step counts if no done or truncation happened strictly before it
+        stops = np.logical_or(dones_batch, truns_batch)
+        counted = (np.cumsum(stops, axis=1) - stops) == 0
+
+        cumulative_dones = np.logical_and(dones_batch, counted).any(axis=1)
+
+        # Accumulate column by column so the sums match the sequential per-element loop exactly
+        counted_rewards = np.where(counted, rewards_batch, 0.0)
         discounted_rewards = np.zeros(batch_size)
-        cumulative_dones = np.zeros(batch_size, dtype=bool)
-
-        for i in range(batch_size):
-            cumulative_discount = 1
-            for j in range(n_step):
-                discounted_rewards[i] += cumulative_discount * rewards_batch[i, j]
-                if dones_batch[i, j] == 1:
-                    cumulative_dones[i] = True
-                    break
-                elif truns_batch[i, j] == 1:
-                    break
-                cumulative_discount *= self.gamma
+        for j in range(n_step):
+            discounted_rewards += discounts[j] * counted_rewards[:, j]
 
         return discounted_rewards, cumulative_dones
 
-    def update_priorities(self, idxs, priorities):
-        priorities = priorities + self.eps
+    def discount_vector(self, n_step):
+        """
+        Return [1, gamma, gamma^2, ...] of length n_step, built by repeated multiplication.
+        Cached until gamma changes, since the agent may anneal it.
+        """
+        if self._discounts is None or self._discounts_gamma != self.gamma or len(self._discounts) != n_step:
+            discounts = np.ones(n_step)
+            for j in range(1, n_step):
+                discounts[j] = discounts[j - 1] * self.gamma
+            self._discounts = discounts
+            self._discounts_gamma = self.gamma
+
+        return self._discounts
+
+    def update_priorities(self, idxs, priorities, added=None):
+        # with added, skip slots that have been written to since transitions_added was added
+        if added is not None:
+            overwritten = self.transitions_added - added
+            if overwritten > 0:
+                slots = idxs - self.st.tree_start
+                age = (slots - (self.point_mem_idx - overwritten)) % self.size
+                keep = age >= min(overwritten, self.size)
+                idxs, priorities = idxs[keep], priorities[keep]
 
-        # for idx, priority in zip(idxs, priorities):
-        #     self._set_priority_min(idx - self.size + 1, sqrt(priority))
+        priorities = priorities + self.eps
 
         if np.isnan(priorities).any():
             print("NaN found in priority!")
@@ -385,6 +769,496 @@ class PER:
         self.max_prio = max(self.max_prio, np.max(priorities))
         self.st.update(idxs, priorities ** self.alpha)
 
+    # memories that are rings indexed by frames, steps or transitions, with the counter of how many were ever written
+    SNAPSHOT_RINGS = {"state_mem": "frames_added", "action_mem": "rewards_added", "reward_mem": "rewards_added",
+                      "done_mem": "rewards_added", "trun_mem": "rewards_added",
+                      "state_pointer_mem": "transitions_added", "n_state_pointer_mem": "transitions_added",
+                      "reward_pointer_mem": "transitions_added"}
+    # the per-stream rings are left out, a resumed run resets its envs so every stream starts a new episode
+    SNAPSHOT_STATE = ["capacity", "point_mem_idx", "transitions_added", "state_mem_idx", "reward_mem_idx",
+                      "frames_added", "rewards_added", "max_prio", "beta", "gamma"]
+    # rows of a ring a save copies at a time, while holding write_lock
+    SNAPSHOT_CHUNK_BYTES = 16 * 2 ** 20
+
+    def save(self, path):
+        """
+        Snapshot the memory into the directory path, so a run can be resumed with load.
+
+        Every memory is an .npy file. The first save to a path writes the part of each ring that has been filled,
+        later saves only the part written since the previous save. Both run on a background thread, so save only
+        blocks for copying the sum tree and counters, which go in meta.npz. The thread copies the rings a bounded
+        chunk at a time under write_lock, so appends wait for one chunk at most, and a compressed frame store only
+        decompresses one chunk at a time.
+
+        A later save first writes what changed to a .delta.npy file per ring, then commits them by replacing
+        pending.npz, which holds the new meta, and only then writes them into the rings and moves pending.npz to
+        meta.npz. A save cut short before the commit leaves the previous snapshot as it was, one cut short after
+        it is finished by load. A first save removes the meta of any older snapshot in path, so if it is cut short
+        there is nothing to load.
+
+        Appends carry on while the thread writes, so transitions in, or pointing into, the slots written since the
+        save call are left out of the snapshot's sum tree. The next save, load or wait_saved waits for the thread,
+        and raises if it failed.
+        """
+        self.wait_saved()
+        os.makedirs(path, exist_ok=True)
+
+        full = self.snapshot is None or self.snapshot["path"] != path
+        if full:
+            # the rings are about to be replaced, an older snapshot here must not stay loadable with them
+            for name in ("meta.npz", "pending.npz"):
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+
+        segments = []
+        for name, counter in self.SNAPSHOT_RINGS.items():
+            memory = getattr(self, name)
+            # a ring is filled from slot 0, so its filled part is the slots written since it started
+            changed = getattr(self, counter) - (0 if full else self.snapshot[counter])
+            end = getattr(self, counter) % len(memory)
+            segments.append((name, memory, end, min(changed, len(memory))))
+
+        meta = {name: np.copy(getattr(self, name)) for name in self.SNAPSHOT_STATE}
+        meta.update(sum_tree=self.st.sum_tree.copy(), tree_index=self.st.index, tree_full=self.st.full,
+                    tree_max=self.st.max, size=self.size, storage_size=self.storage_size, framestack=self.framestack,
+                    n_step=self.n_step, envs=self.last_terminal.size)
+        if self.st.min_tree is not None:
+            meta.update(min_tree=self.st.min_tree.copy())
+        self.snapshot = {"path": path, "frames_added": self.frames_added, "rewards_added": self.rewards_added,
+                         "transitions_added": self.transitions_added}
+
+        self.save_thread = threading.Thread(target=self._run_save, args=(path, segments, meta, full), daemon=True)
+        self.save_thread.start()
+
+    def _run_save(self, path, segments, meta, full):
+        try:
+            self._write_snapshot(path, segments, meta, full)
+        except BaseException as e:
+            self.save_error = e
+
+    def _write_snapshot(self, path, segments, meta, full):
+        for name, memory, end, count in segments:
+            if full:
+                # a new .npy file of the whole ring, only the filled part is written, the rest stays sparse
+                stored = np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=memory.dtype,
+                                                   shape=memory.shape)
+            elif count > 0:
+                stored = np.lib.format.open_memmap(os.path.join(path, name + ".delta.npy"), mode="w+",
+                                                   dtype=memory.dtype, shape=(count,) + memory.shape[1:])
+            else:
+                continue
+
+            # the changed part of a ring is [end - count, end), which may wrap past the end of the array
+            step = max(1, self.SNAPSHOT_CHUNK_BYTES // (memory.dtype.itemsize * int(np.prod(memory.shape[1:]))))
+            written = 0
+            for lo, hi in ring_segments(end, count, len(memory)):
+                for chunk in range(lo, hi, step):
+                    chunk_end = min(chunk + step, hi)
+                    with self.write_lock:
+                        rows = np.array(memory[chunk:chunk_end])
+                    if full:
+                        stored[chunk:chunk_end] = rows
+                    else:
+                        stored[written:written + chunk_end - chunk] = rows
+                    written += chunk_end - chunk
+            stored.flush()
+            del stored
+
+        with self.write_lock:
+            self._drop_raced(meta)
+
+        if full:
+            write_npz(os.path.join(path, "meta.npz"), meta)
+            return
+
+        meta.update(delta_ends=np.array([end for _, _, end, _ in segments]),
+                    delta_counts=np.array([count for _, _, _, count in segments]))
+        write_npz(os.path.join(path, "pending.npz"), meta)
+        self.apply_pending(path)
+
+    @classmethod
+    def apply_pending(cls, path):
+        """ Write the deltas committed by pending.npz into the rings at path, then make it the snapshot's meta. """
+        pending = os.path.join(path, "pending.npz")
+        with np.load(pending) as meta:
+            ends, counts = meta["delta_ends"], meta["delta_counts"]
+
+        for name, end, count in zip(cls.SNAPSHOT_RINGS, ends.tolist(), counts.tolist()):
+            if count == 0:
+                continue
+            stored = np.load(os.path.join(path, name + ".npy"), mmap_mode="r+")
+            delta = np.load(os.path.join(path, name + ".delta.npy"), mmap_mode="r")
+            written = 0
+            for lo, hi in ring_segments(end, count, len(stored)):
+                stored[lo:hi] = delta[written:written + hi - lo]
+                written += hi - lo
+            stored.flush()
+            del stored, delta
+
+        os.replace(pending, os.path.join(path, "meta.npz"))
+        for name in cls.SNAPSHOT_RINGS:
+            if os.path.exists(os.path.join(path, name + ".delta.npy")):
+                os.remove(os.path.join(path, name + ".delta.npy"))
+
+    def _drop_raced(self, meta):
+        """
+        Zero the priority, in meta's sum tree, of every transition that was written, or that points at a frame or
+        reward that was written, after meta was taken. The rings were copied while appends went on, so those slots
+        may hold data newer than meta describes.
+        """
+        def raced(pointers, counter, length):
+            # slots written since the save call, which start where the ring stood at the time
+            count = min(getattr(self, counter) - int(meta[counter]), length)
+            return (pointers - int(meta[counter])) % length < count
+
+        invalid = raced(np.arange(self.size), "transitions_added", self.size)
+        invalid |= raced(self.state_pointer_mem, "frames_added", self.storage_size).any(axis=1)
+        invalid |= raced(self.n_state_pointer_mem, "frames_added", self.storage_size).any(axis=1)
+        invalid |= raced(self.reward_pointer_mem.reshape(self.size, -1), "rewards_added", self.storage_size).any(axis=1)
+
+        leaves = np.flatnonzero(invalid) + self.st.tree_start
+        if leaves.size == 0:
+            return
+        tree = SumTree(self.size)
+        tree.sum_tree = meta["sum_tree"]
+        tree.sum_tree[leaves] = 0
+        if "min_tree" in meta:
+            tree.min_tree = meta["min_tree"]
+            tree.min_tree[leaves] = np.inf
+        tree._propagate(leaves)
+
+    def wait_saved(self):
+        """ Wait for a save running in the background to finish, and raise if it failed. """
+        if self.save_thread is not None:
+            self.save_thread.join()
+            self.save_thread = None
+
+        if self.save_error is not None:
+            error, self.save_error = self.save_error, None
+            # what is on disk no longer matches self.snapshot, so the next save writes everything again
+            self.snapshot = None
+            raise RuntimeError("Replay snapshot save failed") from error
+
+    def load(self, path):
+        """ Restore a snapshot written by save. The memory must have been created with the same sizes. """
+        self.wait_saved()
+        if os.path.exists(os.path.join(path, "pending.npz")):
+            # a save was cut short after committing its deltas
+            self.apply_pending(path)
+        with np.load(os.path.join(path, "meta.npz")) as meta:
+            meta = dict(meta)
+
+        expected = {"size": self.size, "storage_size": self.storage_size, "framestack": self.framestack,
+                    "n_step": self.n_step, "envs": self.last_terminal.size}
+        for name, value in expected.items():
+            if int(meta[name]) != value:
+                raise ValueError(f"Snapshot at {path} has {name} {int(meta[name])}, this memory has {value}")
+
+        for name in self.SNAPSHOT_RINGS:
+            getattr(self, name)[:] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+        for name in self.SNAPSHOT_STATE:
+            value = meta[name]
+            if value.ndim == 0:
+                # counts stay python numbers, numpy ints would promote the sampling weights to float64
+                value = value.item()
+            setattr(self, name, value)
+
+        self.st.sum_tree[:] = meta["sum_tree"]
+        self.st.index = int(meta["tree_index"])
+        self.st.full = bool(meta["tree_full"])
+        self.st.max = meta["tree_max"].item()
+
+        # the envs are reset when a run resumes, so every stream starts a new episode instead of joining its first
+        # frames onto the frames and rewards it held when the snapshot was taken
+        self.last_terminal[:] = True
+        self.stream_head[:] = 0
+        self.stream_rewards[:] = 0
+
+        if self.st.min_tree is not None:
+            # a snapshot without a min-tree is rebuilt from its leaves
+            if "min_tree" in meta:
+                self.st.min_tree[:] = meta["min_tree"]
+            else:
+                leaves = np.arange(self.capacity) + self.st.tree_start
+                self.st.min_tree[:] = np.inf
+                if self.capacity > 0:
+                    self.st.min_tree[leaves] = self.st.sum_tree[leaves]
+                    self.st._propagate(leaves)
+
+        if self.hot_mem is not None:
+            newest = (self.state_mem_idx - 1 - np.arange(self.hot_frames)) % self.storage_size
+            self.hot_mem[newest % self.hot_frames] = self.state_mem[newest]
+
+        self.snapshot = {"path": path, "frames_added": self.frames_added, "rewards_added": self.rewards_added,
+                         "transitions_added": self.transitions_added}
+
+class ShardedPER:
+    """
+    A prioritised replay split into shards by env stream. Every shard is a PER over its own streams, with its own sum
+    tree, storage and lock, so actors appending to different shards never wait on each other, and the learner only
+    ever holds the shard it is reading from.
+
+    sample() stratifies the batch over the priorities of every shard laid end to end, so each shard gets a share of the
+    batch in proportion to its total priority, and transitions are drawn and weighted as from a single memory. The
+    tree indices it returns carry their shard, for update_priorities.
+    """
+    def __init__(self, shards, size, device, n, envs, gamma, memmap_dir=None, hot_frames=0, **kwargs):
+        """
+        Args:
+            shards (int): Number of shards, at most one per env stream
+            size (int): Transitions held over all shards, split evenly between them
+            device: Device that sampled batches are moved to
+            n (int): n-step
+            envs (int): Number of env streams, split into contiguous runs, one per shard
+            gamma (float): Discount
+            memmap_dir (str): Directory holding a memmap subdirectory per shard, None to keep them in RAM
+            hot_frames (int): Hot frame cache over all shards
+            **kwargs: Passed on to every shard's PER
+        """
+        shards = max(1, min(shards, envs))
+        # the sum tree needs an even number of leaves
+        shard_size = size // shards // 2 * 2
+
+        self.streams = np.array_split(np.arange(envs), shards)
+        self.stream_shard = np.concatenate([np.full(len(streams), i) for i, streams in enumerate(self.streams)])
+        self.stream_index = np.concatenate([np.arange(len(streams)) for streams in self.streams])
+
+        self.shards = [PER(shard_size, device, n, len(streams), gamma,
+                           memmap_dir=None if memmap_dir is None else os.path.join(memmap_dir, "shard" + str(i)),
+                           hot_frames=hot_frames // shards, **kwargs)
+                       for i, streams in enumerate(self.streams)]
+        self.locks = [threading.Lock() for _ in self.shards]
+
+        first = self.shards[0]
+        # tree indices of shard i are offset by i * stride
+        self.stride = first.st.sum_tree.shape[0]
+        self.size = shard_size * shards
+        self.state_shape = (first.framestack,) + first.state_mem.shape[1:]
+        self.alpha = first.alpha
+        self.global_weight_norm = first.global_weight_norm
+        self.uint8_states = first.uint8_states
+        self.device = device
+        # samples are taken one at a time, so a prefetch thread and the learner never share a staging slot
+        self.staging = StagingBuffers(device, first.pin_staging)
+        self.sample_lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return sum(shard.capacity for shard in self.shards)
+
+    @property
+    def transitions_added(self):
+        return np.array([shard.transitions_added for shard in self.shards])
+
+    @property
+    def beta(self):
+        return self.shards[0].beta
+
+    @beta.setter
+    def beta(self, beta):
+        for shard in self.shards:
+            shard.beta = beta
+
+    @property
+    def gamma(self):
+        return self.shards[0].gamma
+
+    @gamma.setter
+    def gamma(self, gamma):
+        for shard in self.shards:
+            shard.gamma = gamma
+
+    def append(self, state, action, reward, n_state, done, trun, stream, prio=True):
+        shard = self.stream_shard[stream]
+        with self.locks[shard]:
+            self.shards[shard].append(state, action, reward, n_state, done, trun, self.stream_index[stream], prio=prio)
+
+    def append_batch(self, states, actions, rewards, n_states, dones, truns, shard=None):
+        """
+        Append one transition for every stream. With shard, the arrays hold only that shard's streams, which is how
+        an actor that owns a shard appends without touching the others.
+        """
+        if shard is not None:
+            with self.locks[shard]:
+                self.shards[shard].append_batch(states, actions, rewards, n_states, dones, truns)
+            return
+
+        for shard, streams in enumerate(self.streams):
+            run = slice(streams[0], streams[-1] + 1)
+            self.append_batch(states[run], actions[run], rewards[run], n_states[run], dones[run], truns[run],
+                              shard=shard)
+
+    def sample(self, batch_size):
+        with self.sample_lock:
+            return self._sample(batch_size)
+
+    def _sample(self, batch_size):
+        # shard totals are read without their locks, an append in between only skews this batch's split a little
+        totals = np.array([shard.st.total() for shard in self.shards], dtype=np.float32)
+        p_total = totals.sum()
+
+        segment_length = p_total / batch_size
+        segment_starts = np.arange(batch_size) * segment_length
+        samples = np.random.uniform(0.0, segment_length, [batch_size]) + segment_starts
+
+        # the samples are sorted, so every shard gets one contiguous run of the batch
+        ends = np.cumsum(totals)
+        splits = np.concatenate(([0], np.searchsorted(samples, ends[:-1]), [batch_size]))
+        parts = []
+
+        def gather(states_out=None, n_states_out=None):
+            if states_out is None:
+                states_out = np.empty((batch_size,) + self.state_shape, dtype=np.uint8)
+                n_states_out = np.empty((batch_size,) + self.state_shape, dtype=np.uint8)
+
+            for shard, memory in enumerate(self.shards):
+                start, end = splits[shard], splits[shard + 1]
+                if start == end:
+                    continue
+                with self.locks[shard]:
+                    prios, idxs, tree_idxs = memory.st.find(samples[start:end] - (ends[shard] - totals[shard]))
+                    state_pointers, n_state_pointers, actions, rewards, dones = memory.transitions(idxs)
+                    memory.gather_frames(state_pointers, n_state_pointers, states_out[start:end],
+                                         n_states_out[start:end])
+                parts.append((tree_idxs + shard * self.stride, prios, actions, rewards, dones))
+
+            return states_out, n_states_out
+
+        if self.uint8_states:
+            states, n_states = self.staging.stage((batch_size,) + self.state_shape, gather)
+        else:
+            states, n_states = gather()
+            states = torch.from_numpy(states).to(torch.float32).to(self.device)
+            n_states = torch.from_numpy(n_states).to(torch.float32).to(self.device)
+
+        tree_idxs, prios, actions, rewards, dones = (np.concatenate(part) for part in zip(*parts))
+
+        # Compute importance-sampling weights w over the whole memory, as PER.sample does
+        probs = (prios + 1e-6) / (p_total + 1e-6)
+        capacity = self.capacity
+        weights = (capacity * probs) ** -self.alpha
+
+        if self.global_weight_norm:
+            prob_min = (min(shard.st.min() for shard in self.shards) + 1e-6) / (p_total + 1e-6)
+            weights = weights / (capacity * prob_min) ** -self.alpha
+        else:
+            weights = weights / weights.max()
+
+        if np.isnan(weights).any():
+            print("Nan Found is sample!")
+            print(f"Prios {prios}")
+            print(f"Probs {probs}")
+            print(f"Weights {weights}")
+
+        weights = torch.tensor(weights, dtype=torch.float32, device=self.device)
+        rewards = torch.tensor(rewards, dtype=torch.float32, device=self.device)
+        dones = torch.tensor(dones, dtype=torch.bool, device=self.device)
+        actions = torch.tensor(actions, dtype=torch.int64, device=self.device)
+
+        return tree_idxs, states, actions, rewards, n_states, dones, weights
+
+    def update_priorities(self, idxs, priorities, added=None):
+        """ Update each shard's part of a batch under its lock. added is transitions_added when it was sampled. """
+        shards = idxs // self.stride
+        for shard in np.unique(shards):
+            mine = shards == shard
+            with self.locks[shard]:
+                self.shards[shard].update_priorities(idxs[mine] - shard * self.stride, priorities[mine],
+                                                     None if added is None else added[shard])
+
+        # new transitions in every shard start at the largest priority seen in any of them. Only the learner writes
+        # max_prio, so this needs no lock
+        max_prio = max(shard.max_prio for shard in self.shards)
+        for shard in self.shards:
+            shard.max_prio = max_prio
+
+    def save(self, path):
+        """ Snapshot every shard to a subdirectory of path, see PER.save. """
+        for shard, memory in enumerate(self.shards):
+            with self.locks[shard]:
+                memory.save(os.path.join(path, "shard" + str(shard)))
+
+    def wait_saved(self):
+        for memory in self.shards:
+            memory.wait_saved()
+
+    def load(self, path):
+        """ Restore a snapshot written by save, with the same number of shards and sizes. """
+        for shard, memory in enumerate(self.shards):
+            with self.locks[shard]:
+                memory.load(os.path.join(path, "shard" + str(shard)))
+
+class PrefetchSampler:
+    """
+    Samples batches from a PER on a background thread so the gather overlaps with the learner.
+
+    At most `depth` batches are sampled ahead of the one being learned from. Priority updates are applied
+    immediately and in order on the calling thread, so a batch never misses more than `depth` of them.
+    Transitions overwritten between sampling a batch and updating its priorities keep their new max priority.
+
+    Anything that touches the memory while the sampler is running (appends, other samples) must hold `lock`. A
+    ShardedPER locks its own shards, so it is given a nullcontext instead.
+    """
+    def __init__(self, memory, batch_size, depth=2, lock=None):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.depth = depth
+
+        self.lock = threading.Lock() if lock is None else lock
+        self.batches = queue.Queue()
+        self.credits = threading.Semaphore(depth)
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # transitions_added at the time each batch still waiting for its priorities was sampled
+        self.sampled_at = deque()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="PrefetchSampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                self.credits.acquire()
+                if self.stopped.is_set():
+                    return
+                with self.lock:
+                    added = self.memory.transitions_added
+                    batch = self.memory.sample(self.batch_size)
+                self.batches.put((added, batch))
+        except BaseException as e:
+            self.batches.put((None, e))
+
+    def sample(self):
+        if self.thread is None:
+            self.start()
+
+        added, batch = self.batches.get()
+        if added is None:
+            raise RuntimeError("PrefetchSampler thread failed") from batch
+        self.credits.release()
+
+        self.sampled_at.append(added)
+        return batch
+
+    def update_priorities(self, idxs, priorities):
+        """ Apply the priorities for the oldest batch returned by sample() that has not been updated yet. """
+        added = self.sampled_at.popleft()
+
+        with self.lock:
+            # skip slots that have been written to since the batch was sampled
+            self.memory.update_priorities(idxs, priorities, added)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.credits.release()
+        self.thread.join()
+        self.thread = None
+
 def create_experience(previous_state):
     state = previous_state[:]
     action = np.random.randint(0, 18)
@@ -401,7 +1275,8 @@ def create_experience(previous_state):
 if __name__ == "__main__":
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     framestack = 4
-    tree = PER(8, device, 3, 2, 0.99, alpha=0.2, beta=0.4, framestack=framestack, imagex=2, imagey=2)
+    tree = PER(8, device, 3, 2, 0.99, alpha=0.2, beta=0.4, framestack=framestack, imagex=2, imagey=2,
+               global_weight_norm=True)
 
     image_size = 2
     batch_size = 2
@@ -450,8 +1325,6 @@ if __name__ == "__main__":
 
         print("Maintree")
         print(tree.st.sum_tree)
-        print("min tree")
-        print(np.array(tree.priority_min))
 
         state, action, reward, state_, done = create_experience(s1)
 
@@ -462,8 +1335,6 @@ if __name__ == "__main__":
 
         print("Maintree")
         print(tree.st.sum_tree)
-        print("min tree")
-        print(np.array(tree.priority_min))
 
         if tree.capacity >= batch_size:
             for i in range(20):
@@ -0,0 +1,77 @@
+"""
+Actions per second from Agent.choose_action for a batch of uint8 observations, comparing
+- the previous path: a float32 copy of the observations on the host, then the eager network
+- uint8 observations straight to the network, eager
+- uint8 observations with Agent(compile_actions=True)
+- uint8 observations with Agent(fixed_taus=True), eager, averaging the quantiles at the cached fixed taus
+
+Compile time is excluded; the first call of each path is a warm-up.
+
+Usage: python bench_choose_action.py --envs 64 --steps 50 --device cpu
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch as T
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from Agent import Agent
+
+
+def float_copy_choose_action(agent: Agent, observation):
+    """ The start of choose_action as it was: host float copy, then the eager qvals. """
+    with T.no_grad():
+        if agent.noisy and not agent.eval_mode:
+            agent.reset_noise(agent.net)
+        state = T.tensor(observation, dtype=T.float).to(agent.net.device)
+        return T.argmax(agent.net.qvals(state, advantages_only=True), dim=1).cpu()
+
+
+def actions_per_second(act, observations, steps: int, device: str) -> float:
+    act(observations[0])
+    start = time.perf_counter()
+    for step in range(steps):
+        act(observations[step % len(observations)])
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return steps * observations.shape[1] / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--envs', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--model_size', type=float, default=2)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    observations = np.random.default_rng(0).integers(0, 255, (4, args.envs, 4, 84, 84), dtype=np.uint8)
+
+    results = {}
+    for name, compile_actions, fixed_taus in (("float copy, eager", False, False), ("uint8, eager", False, False),
+                                              ("uint8, compiled", True, False), ("uint8, fixed taus", False, True)):
+        torch.manual_seed(0)
+        agent = Agent(n_actions=5, input_dims=[4, 84, 84], device=args.device, num_envs=args.envs,
+                      agent_name="bench", total_frames=10 ** 7, testing=True, model_size=args.model_size,
+                      max_mem_size=1024, compile_actions=compile_actions,
+                      fixed_taus=fixed_taus)
+        # act greedily so every path runs the network and nothing else
+        agent.env_steps = agent.min_sampling_size = agent.total_frames
+
+        if name == "float copy, eager":
+            act = lambda observation: float_copy_choose_action(agent, observation)
+        else:
+            act = agent.choose_action
+
+        start = time.perf_counter()
+        act(observations[0])
+        warmup = time.perf_counter() - start
+        results[name] = actions_per_second(act, observations, args.steps, args.device)
+        print(f"{name:>18}: {results[name]:8.1f} actions/s at {args.envs} envs on {args.device} "
+              f"(first call {warmup:.1f} s, compiled: {agent.compiled_qvals is not None})")
+
+
+if __name__ == '__main__':
+    main()
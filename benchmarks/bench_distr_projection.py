@@ -0,0 +1,132 @@
+"""
+Latency of the C51 distr_projection against the previous atom by atom loop on the host (kept here as
+`loop_distr_projection` for reference), after asserting that both give the same projected distributions.
+
+On cpu the projections must be bit-identical, for random batches and for rows that are terminal, have their
+support clipped at Vmin / Vmax or land exactly on atoms. On cuda, where scatter_add_ may sum in another order, they
+must also agree to within float rounding.
+
+The loop path includes the copies to and from the host that the learner used to make around it.
+
+Usage: python bench_distr_projection.py --batch 256 --repeats 100 --device cuda
+"""
+import argparse
+import warnings
+
+import numpy as np
+import torch
+import torch as T
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+from Agent import distr_projection
+
+
+def loop_distr_projection(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma):
+    """ distr_projection as it was before being vectorised. """
+    batch_size = len(rewards)
+    proj_distr = T.zeros((batch_size, n_atoms), dtype=T.float32)
+    delta_z = (Vmax - Vmin) / (n_atoms - 1)
+    for atom in range(n_atoms):
+        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards + (Vmin + atom * delta_z) * gamma))
+        b_j = (tz_j - Vmin) / delta_z
+        l = np.floor(b_j).type(T.int64)
+        u = np.ceil(b_j).type(T.int64)
+        eq_mask = u == l
+        proj_distr[eq_mask, l[eq_mask]] += next_distr[eq_mask, atom]
+        ne_mask = u != l
+        proj_distr[ne_mask, l[ne_mask]] += next_distr[ne_mask, atom] * (u - b_j)[ne_mask]
+        proj_distr[ne_mask, u[ne_mask]] += next_distr[ne_mask, atom] * (b_j - l)[ne_mask]
+    if dones.any():
+        proj_distr[dones] = 0.0
+        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards[dones]))
+        b_j = (tz_j - Vmin) / delta_z
+        l = np.floor(b_j).type(T.int64)
+        u = np.ceil(b_j).type(T.int64)
+        eq_mask = u == l
+        eq_dones = T.clone(dones)
+        eq_dones[dones] = eq_mask
+        if eq_dones.any():
+            proj_distr[eq_dones, l[eq_mask]] = 1.0
+        ne_mask = u != l
+        ne_dones = T.clone(dones)
+        ne_dones[dones] = ne_mask
+        if ne_dones.any():
+            proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
+            proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
+    return proj_distr
+
+
+def random_batch(batch_size: int, n_atoms: int, device: str, seed: int):
+    """Softmaxed next distributions, n-step rewards with some landing exactly on atoms, and ~10% terminal rows."""
+    gen = torch.Generator().manual_seed(seed)
+    next_distr = torch.softmax(torch.randn((batch_size, n_atoms), generator=gen) * 2, dim=1)
+    rewards = torch.randn(batch_size, generator=gen) * 3
+    rewards[::7] = torch.randint(-12, 12, (rewards[::7].shape[0],), generator=gen).float()  # some clip at Vmin/Vmax
+    dones = torch.rand(batch_size, generator=gen) < 0.1
+    return next_distr.to(device), rewards.to(device), dones.to(device)
+
+
+def edge_batches(n_atoms: int, seed: int) -> dict:
+    """Batches whose rows are all terminal, clipped at Vmin / Vmax, or shifted by whole atoms."""
+    gen = torch.Generator().manual_seed(seed)
+    next_distr = torch.softmax(torch.randn((64, n_atoms), generator=gen) * 2, dim=1)
+    # 0.4 is the atom spacing of the default support, so these rewards move atoms onto atoms (up to float rounding)
+    on_atoms = torch.randint(-25, 26, (64,), generator=gen).float() * 0.4
+    clipped = torch.cat((torch.full((16,), -10.0), torch.full((16,), 10.0), torch.randn(32, generator=gen) * 4 + 14))
+    clipped[32:48] *= -1
+    mixed = torch.cat((on_atoms[:16], clipped[:16], clipped[16:32], torch.randn(16, generator=gen) * 3))
+    none_done = torch.zeros(64, dtype=torch.bool)
+    return {
+        "terminal": (next_distr, mixed, torch.ones(64, dtype=torch.bool)),
+        "clipped": (next_distr, clipped, none_done),
+        "on-atom": (next_distr, on_atoms, none_done),
+    }
+
+
+def check_against_loop(device: str, batch_size: int, Vmin: float, Vmax: float, n_atoms: int) -> None:
+    """Assert that distr_projection gives the loop's distributions on cpu, and on device if that is not cpu."""
+    cases = [(f"random batch {seed}", random_batch(batch_size, n_atoms, 'cpu', seed)) for seed in range(20)]
+    cases += list(edge_batches(n_atoms, 0).items())
+    for name, (next_distr, rewards, dones) in cases:
+        for gamma in (0.99 ** 3, 0.997 ** 3, 1.0, 0.5):
+            expected = loop_distr_projection(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma)
+            projected = distr_projection(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma)
+            assert torch.equal(projected, expected), f"{name} differs from the loop on cpu with gamma {gamma}"
+            if device != 'cpu':
+                projected = distr_projection(next_distr.to(device), rewards.to(device), dones.to(device), Vmin, Vmax,
+                                             n_atoms, gamma).cpu()
+                assert torch.allclose(projected, expected, atol=1e-6), \
+                    f"{name} differs from the loop on {device} with gamma {gamma}"
+    print(f"distr_projection matches the loop on {len(cases)} batches: random, terminal, clipped and on-atom rows")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    # the reference loop applies numpy ufuncs to tensors, as the learner did
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+    Vmin, Vmax, n_atoms = -10, 10, 51
+    check_against_loop(args.device, args.batch, Vmin, Vmax, n_atoms)
+
+    next_distr, rewards, dones = random_batch(args.batch, n_atoms, args.device, 0)
+    gamma = 0.99 ** 3
+
+    def loop():
+        proj = loop_distr_projection(next_distr.cpu(), rewards.cpu(), dones.cpu(), Vmin, Vmax, n_atoms, gamma)
+        return proj.to(args.device)
+
+    loop_ms = latency_ms(loop, args.repeats, args.device)
+    vectorised_ms = latency_ms(lambda: distr_projection(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma),
+                               args.repeats, args.device)
+    print(f"      loop on {args.device}: {loop_ms:.3f} ms per batch of {args.batch}")
+    print(f"vectorised on {args.device}: {vectorised_ms:.3f} ms per batch of {args.batch}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Learner throughput with and without Agent(mixed_precision=True), and how far the bfloat16 learner's Q-values drift
+from the fp32 learner's when both start from the same weights and see the same batches.
+
+Drift is measured on a fixed batch of states with both networks evaluated in fp32, so it reflects the training
+trajectory rather than the rounding of a single bfloat16 pass.
+
+Usage: python bench_mixed_precision.py --steps 200 --batch 256 --device cuda
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from Agent import Agent
+
+
+def filled_agent(args, mixed_precision: bool) -> Agent:
+    """An agent whose replay holds the same random transitions every time, ready to learn."""
+    torch.manual_seed(0)
+    np.random.seed(0)
+    agent = Agent(n_actions=5, input_dims=[4, 84, 84], device=args.device, num_envs=8, agent_name="bench",
+                  total_frames=10 ** 7, testing=True, batch_size=args.batch, model_size=args.model_size,
+                  max_mem_size=8192, mixed_precision=mixed_precision)
+    agent.min_sampling_size = 0
+
+    rng = np.random.default_rng(0)
+    states = rng.integers(0, 255, (8, 4, 84, 84), dtype=np.uint8)
+    for _ in range(args.fill // 8):
+        next_states = np.roll(states, -1, axis=1)
+        next_states[:, -1] = rng.integers(0, 255, (8, 84, 84), dtype=np.uint8)
+        agent.store_transitions_batch(states, rng.integers(0, 5, 8), rng.normal(size=8), next_states,
+                                      rng.random(8) < 0.01, np.zeros(8, dtype=bool))
+        states = next_states
+    return agent
+
+
+@torch.no_grad()
+def fp32_qvals(agent: Agent, states: torch.Tensor) -> torch.Tensor:
+    agent.net.mixed_precision = False
+    agent.net.tau_generator.manual_seed(1)  # same taus for both learners
+    qvals = agent.net.qvals(states)
+    agent.net.mixed_precision = agent.mixed_precision
+    return qvals
+
+
+def run(args, mixed_precision: bool, eval_states: torch.Tensor):
+    agent = filled_agent(args, mixed_precision)
+    torch.manual_seed(2)
+    np.random.seed(2)
+
+    qvals = []
+    elapsed = 0.0
+    for step in range(args.steps):
+        start = time.perf_counter()
+        agent.learn()
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+
+        if (step + 1) % args.eval_every == 0:
+            rng_state = torch.get_rng_state()
+            qvals.append(fp32_qvals(agent, eval_states))
+            torch.set_rng_state(rng_state)
+
+    return args.steps / elapsed, qvals
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--eval_every', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--model_size', type=float, default=2)
+    parser.add_argument('--fill', type=int, default=4096)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    eval_states = torch.from_numpy(np.random.default_rng(3).integers(0, 255, (64, 4, 84, 84), dtype=np.uint8))
+    eval_states = eval_states.to(args.device)
+
+    fp32_rate, fp32_qvals_log = run(args, False, eval_states)
+    bf16_rate, bf16_qvals_log = run(args, True, eval_states)
+    print(f"fp32: {fp32_rate:.2f} learn steps/s")
+    print(f"bf16: {bf16_rate:.2f} learn steps/s ({bf16_rate / fp32_rate:.2f}x)")
+
+    for i, (q32, q16) in enumerate(zip(fp32_qvals_log, bf16_qvals_log)):
+        drift = ((q16 - q32).abs().mean() / q32.abs().mean()).item()
+        agree = (q16.argmax(dim=1) == q32.argmax(dim=1)).float().mean().item()
+        print(f"step {(i + 1) * args.eval_every:>5}: relative Q drift {drift:.4f}, greedy action agreement {agree:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+Microbenchmark of NESEnv.step on a stub emulator: frames/sec with the legacy deepcopy RAM
+snapshot versus the double-buffered RAM mode.
+
+Usage: python benchmarks/bench_nes_step.py --frames 200000
+"""
+import argparse
+import time
+
+from stub_nes import make_stub_env_class
+
+
+def frames_per_second(env, frames: int) -> float:
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(frames):
+        env.step(0)
+    return frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=200000)
+    args = parser.parse_args()
+
+    StubEnv = make_stub_env_class()
+
+    legacy = frames_per_second(StubEnv(double_buffer_ram=False), args.frames)
+    buffered = frames_per_second(StubEnv(double_buffer_ram=True), args.frames)
+
+    print(f"deepcopy RAM:        {legacy:,.0f} frames/sec")
+    print(f"double-buffered RAM: {buffered:,.0f} frames/sec ({buffered / legacy:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Cost of resetting the noise of a noisy network with Agent.reset_noise (one NoiseManager draw into a flat buffer)
+against the previous walk over net.modules() with a reset per layer (kept here as `module_walk_reset_noise`), and
+the latency of a noisy learner forward pass with the factorised weight noise against the stored weight_epsilon matrix.
+
+Usage: python bench_noise_reset.py --batch 256 --repeats 200 --device cuda
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+import networks
+from Agent import Agent
+
+
+def module_walk_reset_noise(net):
+    """ Agent.reset_noise and FactorizedNoisyLinear.reset_noise as they were, storing the full weight_epsilon. """
+    with torch.no_grad():
+        for m in net.modules():
+            if isinstance(m, networks.FactorizedNoisyLinear):
+                epsilon_in = m._get_noise(m.in_features)
+                epsilon_out = m._get_noise(m.out_features)
+                m.weight_epsilon = epsilon_out.outer(epsilon_in)
+                m.bias_epsilon.copy_(epsilon_out)
+
+
+def stored_epsilon_forward(self, input):
+    """ FactorizedNoisyLinear.forward as it was. """
+    return F.linear(input, self.weight_mu + self.weight_sigma * self.weight_epsilon,
+                    self.bias_mu + self.bias_sigma * self.bias_epsilon)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--model_size', type=float, default=2)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    agent = Agent(n_actions=5, input_dims=[4, 84, 84], device=args.device, num_envs=8, agent_name="bench",
+                  total_frames=10 ** 7, testing=True, model_size=args.model_size, max_mem_size=1024)
+    net = agent.net
+    layers = [m for m in net.modules() if isinstance(m, networks.FactorizedNoisyLinear)]
+
+    manager_ms = latency_ms(lambda: agent.reset_noise(net), args.repeats, args.device)
+    walk_ms = latency_ms(lambda: module_walk_reset_noise(net), args.repeats, args.device)
+    print(f"{len(layers)} noisy layers, {net.noise_manager.noise.numel()} noise values")
+    print(f"   module walk reset: {walk_ms:.3f} ms")
+    print(f"NoiseManager reset: {manager_ms:.3f} ms")
+
+    # the same noise for both forward passes, so the outputs can be compared
+    agent.reset_noise(net)
+    for m in layers:
+        m.weight_epsilon = m.bias_epsilon.outer(m.epsilon_in)
+
+    inputs = [torch.randn(args.batch * net.num_tau, m.in_features, device=args.device) for m in layers]
+
+    def forward_all(forward):
+        return [forward(m, x) for m, x in zip(layers, inputs)]
+
+    with torch.no_grad():
+        diff = max((a - b).abs().max().item() for a, b in
+                   zip(forward_all(stored_epsilon_forward), forward_all(networks.FactorizedNoisyLinear.forward)))
+        print(f"max abs difference between the forward passes: {diff:.3g}")
+
+        for name, forward in (("stored weight_epsilon", stored_epsilon_forward),
+                              ("factorised", networks.FactorizedNoisyLinear.forward)):
+            ms = latency_ms(lambda: forward_all(forward), args.repeats, args.device)
+            print(f"{name:>21} forward of the noisy layers: {ms:.3f} ms for {inputs[0].shape[0]} rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Time to store one vector step (one transition per env) in PER: the previous list-based per-stream buffers
+(kept here as `ListBufferPER` for reference), the ring buffers through append, and append_batch.
+
+The three are timed in alternating rounds of --steps vector steps, and the median round is printed, so that a
+noisy machine affects them alike.
+
+Usage: python bench_per_append.py --envs 64 --steps 500 --rounds 7
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from PER import PER
+
+
+class ListBufferPER(PER):
+    """ PER.append as it was before the ring buffers: python lists per stream, sliding with pop(0). """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        envs = self.last_terminal.size
+        self.last_terminal = [True for _ in range(envs)]
+        self.state_buffer = [[] for _ in range(envs)]
+        self.reward_buffer = [[] for _ in range(envs)]
+
+    def append(self, state, action, reward, n_state, done, trun, stream, prio=True):
+        if self.last_terminal[stream]:
+            for i in range(self.framestack):
+                self.state_mem[self.state_mem_idx] = state[i]
+                self.state_buffer[stream].append(self.state_mem_idx)
+                self.state_mem_idx = (self.state_mem_idx + 1) % self.storage_size
+
+        self.state_mem[self.state_mem_idx] = n_state[self.framestack - 1]
+        self.state_buffer[stream].append(self.state_mem_idx)
+        self.state_mem_idx = (self.state_mem_idx + 1) % self.storage_size
+
+        self.action_mem[self.reward_mem_idx] = action
+        self.reward_mem[self.reward_mem_idx] = reward
+        self.done_mem[self.reward_mem_idx] = done
+        self.trun_mem[self.reward_mem_idx] = trun
+        self.reward_buffer[stream].append(self.reward_mem_idx)
+        self.reward_mem_idx = (self.reward_mem_idx + 1) % self.storage_size
+
+        states, rewards = self.state_buffer[stream], self.reward_buffer[stream]
+        while len(states) >= self.framestack + self.n_step and len(rewards) >= self.n_step:
+            self.add_pointers(states[:self.framestack], states[self.n_step:self.n_step + self.framestack],
+                              rewards[:self.n_step])
+            states.pop(0)
+            rewards.pop(0)
+            self.beta = 0
+
+        if done or trun:
+            while len(states) >= self.framestack and len(rewards) > 0:
+                self.add_pointers(states[:self.framestack], states[-self.framestack:],
+                                  rewards + [0] * (self.n_step - len(rewards)))
+                states.pop(0)
+                rewards.pop(0)
+            self.state_buffer[stream] = []
+            self.reward_buffer[stream] = []
+
+        self.last_terminal[stream] = done or trun
+
+    def add_pointers(self, state_array, n_state_array, reward_array):
+        self.state_pointer_mem[self.point_mem_idx] = state_array
+        self.n_state_pointer_mem[self.point_mem_idx] = n_state_array
+        self.reward_pointer_mem[self.point_mem_idx] = reward_array
+        self.st.append(self.max_prio ** self.alpha)
+        self.point_mem_idx = (self.point_mem_idx + 1) % self.size
+        self.capacity = min(self.size, self.capacity + 1)
+        self.transitions_added += 1
+
+
+def store(memory: PER, envs: int, steps: int, batched: bool) -> float:
+    """Store `steps` vector steps of random 84x84 frames, returning the mean milliseconds per vector step."""
+    rng = np.random.default_rng(0)
+    states = rng.integers(0, 255, (envs, 4, 84, 84), dtype=np.uint8)
+    next_states = np.roll(states, -1, axis=1)
+    actions = rng.integers(0, 5, (steps, envs))
+    rewards = rng.normal(size=(steps, envs))
+    dones = rng.random((steps, envs)) < 0.002
+    truns = np.zeros((steps, envs), dtype=bool)
+
+    start = time.perf_counter()
+    for t in range(steps):
+        if batched:
+            memory.append_batch(states, actions[t], rewards[t], next_states, dones[t], truns[t])
+        else:
+            for stream in range(envs):
+                memory.append(states[stream], actions[t, stream], rewards[t, stream], next_states[stream],
+                              dones[t, stream], truns[t, stream], stream)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--envs', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--capacity', type=int, default=2 ** 17)
+    args = parser.parse_args()
+
+    configs = (("lists + append", ListBufferPER, False), ("rings + append", PER, False),
+               ("rings + append_batch", PER, True))
+    memories = {name: memory_cls(args.capacity, 'cpu', 3, args.envs, 0.99) for name, memory_cls, _ in configs}
+    rounds = {name: [] for name, _, _ in configs}
+    for _ in range(args.rounds):
+        for name, _, batched in configs:
+            rounds[name].append(store(memories[name], args.envs, args.steps, batched))
+
+    for name, _, _ in configs:
+        print(f"{name:>20}: {statistics.median(rounds[name]):.3f} ms per vector step of {args.envs} envs "
+              f"(median of {args.rounds} rounds, fastest {min(rounds[name]):.3f} ms)")
+
+    reference = memories["lists + append"]
+    for name, memory in memories.items():
+        same = all(np.array_equal(getattr(reference, mem), getattr(memory, mem)) for mem in
+                   ("state_pointer_mem", "n_state_pointer_mem", "reward_pointer_mem", "state_mem"))
+        print(f"{name:>20}: identical pointers and frames: {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Compression ratio of PER(compress_frames=...) and the change in PER.sample() latency against raw frames in RAM, for
+every codec that is installed (zlib always is, lz4 and zstd are optional).
+
+Pass recorded frames with --frames: a (N, 84, 84) uint8 .npy of consecutive frames from a run, such as the newest
+frame of every observation of one env. Without it, Tetris-like frames are generated instead: a static playfield
+with pieces falling one row every few frames, and stretches of an unchanging title screen, so the ratio they give is
+only an indication.
+
+Usage: python bench_per_compression.py --frames tetris_frames.npy --capacity 65536 --batch 256
+"""
+import argparse
+import importlib.util
+import time
+
+import numpy as np
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+from PER import PER
+
+
+def tetris_like_frames(count: int, seed: int = 0) -> np.ndarray:
+    """A playfield with pieces falling into it and a title screen shown between games."""
+    rng = np.random.default_rng(seed)
+    title = rng.integers(0, 255, (84, 84), dtype=np.uint8)
+    board = np.zeros((84, 84), dtype=np.uint8)
+    board[:, 20:22] = board[:, 62:64] = 180
+    board[82:] = 180
+
+    frames = np.empty((count, 84, 84), dtype=np.uint8)
+    stack = board.copy()
+    piece_x, piece_y, shade = 30, 0, 120
+    for i in range(count):
+        if i % 2000 < 150:
+            frames[i] = title
+            continue
+        if i % 4 == 0:
+            piece_y += 2
+        if piece_y >= 76 or stack[piece_y + 6, piece_x:piece_x + 8].any():
+            stack[piece_y:piece_y + 6, piece_x:piece_x + 8] = shade
+            if stack[10:82, 22:62].all(axis=1).any() or piece_y < 8:
+                stack = board.copy()
+            piece_x, piece_y, shade = int(rng.integers(22, 54)), 0, int(rng.integers(60, 250))
+        frame = stack.copy()
+        frame[piece_y:piece_y + 6, piece_x:piece_x + 8] = shade
+        frames[i] = frame
+    return frames
+
+
+def filled_memory(frames: np.ndarray, capacity: int, envs: int, compress_frames) -> PER:
+    """A PER filled from envs streams, each playing its own slice of the recorded frames."""
+    memory = PER(capacity, 'cpu', 3, envs, 0.99, compress_frames=compress_frames)
+    rng = np.random.default_rng(0)
+    per_env = len(frames) // envs
+    starts = np.arange(envs) * per_env
+    states = np.stack([frames[s:s + 4] for s in starts])
+    for t in range(min(capacity // envs, per_env - 5)):
+        n_states = np.stack([frames[s + t + 1:s + t + 5] for s in starts])
+        memory.append_batch(states, rng.integers(0, 5, envs), rng.normal(size=envs), n_states,
+                            rng.random(envs) < 0.001, np.zeros(envs, dtype=bool))
+        states = n_states
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=str, default=None)
+    parser.add_argument('--capacity', type=int, default=2 ** 15)
+    parser.add_argument('--envs', type=int, default=16)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.frames is not None:
+        frames = np.load(args.frames)
+    else:
+        frames = tetris_like_frames(args.capacity * 5 // 4 + 8 * args.envs)
+    print(f"{len(frames)} frames from {args.frames or 'the Tetris-like generator'}")
+
+    codecs = [None, "zlib"]
+    for codec, package in (("lz4", "lz4"), ("zstd", "zstandard")):
+        if importlib.util.find_spec(package) is not None:
+            codecs.append(codec)
+
+    batches = {}
+    raw_ms = None
+    for codec in codecs:
+        start = time.perf_counter()
+        memory = filled_memory(frames, args.capacity, args.envs, codec)
+        fill_s = time.perf_counter() - start
+
+        np.random.seed(0)
+        sample_ms = latency_ms(lambda: memory.sample(args.batch), args.repeats)
+        name = codec or "raw"
+        if codec is None:
+            raw_ms = sample_ms
+            print(f"{name:>5}: sample({args.batch}) {sample_ms:.2f} ms, filled in {fill_s:.1f} s")
+        else:
+            store = memory.state_mem
+            print(f"{name:>5}: sample({args.batch}) {sample_ms:.2f} ms ({sample_ms - raw_ms:+.2f} ms), "
+                  f"filled in {fill_s:.1f} s, compression ratio {store.compression_ratio():.1f}x, "
+                  f"{len(store.blobs)} distinct of {store.frames_held} frames")
+
+        np.random.seed(1)
+        batches[name] = [x.cpu() if isinstance(x, torch.Tensor) else x for x in memory.sample(args.batch)]
+
+    for name, batch in batches.items():
+        same = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(batches["raw"], batch))
+        print(f"{name:>5}: identical batch: {same}")
+
+
+if __name__ == '__main__':
+    main()
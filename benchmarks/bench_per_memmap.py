@@ -0,0 +1,58 @@
+"""
+Latency of PER.sample() with the frame memory in RAM, in np.memmap files (PER(memmap_dir=...)), and in memmap files
+with the newest frames kept in a RAM hot cache (hot_frames), plus a check that all three sample the same batches.
+
+The memmap files go in a temporary directory unless --dir is given; put it on the disk you want to measure. Pages the
+OS still caches make the memmap look faster than it would be at a size that does not fit in RAM.
+
+Usage: python bench_per_memmap.py --capacity 65536 --batch 256 --hot_frames 16384 --dir D:/replay
+"""
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import fill_memory, latency_ms, vector_steps
+from PER import PER
+
+
+def filled_memory(args, memmap_dir, hot_frames: int) -> PER:
+    """A PER filled from 16 streams of random 84x84 frames."""
+    memory = PER(args.capacity, args.device, 3, 16, 0.99, memmap_dir=memmap_dir, hot_frames=hot_frames)
+    fill_memory(memory, args.capacity // 16, vector_steps(16))
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=2 ** 16)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--hot_frames', type=int, default=2 ** 14)
+    parser.add_argument('--dir', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        batches = {}
+        for name, memmap_dir, hot_frames in (("ram", None, 0), ("memmap", tmp + "/cold", 0),
+                                             ("memmap + hot", tmp + "/hot", args.hot_frames)):
+            memory = filled_memory(args, memmap_dir, hot_frames)
+            np.random.seed(0)
+            sample = latency_ms(lambda: memory.sample(args.batch), args.repeats, args.device)
+            print(f"{name:>12} on {args.device}: sample({args.batch}) {sample:.3f} ms")
+
+            np.random.seed(1)
+            batches[name] = [x.cpu() if isinstance(x, torch.Tensor) else x for x in memory.sample(args.batch)]
+            del memory
+
+    reference = batches["ram"]
+    for name, batch in batches.items():
+        same = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(reference, batch))
+        print(f"{name:>12}: identical batch: {same}")
+
+
+if __name__ == '__main__':
+    main()
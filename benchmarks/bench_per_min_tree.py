@@ -0,0 +1,55 @@
+"""
+What the min-tree of PER(global_weight_norm=True) costs on the hot paths (append_batch, sample and
+update_priorities) against the default batch-max normalisation, and a check that the tree's minimum matches a scan
+of the leaves, which is what the old list-based _set_priority_min kept up one element at a time.
+
+Usage: python bench_per_min_tree.py --capacity 1048576 --envs 64 --batch 256
+"""
+import argparse
+
+import numpy as np
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import fill_memory, latency_ms, vector_steps
+from PER import PER
+
+
+def filled_memory(args, global_weight_norm: bool) -> PER:
+    """A PER filled with 8x8 frames, so the sum tree dominates the timings rather than the frame gather."""
+    memory = PER(args.capacity, 'cpu', 3, args.envs, 0.99, imagex=8, imagey=8, global_weight_norm=global_weight_norm)
+    fill_memory(memory, args.capacity // args.envs, vector_steps(args.envs, (8, 8)))
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=2 ** 18)
+    parser.add_argument('--envs', type=int, default=64)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    states = rng.integers(0, 255, (args.envs, 4, 8, 8), dtype=np.uint8)
+    step = (states, np.zeros(args.envs, dtype=int), np.zeros(args.envs), states, np.zeros(args.envs, dtype=bool),
+            np.zeros(args.envs, dtype=bool))
+
+    for name, global_weight_norm in (("batch max", False), ("global max", True)):
+        memory = filled_memory(args, global_weight_norm)
+        np.random.seed(0)
+        idxs = memory.sample(args.batch)[0]
+        priorities = rng.random(args.batch) * 5
+
+        append = latency_ms(lambda: memory.append_batch(*step), args.repeats)
+        sample = latency_ms(lambda: memory.sample(args.batch), args.repeats)
+        update = latency_ms(lambda: memory.update_priorities(idxs, priorities), args.repeats)
+        print(f"{name:>10}: append_batch({args.envs}) {append:.3f} ms, sample({args.batch}) {sample:.3f} ms, "
+              f"update_priorities({args.batch}) {update:.3f} ms")
+
+        if global_weight_norm:
+            leaves = memory.st.sum_tree[memory.st.tree_start:memory.st.tree_start + memory.capacity]
+            print(f"tree minimum matches the leaves: {memory.st.min() == leaves.min()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Throughput of actor threads appending to the replay memory while a learner thread samples from it and updates
+priorities, with one PER behind a single lock (as Agent does with prefetch) against a ShardedPER with one shard per
+actor, plus a check that a ShardedPER with a single shard samples the same batches as PER. Each memory's sample,
+update_priorities and append_batch latencies with no other thread running are printed first, which is what sharding
+itself costs.
+
+numpy releases the GIL for the larger copies only, so the gain depends on the machine's core count. On a single core
+the actors, no longer held back by the learner's lock, take CPU time the learner used to get.
+
+Usage: python bench_per_sharded.py --capacity 262144 --actors 4 --envs 64 --batch 256 --seconds 10
+"""
+import argparse
+import threading
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import fill_memory, latency_ms, vector_steps
+from PER import PER, ShardedPER
+
+
+def actor(memory, lock, shard, envs: int, stop: threading.Event, steps: list):
+    """Append a vector step of random frames for envs streams until stop is set."""
+    step_iter = vector_steps(envs, seed=shard)
+    while not stop.is_set():
+        args = next(step_iter)
+        with lock:
+            if shard is None:
+                memory.append_batch(*args)
+            else:
+                memory.append_batch(*args, shard=shard)
+        steps[0] += envs
+
+
+def learner(memory, lock, batch: int, stop: threading.Event, steps: list):
+    rng = np.random.default_rng(100)
+    while not stop.is_set():
+        with lock:
+            idxs = memory.sample(batch)[0]
+        with lock:
+            memory.update_priorities(idxs, rng.random(batch))
+        steps[0] += 1
+
+
+def run(memory, lock, sharded: bool, args) -> tuple:
+    """Transitions appended and batches learned per second."""
+    stop = threading.Event()
+    appended = [[0] for _ in range(args.actors)]
+    learned = [0]
+    envs = args.envs // args.actors
+    threads = [threading.Thread(target=actor, args=(memory, lock, i if sharded else None, envs, stop, appended[i]))
+               for i in range(args.actors)]
+    threads.append(threading.Thread(target=learner, args=(memory, lock, args.batch, stop, learned)))
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(a[0] for a in appended) / args.seconds, learned[0] / args.seconds
+
+
+def alone(name: str, memory, envs: int, args):
+    """sample, update_priorities and append_batch latencies with no other thread running."""
+    rng = np.random.default_rng(200)
+    idxs = memory.sample(args.batch)[0]
+    states = rng.integers(0, 255, (envs, 4, 84, 84), dtype=np.uint8)
+    step = (states, np.zeros(envs, dtype=int), np.zeros(envs), states, np.zeros(envs, dtype=bool),
+            np.zeros(envs, dtype=bool))
+    sample = latency_ms(lambda: memory.sample(args.batch), 50)
+    update = latency_ms(lambda: memory.update_priorities(idxs, rng.random(args.batch)), 50)
+    append = latency_ms(lambda: memory.append_batch(*step), 50)
+    print(f"{name}, alone: sample({args.batch}) {sample:.2f} ms, update_priorities {update:.2f} ms, "
+          f"append_batch({envs}) {append:.2f} ms")
+
+
+def filled(memory, envs: int, steps: int):
+    fill_memory(memory, steps, vector_steps(envs))
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=2 ** 16)
+    parser.add_argument('--actors', type=int, default=4)
+    parser.add_argument('--envs', type=int, default=64)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+    per_actor = args.envs // args.actors
+    warmup = args.capacity // (4 * args.envs)
+
+    # PER only appends every stream at once, so here all actors take turns with the same per_actor streams. Their
+    # frames end up interleaved, which costs the same as keeping them apart
+    memory = filled(PER(args.capacity, 'cpu', 3, per_actor, 0.99), per_actor, warmup * args.actors)
+    alone("   PER, one lock", memory, per_actor, args)
+    appends, batches = run(memory, threading.Lock(), False, args)
+    print(f"   PER, one lock: {appends:.0f} transitions/s appended, {batches:.1f} batches/s learned")
+    del memory
+
+    memory = filled(ShardedPER(args.actors, args.capacity, 'cpu', 3, per_actor * args.actors, 0.99),
+                    per_actor * args.actors, warmup)
+    alone(f"ShardedPER ({args.actors})", memory, per_actor * args.actors, args)
+    appends, batches = run(memory, nullcontext(), True, args)
+    print(f"ShardedPER ({args.actors}): {appends:.0f} transitions/s appended, {batches:.1f} batches/s learned")
+    del memory
+
+    single = filled(PER(2 ** 12, 'cpu', 3, 8, 0.99), 8, 200)
+    sharded = filled(ShardedPER(1, 2 ** 12, 'cpu', 3, 8, 0.99), 8, 200)
+    np.random.seed(0)
+    batch = single.sample(64)
+    np.random.seed(0)
+    sharded_batch = sharded.sample(64)
+    same = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(batch, sharded_batch))
+    print(f"one shard samples the same batch as PER: {same}")
+
+
+if __name__ == '__main__':
+    main()
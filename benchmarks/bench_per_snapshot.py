@@ -0,0 +1,73 @@
+"""
+How long PER.save blocks the caller: the first (full) snapshot, then incremental snapshots taken every --every vector
+steps, along with how long their background writes take. Finishes with a load, a check that the restored memory
+samples the same batch, and a check that the first transitions stored after the load, from freshly reset envs, hold
+no frame of the episodes that were running when the snapshot was taken.
+
+Usage: python bench_per_snapshot.py --capacity 131072 --envs 64 --every 2000 --dir D:/snapshots
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import fill_memory, vector_steps
+from PER import PER
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=2 ** 17)
+    parser.add_argument('--envs', type=int, default=64)
+    parser.add_argument('--every', type=int, default=2000)
+    parser.add_argument('--snapshots', type=int, default=3)
+    parser.add_argument('--dir', type=str, default=None)
+    args = parser.parse_args()
+
+    memory = PER(args.capacity, 'cpu', 3, args.envs, 0.99)
+    steps = vector_steps(args.envs)
+    step = fill_memory(memory, args.capacity // args.envs, steps)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        start = time.perf_counter()
+        memory.save(tmp)
+        blocked = time.perf_counter() - start
+        memory.wait_saved()
+        print(f"full snapshot of {memory.capacity} transitions: blocked {blocked * 1000:.1f} ms, "
+              f"written in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        for _ in range(args.snapshots):
+            step = fill_memory(memory, args.every, steps)
+            start = time.perf_counter()
+            memory.save(tmp)
+            blocked = time.perf_counter() - start
+            memory.wait_saved()
+            print(f"incremental snapshot after {args.every * args.envs} transitions: blocked {blocked * 1000:.1f} ms, "
+                  f"written in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        restored = PER(args.capacity, 'cpu', 3, args.envs, 0.99)
+        start = time.perf_counter()
+        restored.load(tmp)
+        print(f"load: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    np.random.seed(0)
+    batch = memory.sample(256)
+    np.random.seed(0)
+    restored_batch = restored.sample(256)
+    same = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(batch, restored_batch))
+    print(f"restored memory samples the same batch: {same}")
+
+    # the snapshot was taken mid-episode, so the streams still held frames and rewards of the running episodes
+    old_frames = {frame.tobytes() for frame in step[3].reshape(-1, 84, 84)}
+    before = restored.transitions_added
+    fill_memory(restored, restored.n_step, vector_steps(args.envs, seed=2))
+    slots = np.arange(before, restored.transitions_added) % restored.size
+    pointers = np.concatenate((restored.state_pointer_mem[slots], restored.n_state_pointer_mem[slots]), axis=1)
+    crossed = any(restored.state_mem[p].tobytes() in old_frames for p in pointers.reshape(-1))
+    print(f"{slots.size} transitions after the load, any holding a frame from before it: {crossed}")
+
+
+if __name__ == '__main__':
+    main()
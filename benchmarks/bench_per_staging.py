@@ -0,0 +1,63 @@
+"""
+Latency of PER.sample() with uint8 staging (the default) against the previous float32 conversion on the host,
+plus the number of bytes each one moves to the device per batch.
+
+On cuda the uint8 path gathers into pinned buffers and copies with non_blocking=True; on cpu there is nothing to
+pin, so the difference there is only the float conversion that no longer happens on the host.
+
+Usage: python bench_per_staging.py --capacity 16384 --batch 256 --repeats 100 --device cuda
+"""
+import argparse
+
+import numpy as np
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+from PER import PER
+
+
+def filled_memory(capacity: int, device: str, uint8_states: bool) -> PER:
+    """A PER filled from a single stream of random 84x84 frames."""
+    memory = PER(capacity, device, 3, 1, 0.99, uint8_states=uint8_states)
+    rng = np.random.default_rng(0)
+    state = rng.integers(0, 255, (4, 84, 84), dtype=np.uint8)
+    for step in range(capacity):
+        n_state = np.roll(state, -1, axis=0)
+        n_state[-1] = rng.integers(0, 255, (84, 84), dtype=np.uint8)
+        memory.append(state, step % 5, 1.0, n_state, step % 1000 == 999, False, 0)
+        state = n_state
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=2 ** 14)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    results = {}
+    for name, uint8_states in (("float32", False), ("uint8", True)):
+        memory = filled_memory(args.capacity, args.device, uint8_states)
+
+        def sample_and_use():
+            # touch the states as the learner would, so the timing includes waiting on the copy
+            states, n_states = memory.sample(args.batch)[1::4]
+            return states.float().sum() + n_states.float().sum()
+
+        np.random.seed(0)
+        batch = memory.sample(args.batch)
+        moved = batch[1].nbytes + batch[4].nbytes
+        sample = latency_ms(sample_and_use, args.repeats, args.device)
+        print(f"{name:>7} on {args.device}: sample({args.batch}) {sample:.3f} ms, "
+              f"{moved / 2 ** 20:.1f} MiB of frames per batch, pinned staging: {memory.pin_staging}")
+        results[name] = (batch[1].cpu().float(), batch[4].cpu().float())
+
+    same = all(torch.equal(a, b) for a, b in zip(results["float32"], results["uint8"]))
+    print(f"identical frames: {same}")
+
+
+if __name__ == '__main__':
+    main()
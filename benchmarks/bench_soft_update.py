@@ -0,0 +1,56 @@
+"""
+Latency of Agent.soft_update (one torch._foreach_lerp_ over the parameters paired by name) against the previous
+per-parameter loop building tau*local + (1-tau)*target (kept here as `loop_soft_update`), for the spectral-normed
+Impala IQN network, and a check that both leave the target network with the same weights.
+
+Usage: python bench_soft_update.py --model_size 2 --repeats 200 --device cuda
+"""
+import argparse
+
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+from Agent import Agent
+
+
+def loop_soft_update(agent: Agent):
+    """ Agent.soft_update as it was. """
+    with torch.no_grad():
+        for target_param, local_param in zip(agent.tgt_net.parameters(), agent.net.parameters()):
+            target_param.data.copy_(
+                agent.soft_update_tau * local_param.data + (1.0 - agent.soft_update_tau) * target_param.data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_size', type=float, default=2)
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    agents = []
+    for _ in range(2):
+        torch.manual_seed(0)
+        agent = Agent(n_actions=5, input_dims=[4, 84, 84], device=args.device, num_envs=8, agent_name="bench",
+                      total_frames=10 ** 7, testing=True, model_size=args.model_size, max_mem_size=1024, ema=True,
+                      ema_tau=0.01)
+        agents.append(agent)
+    loop_agent, ema_agent = agents
+
+    params = sum(p.numel() for p in ema_agent.net.parameters())
+    tensors = len(list(ema_agent.net.parameters()))
+    print(f"{tensors} parameter tensors, {params / 1e6:.2f}M parameters")
+
+    loop_ms = latency_ms(lambda: loop_soft_update(loop_agent), args.repeats, args.device)
+    ema_ms = latency_ms(ema_agent.soft_update, args.repeats, args.device)
+    print(f"   per-parameter loop on {args.device}: {loop_ms:.3f} ms per soft update")
+    print(f"   _foreach_lerp_ EMA on {args.device}: {ema_ms:.3f} ms per soft update")
+
+    diff = max((a - b).abs().max().item() for a, b in
+               zip(loop_agent.tgt_net.state_dict().values(), ema_agent.tgt_net.state_dict().values()))
+    print(f"max abs difference between the target networks after {args.repeats + 1} updates: {diff:.3g}")
+
+
+if __name__ == '__main__':
+    main()
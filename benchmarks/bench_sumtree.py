@@ -0,0 +1,96 @@
+"""
+Latency of PER.sample(256) and PER.update_priorities(256) at 2^20 capacity, with the iterative SumTree
+against the previous recursive retrieval/propagation (kept here as `RecursiveSumTree` for reference).
+
+Frames are 1x1 so the buffer fits in memory, which leaves the timings dominated by the tree.
+
+Usage: python benchmarks/bench_sumtree.py --capacity 1048576 --batch 256 --repeats 200
+"""
+import argparse
+
+import numpy as np
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+from PER import PER, SumTree
+
+
+class RecursiveSumTree(SumTree):
+  """ The SumTree search and propagation as they were before being made iterative. """
+  def _update_nodes(self, indices):
+    children_indices = indices * 2 + np.expand_dims([1, 2], axis=1)
+    self.sum_tree[indices] = np.sum(self.sum_tree[children_indices], axis=0)
+
+  def _propagate(self, indices):
+    parents = (indices - 1) // 2
+    unique_parents = np.unique(parents)
+    self._update_nodes(unique_parents)
+    if parents[0] != 0:
+      self._propagate(parents)
+
+  def _retrieve(self, indices, values):
+    children_indices = (indices * 2 + np.expand_dims([1, 2], axis=1))
+    if children_indices[0, 0] >= self.sum_tree.shape[0]:
+      return indices
+    elif children_indices[0, 0] >= self.tree_start:
+      children_indices = np.minimum(children_indices, self.sum_tree.shape[0] - 1)
+    left_children_values = self.sum_tree[children_indices[0]]
+    successor_choices = np.greater(values, left_children_values).astype(np.int32)
+    successor_indices = children_indices[successor_choices, np.arange(indices.size)]
+    successor_values = values - successor_choices * left_children_values
+    return self._retrieve(successor_indices, successor_values)
+
+  def find(self, values):
+    indices = self._retrieve(np.zeros(values.shape, dtype=np.int32), values)
+    data_index = indices - self.tree_start
+    return (self.sum_tree[indices], data_index, indices)
+
+
+def filled_memory(capacity: int, tree_cls) -> PER:
+    """A PER whose every slot holds a transition with a random priority."""
+    memory = PER(capacity, 'cpu', 3, 1, 0.99, imagex=1, imagey=1)
+    tree = tree_cls(capacity)
+    leaves = np.random.default_rng(0).random(capacity).astype(np.float32)
+    tree.sum_tree[tree.tree_start:] = leaves
+
+    # Build the internal levels bottom up
+    level_start = tree.tree_start
+    while level_start > 0:
+        parent_start = (level_start - 1) // 2
+        parents = np.arange(parent_start, level_start)
+        tree._update_nodes(parents)
+        level_start = parent_start
+
+    memory.st = tree
+    memory.capacity = capacity
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, default=2 ** 20)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    results = {}
+    for name, tree_cls in (("recursive", RecursiveSumTree), ("iterative", SumTree)):
+        memory = filled_memory(args.capacity, tree_cls)
+        np.random.seed(0)
+        idxs = memory.sample(args.batch)[0]
+        priorities = np.random.default_rng(1).random(args.batch)
+
+        values = np.random.uniform(0, memory.st.total(), args.batch)
+        find = latency_ms(lambda: memory.st.find(values), args.repeats)
+        sample = latency_ms(lambda: memory.sample(args.batch), args.repeats)
+        update = latency_ms(lambda: memory.update_priorities(idxs, priorities), args.repeats)
+        print(f"{name:>9}: find({args.batch}) {find:.3f} ms, sample({args.batch}) {sample:.3f} ms, update_priorities({args.batch}) {update:.3f} ms")
+        results[name] = (idxs, memory.st.sum_tree.copy())
+
+    same_idxs = np.array_equal(results["recursive"][0], results["iterative"][0])
+    same_tree = np.array_equal(results["recursive"][1], results["iterative"][1])
+    print(f"identical sampled indices: {same_idxs}, identical trees after updates: {same_tree}")
+
+
+if __name__ == '__main__':
+    main()
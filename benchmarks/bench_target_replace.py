@@ -0,0 +1,52 @@
+"""
+Latency of Agent.replace_target_network (an in-place copy of the paired parameters and buffers) against the previous
+tgt_net.load_state_dict(net.state_dict()) round trip, for the spectral-normed Impala IQN network, and a check that
+both leave the target network with the same state.
+
+Usage: python bench_target_replace.py --model_size 2 --repeats 200 --device cuda
+"""
+import argparse
+
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+from bench_utils import latency_ms
+from Agent import Agent
+
+
+def state_dict_replace(agent: Agent):
+    """ Agent.replace_target_network as it was. """
+    agent.tgt_net.load_state_dict(agent.net.state_dict())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_size', type=float, default=2)
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    agent = Agent(n_actions=5, input_dims=[4, 84, 84], device=args.device, num_envs=8, agent_name="bench",
+                  total_frames=10 ** 7, testing=True, model_size=args.model_size, max_mem_size=1024)
+    print(f"{len(agent.net.state_dict())} tensors in the state dict")
+
+    state_dict_ms = latency_ms(lambda: state_dict_replace(agent), args.repeats, args.device)
+    copy_ms = latency_ms(agent.replace_target_network, args.repeats, args.device)
+    print(f"load_state_dict(state_dict()) on {args.device}: {state_dict_ms:.3f} ms per replace")
+    print(f"           in-place tensor copy on {args.device}: {copy_ms:.3f} ms per replace")
+
+    # move both networks apart, then replace the target each way from the same online state
+    agent.reset_noise(agent.net)
+    with torch.no_grad():
+        for param in agent.net.parameters():
+            param.add_(torch.randn_like(param))
+    agent.replace_target_network()
+    copied = {k: v.clone() for k, v in agent.tgt_net.state_dict().items()}
+    state_dict_replace(agent)
+    same = all(torch.equal(copied[k], v) for k, v in agent.tgt_net.state_dict().items())
+    print(f"identical target state: {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Helpers shared by the benchmarks: timing a call, and filling a replay memory with vector steps of random frames.
+"""
+import time
+
+import numpy as np
+import torch
+
+import stub_nes  # noqa: F401  (puts the repo root on sys.path)
+
+
+def latency_ms(fn, repeats: int, device: str = 'cpu') -> float:
+    """Mean milliseconds per call of fn over repeats calls after a warm-up call, synchronising cuda around them."""
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def vector_steps(envs: int, frame_shape: tuple = (84, 84), seed=0, done_prob: float = 0.001):
+    """
+    Endless vector steps (states, actions, rewards, n_states, dones, truns) for envs streams of random frames, in
+    the form PER.append_batch takes. Each step's n_states are its states shifted on by one new frame, and are the
+    next step's states.
+    """
+    rng = np.random.default_rng(seed)
+    states = rng.integers(0, 255, (envs, 4) + frame_shape, dtype=np.uint8)
+    while True:
+        n_states = np.roll(states, -1, axis=1)
+        n_states[:, -1] = rng.integers(0, 255, (envs,) + frame_shape, dtype=np.uint8)
+        yield (states, rng.integers(0, 5, envs), rng.normal(size=envs), n_states, rng.random(envs) < done_prob,
+               np.zeros(envs, dtype=bool))
+        states = n_states
+
+
+def fill_memory(memory, steps: int, vector_step_iter) -> tuple:
+    """Append the next steps vector steps of vector_step_iter to memory, returning the last one."""
+    step = None
+    for _ in range(steps):
+        step = next(vector_step_iter)
+        memory.append_batch(*step)
+    return step
@@ -0,0 +1,114 @@
+"""
+Steps/sec of the NES vector envs built by `make_env`: the AsyncVectorEnv of wrapped envs versus the
+shared-memory worker pool (and the in-process batch env), at 8, 32 and 64 envs.
+
+With --check, the batch and shared-memory envs are first stepped alongside a SyncVectorEnv of the wrapped envs
+(FrameStackObservation over ObsPreprocessing, on both its native and legacy frame skip) with a short time limit,
+asserting that observations, rewards, dones and the final observations of finished episodes match at every step.
+
+Usage: python benchmarks/bench_vector_env.py --game SuperMarioBros --steps 500
+       python benchmarks/bench_vector_env.py --stub --check   # stub emulator, measures transport overhead only
+"""
+import argparse
+import time
+
+import numpy as np
+
+from stub_nes import install_stub_emulator
+
+
+def steps_per_second(env, steps: int) -> float:
+    env.reset(seed=0)
+    actions = np.random.randint(0, env.single_action_space.n, (steps, env.num_envs))
+    for i in range(min(steps, 10)):  # warm up the workers
+        env.step(actions[i])
+
+    start = time.perf_counter()
+    for i in range(steps):
+        env.step_async(actions[i])
+        env.step_wait()
+    return steps / (time.perf_counter() - start)
+
+
+def check_matches_wrappers(game: str, mode: str, context: str, num_envs: int = 3, steps: int = 60,
+                           max_episode_steps: int = 48) -> None:
+    """Step a NES vector env and the wrapped envs it replaces with the same actions, asserting identical results."""
+    import gymnasium as gym
+    from gymnasium.vector import AutoresetMode
+    from nes_gym.vector import NESBatchEnv, NESSharedMemoryEnv
+    from ObsPreprocessing import ObsPreprocessing
+
+    for native_frame_skip in (True, False):
+        def create_env():
+            env = gym.make(f'NES/{game}-v1', max_episode_steps=max_episode_steps)
+            return gym.wrappers.FrameStackObservation(ObsPreprocessing(env, native_frame_skip=native_frame_skip), 4)
+
+        reference = gym.vector.SyncVectorEnv([create_env for _ in range(num_envs)],
+                                             autoreset_mode=AutoresetMode.SAME_STEP)
+        if mode == "batch":
+            env = NESBatchEnv(game, num_envs, max_episode_steps=max_episode_steps)
+        else:
+            env = NESSharedMemoryEnv(game, num_envs, max_episode_steps=max_episode_steps, context=context)
+
+        expected, _ = reference.reset(seed=0)
+        obs, _ = env.reset(seed=0)
+        assert np.array_equal(obs, expected), "reset observations differ"
+
+        actions = np.random.default_rng(0).integers(0, env.single_action_space.n, (steps, num_envs))
+        finished = 0
+        for t in range(steps):
+            (expected, expected_rewards, expected_terminated, expected_truncated,
+             expected_info) = reference.step(actions[t])
+            obs, rewards, terminated, truncated, info = env.step(actions[t])
+            assert np.array_equal(obs, expected), f"observations differ at step {t}"
+            assert np.array_equal(rewards, expected_rewards), f"rewards differ at step {t}"
+            assert np.array_equal(terminated, expected_terminated), f"terminations differ at step {t}"
+            assert np.array_equal(truncated, expected_truncated), f"truncations differ at step {t}"
+
+            done = expected_info.get("_final_obs", np.zeros(num_envs, dtype=bool))
+            assert np.array_equal(info.get("_final_obs", np.zeros(num_envs, dtype=bool)), done), \
+                f"finished envs differ at step {t}"
+            for i in np.flatnonzero(done):
+                assert np.array_equal(info["final_obs"][i], expected_info["final_obs"][i]), \
+                    f"final observation of env {i} differs at step {t}"
+            finished += done.sum()
+
+        env.close()
+        reference.close()
+        assert finished > 0, "no episode ended, raise steps or lower max_episode_steps"
+        path = "native" if native_frame_skip else "legacy"
+        print(f"{mode:>7} matches the wrapped envs ({path} frame skip) over {steps} steps and {finished} episode ends")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--game', type=str, default="SuperMarioBros")
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--envs', type=int, nargs='+', default=[8, 32, 64])
+    parser.add_argument('--modes', type=str, nargs='+', default=["async", "shared", "batch"])
+    parser.add_argument('--stub', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    context = "spawn"
+    if args.stub:
+        # Forked workers inherit the stub emulator module
+        install_stub_emulator()
+        context = "fork"
+
+    from main_super_og import make_env
+
+    if args.check:
+        for mode in ("batch", "shared"):
+            check_matches_wrappers(args.game, mode, context)
+
+    for num_envs in args.envs:
+        for mode in args.modes:
+            env = make_env(args.game, num_envs, framestack=4, vec_env=mode, context=context)
+            sps = steps_per_second(env, args.steps)
+            env.close()
+            print(f"{mode:>7} x{num_envs:<3} {sps:8.1f} vector steps/sec {sps * num_envs:10.1f} env steps/sec", flush=True)
+
+
+if __name__ == '__main__':
+    main()
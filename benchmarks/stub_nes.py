@@ -0,0 +1,104 @@
+"""
+A stand-in for the compiled cynes emulator used by the benchmarks.
+
+It mimics the parts of the `NES` API used by `NESEnv` (controller, step, get_all_ram, save/load, item access)
+without emulating anything, so benchmarks measure only the Python overhead around the emulator.
+"""
+import os
+import sys
+import types
+import numpy as np
+
+# Make the top level modules (PER, Agent, ObsPreprocessing...) importable when run as a script
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+# SMB1 reads this address to decide whether it is in game, keeping it at 1 makes menu skipping a no-op
+SMB1_GAME_MODE = 0x0770
+
+
+class StubNES:
+    """
+    Headless fake emulator which cycles through a few fixed frames, so that max-pooling consecutive frames has an
+    effect, and returns slowly changing zero page RAM.
+    """
+    def __init__(self, rom: str = "") -> None:
+        self.controller = 0
+        self.frames = np.random.default_rng(0).integers(0, 255, (3, 240, 256, 3), dtype=np.uint8)
+        self.ram = np.zeros(0x800, dtype=np.uint8)
+        self.frame_count = 0
+        self.has_crashed = 0
+        self.reset()
+
+    def __getitem__(self, address: int) -> int:
+        return int(self.ram[address])
+
+    def __setitem__(self, address: int, value: int) -> None:
+        self.ram[address] = value
+
+    def get_all_ram(self) -> np.ndarray:
+        # The real emulator hands back a fresh array on every call
+        return self.ram.copy()
+
+    def reset(self) -> None:
+        self.ram[:] = 0
+        self.ram[SMB1_GAME_MODE] = 1
+        self.frame_count = 0
+
+    def step(self, frames: int = 1) -> np.ndarray:
+        self.frame_count += frames
+        i = self.frame_count % 0x100
+        self.ram[i] = (int(self.ram[i]) + 1) & 0xFF
+        return self.frames[self.frame_count % len(self.frames)]
+
+    def save(self) -> np.ndarray:
+        return self.ram.copy()
+
+    def load(self, buffer: np.ndarray) -> None:
+        self.ram[:] = buffer
+
+
+def install_stub_emulator() -> None:
+    """Register `StubNES` as `nes_gym.cynes.emulator.NES` when the compiled emulator cannot be imported."""
+    try:
+        import nes_gym.cynes.emulator  # noqa: F401
+        import nes_gym.cynes.windowed  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    emulator = types.ModuleType("nes_gym.cynes.emulator")
+    emulator.NES = StubNES
+    sys.modules["nes_gym.cynes.emulator"] = emulator
+
+    windowed = types.ModuleType("nes_gym.cynes.windowed")
+    windowed.WindowedNES = StubNES
+    sys.modules["nes_gym.cynes.windowed"] = windowed
+
+
+def make_stub_env_class():
+    """Return a minimal NESEnv game built on the stub emulator."""
+    install_stub_emulator()
+    from nes_gym import nes_env
+
+    class StubEnv(nes_env.NESEnv):
+        def __init__(self, render_mode: str = "rgb_array", fps_limit: int = -1, max_episode_steps: int = -1,
+                     double_buffer_ram: bool = True) -> None:
+            super().__init__("smb1", render_mode=render_mode, fps_limit=fps_limit,
+                             max_episode_steps=max_episode_steps, double_buffer_ram=double_buffer_ram)
+            self.nes = StubNES()
+
+        def _will_reset(self): pass
+        def _did_reset(self): pass
+        def _will_step(self): pass
+        def _did_step(self): pass
+
+        def get_reward(self) -> float:
+            return float(self.value_change(0x0086)) + float(self.read_mult_byte([0x006D, 0x0086]))
+
+        def get_done(self) -> bool:
+            return False
+
+    return StubEnv
@@ -6,14 +6,16 @@ import gymnasium as gym
 import os
 import argparse
 import multiprocessing as mp
-from Agent import Agent, choose_eval_action, apply_pruning
+from Agent import Agent
+from EvalPool import EvalPool, EvalResults
 import sys
 from functools import partial
 from matplotlib import pyplot as plt
 from ObsPreprocessing import ObsPreprocessing
 import nes_gym
+from nes_gym.vector import NESBatchEnv, NESSharedMemoryEnv
 
-def make_env(game_name:str, envs_create:int=1, framestack:int=4, render_mode:str="rgb_array", fps_limit:int=-1) -> gym.vector.AsyncVectorEnv:
+def make_env(game_name:str, envs_create:int=1, framestack:int=4, render_mode:str="rgb_array", fps_limit:int=-1, vec_env:str="async", context:str="spawn") -> gym.vector.VectorEnv:
     '''
     Create a vectorised game environment.
 
@@ -22,12 +24,20 @@ def make_env(game_name:str, envs_create:int=1, framestack:int=4, render_mode:str
         framestack (int): The number of frames which are stacked together to form 1 observation. Defaults to 4
         headless (bool): Whether the environments should be headless, i.e. no window is displayed. Defaults to False
         fps_limit (int): Integer limit for the fps of the environment. Negative values give unlimited fps. Defaults to -1
+        vec_env (str): "async" for one wrapped env per process, "batch" for a single-process NESBatchEnv or "shared" for a NESSharedMemoryEnv worker pool. Defaults to "async"
+        context (str): Multiprocessing start method for the "async" and "shared" envs. Defaults to "spawn"
 
     Returns:
-        gym.vector.AsyncVectorEnv: Vectorised Gym environment.
+        gym.vector.VectorEnv: Vectorised Gym environment.
     '''
     print(f"Creating {envs_create} envs")
 
+    if vec_env == "batch":
+        return NESBatchEnv(game_name, envs_create, framestack=framestack, max_episode_steps=10000, render_mode=render_mode)
+    if vec_env == "shared":
+        return NESSharedMemoryEnv(game_name, envs_create, framestack=framestack, max_episode_steps=10000,
+                                  render_mode=render_mode, context=context)
+
     def create_env(game_name:str, render_mode:str="rgb_array"):
         env = ObsPreprocessing(gym.make(f'NES/{game_name}-v1', render_mode=render_mode, max_episode_steps=10000))
 
@@ -35,7 +45,7 @@ def make_env(game_name:str, envs_create:int=1, framestack:int=4, render_mode:str
     
     return gym.vector.AsyncVectorEnv(
         [lambda: create_env(game_name, render_mode=render_mode) for _ in range(envs_create)],
-        context="spawn",  # Required for Windows
+        context=context,  # spawn is required for Windows
     )
 
 def non_default_args(args, parser):
@@ -55,7 +65,9 @@ def non_default_args(args, parser):
         # Check if the argument should be included
         if (user_val != default_val and
                 default_val != "NameThisGame" and
-                arg not in ["include_evals", "eval_envs", "num_eval_episodes", "analy", "save_allll"]):
+                arg not in ["include_evals", "eval_envs", "num_eval_episodes", "analy", "save_allll", "vec_env", "compile_actions",
+                            "eval_workers", "memmap_dir", "hot_frames",
+                            "replay_snapshot", "load_replay", "compress_frames", "per_splits"]):
             # Format: argName + value (e.g., testing1)
             result.append(f"{arg}{user_val}")
 
@@ -75,61 +87,6 @@ def format_arguments(arg_string):
     return arg_string
 
 
-def evaluate_agent(net_state_dict, network_creator, eval_envs, num_eval_episodes, agent_name, testing, game, life_info,
-                   n_actions, device, index, framestack, repeat_probs, pruning=False):
-
-    eval_env = make_env(game, eval_envs, framestack=4, render_mode="rgb_array")
-    evals = []
-    eval_episodes = 0
-    eval_scores = np.array([0 for i in range(eval_envs)])
-    eval_observation, eval_info = eval_env.reset()
-
-    eval_net = network_creator()
-
-    if pruning:
-        apply_pruning(eval_net, 0.0)
-
-    # move state dict to gpu - pytorch doesn't allow sharing across threads on gpu
-    state_dict_gpu = {k: v.to(device) for k, v in net_state_dict.items()}
-
-    eval_net.load_state_dict(state_dict_gpu)
-
-    # this massively helps speed up training since agents get stuck in some games, causing evals to last a very
-    # long time
-    if index <= 125:
-        rng = 0.01
-    else:
-        rng = 0.0
-    while eval_episodes < num_eval_episodes:
-
-        eval_action = choose_eval_action(eval_observation, eval_net, n_actions, device, rng)
-        eval_observation_, eval_reward, eval_done_, eval_trun_, eval_info = eval_env.step(eval_action)
-        eval_done_ = np.logical_or(eval_done_, eval_trun_)
-
-        for i in range(eval_envs):
-            eval_scores[i] += eval_reward[i]
-            if eval_done_[i]:
-                eval_episodes += 1
-                evals.append(eval_scores[i])
-                eval_scores[i] = 0
-                if eval_episodes >= num_eval_episodes:
-                    break
-
-        eval_observation = eval_observation_
-
-    if not testing:
-        fname = agent_name + "Evaluation.npy"
-        data = np.load(fname)
-
-        # Update the specified index in the 0th dimension
-        data[index] = evals
-        print("Evaluation " + str(index + 1) + "M Complete, average score:")
-        print(np.mean(evals))
-
-        # Save the updated array back to the file
-        np.save(fname, data)
-
-
 def main():
     parser = argparse.ArgumentParser()
 
@@ -142,11 +99,13 @@ def main():
     parser.add_argument('--repeat', type=int, default=0)
     parser.add_argument('--include_evals', type=int, default=1)
     parser.add_argument('--eval_envs', type=int, default=10)
+    parser.add_argument('--eval_workers', type=int, default=1)
     parser.add_argument('--life_info', type=int, default=0)
     parser.add_argument('--num_eval_episodes', type=int, default=100)
     parser.add_argument('--analy', type=int, default=0)
     parser.add_argument('--framestack', type=int, default=4)
     parser.add_argument('--sticky', type=int, default=1)
+    parser.add_argument('--vec_env', type=str, default="async")
 
     # agent setup
     parser.add_argument('--nstep', type=int, default=3)
@@ -193,6 +152,18 @@ def main():
     parser.add_argument('--selfnorm', type=int, default=0)
     parser.add_argument('--pessimistic', type=int, default=0)
     parser.add_argument('--chain', type=int, default=0)
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--fused_encoder', type=int, default=1)
+    parser.add_argument('--mixed_precision', type=int, default=0)
+    parser.add_argument('--compile_actions', type=int, default=0)
+    parser.add_argument('--fixed_taus', type=int, default=0)
+    parser.add_argument('--memmap_dir', type=str, default="")
+    parser.add_argument('--hot_frames', type=int, default=0)
+    parser.add_argument('--compress_frames', type=str, default="")
+    parser.add_argument('--replay_snapshot', type=int, default=0)
+    parser.add_argument('--load_replay', type=str, default="")
+    parser.add_argument('--global_weight_norm', type=int, default=0)
+    parser.add_argument('--per_splits', type=int, default=1)
 
     parser.add_argument('--rainbow', type=int, default=0)
 
@@ -257,6 +228,19 @@ def main():
     selfnorm = args.selfnorm
     pessimistic = args.pessimistic
     chain = args.chain
+    prefetch = args.prefetch
+    fused_encoder = args.fused_encoder
+    mixed_precision = args.mixed_precision
+    compile_actions = args.compile_actions
+    fixed_taus = args.fixed_taus
+    # an empty memmap_dir keeps the replay memory in RAM
+    memmap_dir = args.memmap_dir or None
+    hot_frames = args.hot_frames
+    # "lz4", "zstd" or "zlib" keeps the replay frames compressed, empty stores them raw
+    compress_frames = args.compress_frames or None
+    global_weight_norm = args.global_weight_norm
+    # replay shards, each with its own lock, one or more envs per shard
+    per_splits = args.per_splits
     save_all = args.save_all
 
     rainbow = args.rainbow
@@ -295,9 +279,9 @@ def main():
         os.chdir(new_dir_name)
 
     # create blank evaluation file
-    fname = agent_name + "Evaluation.npy"
+    eval_results = None
     if not testing:
-        np.save(fname, np.zeros((args.frames // 1000000, num_eval_episodes)))
+        eval_results = EvalResults(agent_name + "Evaluation.npy", (args.frames // 1000000, num_eval_episodes))
 
     if testing:
         num_envs = 8
@@ -323,7 +307,7 @@ def main():
     device = torch.device('cuda:' + gpu if torch.cuda.is_available() else 'cpu')
     print("Device: " + str(device))
 
-    env = make_env(game, num_envs, framestack=4, render_mode="rgb_array")
+    env = make_env(game, num_envs, framestack=4, render_mode="rgb_array", vec_env=args.vec_env)
     print(env.observation_space)
     print(env.action_space[0])
     n_actions = env.action_space[0].n
@@ -338,7 +322,11 @@ def main():
                   per_beta_anneal=per_beta_anneal, layer_norm=layer_norm, c51=c51, eps_steps=eps_steps,
                   eps_disable=eps_disable, stoch=stoch, perturb=perturb,
                   activation=activation, selfnorm=selfnorm, pessimistic=pessimistic, n=nstep, munch_alpha=munch_alpha,
-                  sam=sam, grad_clip=grad_clip, chain=chain, rainbow=rainbow)
+                  sam=sam, grad_clip=grad_clip, chain=chain, rainbow=rainbow, prefetch=prefetch,
+                  fused_encoder=fused_encoder, mixed_precision=mixed_precision,
+                  compile_actions=compile_actions, fixed_taus=fixed_taus,
+                  memmap_dir=memmap_dir, hot_frames=hot_frames, compress_frames=compress_frames,
+                  global_weight_norm=global_weight_norm, per_splits=per_splits)
 
 
     scores_temp = []
@@ -350,7 +338,17 @@ def main():
     scores_count = [0 for i in range(num_envs)]
     scores = []
     observation, info = env.reset()
-    processes = []
+
+    # evaluation workers keep their envs and network for the whole run, and get new weights through shared memory
+    eval_pool = None
+    if include_evals:
+        eval_pool = EvalPool(args.eval_workers, deepcopy(agent.network_creator_fn),
+                             partial(make_env, game, eval_envs, framestack=4, render_mode="rgb_array"),
+                             agent.net.state_dict(), n_actions, device, eval_results=eval_results, pruning=pruning)
+
+    # resume from a replay snapshot, saved into the replay directory of an earlier run
+    if args.load_replay:
+        agent.load_memory(args.load_replay)
 
     if testing:
         from torchsummary import summary
@@ -373,12 +371,14 @@ def main():
 
         reward = np.clip(reward, -1., 1.)
 
-        for stream in range(num_envs):
-            terminal_in_buffer = done_[stream] #or info["lost_life"][stream]
-            next_obs = observation_[stream] if not trun_[stream] else np.array(info["final_observation"][stream])
+        terminal_in_buffer = done_ #or info["lost_life"]
+        next_obs = observation_
+        if trun_.any():
+            next_obs = observation_.copy()
+            for stream in np.flatnonzero(trun_):
+                next_obs[stream] = info["final_observation"][stream]
 
-            agent.store_transition(observation[stream], action[stream], reward[stream], next_obs,
-                                   terminal_in_buffer, trun_[stream], stream=stream)
+        agent.store_transitions_batch(observation, action, reward, next_obs, terminal_in_buffer, trun_)
 
         observation = observation_
 
@@ -405,30 +405,24 @@ def main():
             if not testing:
                 np.save(fname, np.array(scores))
 
-            if include_evals:
-
-                # wait for our evaluations to finish before we start the next evaluation
+            # after the first snapshot only what changed since the last one is written, in the background
+            if args.replay_snapshot and not testing:
+                agent.save_memory("replay")
 
-                for process in processes:
-                    process.join()
+            if include_evals:
 
+                # this waits only if every evaluation worker is still busy
                 agent.disable_noise(agent.net)
-                net_state_dict = deepcopy({k: v.cpu() for k, v in agent.net.state_dict().items()})
-                network_creator = deepcopy(agent.network_creator_fn)
-
-                # Start evaluation in a separate process
-                eval_process = mp.Process(target=evaluate_agent,
-                                          args=(net_state_dict, network_creator, eval_envs, num_eval_episodes, agent_name, testing, game,
-                                                life_info, n_actions, device, current_eval, framestack, repeat_probs, pruning))
-                eval_process.start()
-                processes.append(eval_process)
+                eval_pool.submit(agent.net.state_dict(), current_eval, num_eval_episodes)
 
             next_eval += eval_every
             current_eval += 1
 
+    agent.memory.wait_saved()
+
     # wait for our evaluations to finish before we quit the program
-    for process in processes:
-        process.join()
+    if eval_pool is not None:
+        eval_pool.close()
 
     print("Evaluations finished, job completed successfully!")
 
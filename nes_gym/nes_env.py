@@ -27,7 +27,7 @@ class NESEnv(gym.Env):
     ''' NES Gymnasium Environment. '''
     metadata = {"render_modes": ["human", "rgb_array"], "render_fps": 30}
 
-    def __init__(self, game_name:str, render_mode:str = "rbg_array", fps_limit:int = -1, max_episode_steps:int = -1) -> None:
+    def __init__(self, game_name:str, render_mode:str = "rbg_array", fps_limit:int = -1, max_episode_steps:int = -1, double_buffer_ram:bool = True) -> None:
         """
         Create a new NES environment.
 
@@ -35,6 +35,7 @@ class NESEnv(gym.Env):
             rom_path (str): The path to the NES .rom file to be loaded.
             render_mode (str): Optional - Either "rgb_array" or "human"  which defines whether the environment should display a window for each env.
             fps_limit (int): The frame rate limit of the game, negative values are unlimited. Defaults to -1
+            double_buffer_ram (bool): Keep `current_ram` and `previous_ram` in two preallocated buffers which swap roles each frame instead of copying RAM every step. Defaults to True
 
         Returns:
             None
@@ -71,8 +72,17 @@ class NESEnv(gym.Env):
         self.episode_frame_count = 0
         self.max_episode_length = max_episode_steps
 
-        self.current_ram = np.zeros(2048)
-        self.previous_ram = np.zeros(2048)
+        # Two preallocated RAM snapshots which swap between "current" and "previous" every frame
+        self.double_buffer_ram = double_buffer_ram
+        self._ram_buffers = np.zeros((2, self.nes.get_all_ram().size), dtype=np.uint8)
+        self._ram_views = (self._ram_buffers[0], self._ram_buffers[1])
+        self._ram_index = 0
+
+        self.current_ram = self._ram_views[0]
+        self.previous_ram = self._ram_views[1]
+
+        # Reused output of `step_n`, allocated on first use
+        self._frame_buffer = None
 
     def setActions(self, actionList: list = INPUTS):
         self._action_map = actionList
@@ -110,11 +120,22 @@ class NESEnv(gym.Env):
         obs = np.array(obs, dtype=np.uint8)  # Ensure it's a valid numpy array
         info = {}
 
-        self.current_ram = self.nes.get_all_ram()
-        self.previous_ram = copy.deepcopy(self.current_ram)
+        if self.double_buffer_ram:
+            self._swap_ram()
+            self.previous_ram[:] = self.current_ram
+        else:
+            self.current_ram = self.nes.get_all_ram()
+            self.previous_ram = copy.deepcopy(self.current_ram)
 
         return obs, info
 
+    def _swap_ram(self) -> None:
+        """Make the current RAM buffer the previous one and refill the other buffer in place from the emulator."""
+        self._ram_index ^= 1
+        self.previous_ram = self.current_ram
+        self.current_ram = self._ram_views[self._ram_index]
+        self.current_ram[:] = self.nes.get_all_ram()
+
     def _backup(self) -> None:
         """Backup the current emulator state."""
         self._backup_state = self.nes.save()
@@ -175,36 +196,96 @@ class NESEnv(gym.Env):
     def get_done(self) -> bool:
         return False
 
-    def step(self, action: int) -> tuple:
-        ''' Transition function: advances one frame of gameplay with a given action. '''
-
-        if self.done: raise ValueError('Cannot step in a done environment! Call `reset` first.')
+    def _run_frame(self, action: int):
+        ''' Run a single frame of gameplay, updating the done flag and RAM snapshots. Returns the raw frame buffer and the bounded reward. '''
         self._will_step()
 
         self.nes.controller = self._action_map[action]
         frame = self.nes.step(frames=1)
-        obs = np.array(frame, dtype=np.uint8)
         reward = float(self.get_reward())
         self.done = bool(self.get_done() or self.max_len_exceeded())
 
-        self.previous_ram = copy.deepcopy(self.current_ram)
-        self.current_ram = self.nes.get_all_ram()
+        if self.double_buffer_ram:
+            self._swap_ram()
+        else:
+            self.previous_ram = copy.deepcopy(self.current_ram)
+            self.current_ram = self.nes.get_all_ram()
 
         self.episode_frame_count += 1
 
         # Bound the reward in [min, max]
         if reward < self.reward_range[0]: reward = self.reward_range[0]
         elif reward > self.reward_range[1]: reward = self.reward_range[1]
-        
-        if self.fps_limit > 0:
-            # Sleep until the required frame duration has passed for consistent frame rate
-            if (1/self.fps_limit - (time.time() - self.last_time)) > 0:
-                time.sleep(1/self.fps_limit - (time.time() - self.last_time))
-            self.last_time = time.time()
+
+        return frame, reward
+
+    def _limit_fps(self, frames: int = 1) -> None:
+        ''' Sleep until the duration of `frames` frames has passed since the last call for consistent frame rate. '''
+        remaining = frames / self.fps_limit - (time.time() - self.last_time)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.last_time = time.time()
+
+    def step(self, action: int) -> tuple:
+        ''' Transition function: advances one frame of gameplay with a given action. '''
+
+        if self.done: raise ValueError('Cannot step in a done environment! Call `reset` first.')
+
+        frame, reward = self._run_frame(action)
+        obs = np.array(frame, dtype=np.uint8)
+
+        if self.fps_limit > 0: self._limit_fps()
 
         self._did_step()
 
         return obs, reward, self.done, False, {}
+
+    def step_n(self, action: int, n: int, keep_last: int = 2) -> tuple:
+        '''
+        Advance up to `n` frames with the same action in a single call, stopping early if the episode ends.
+
+        Only the last `keep_last` frames are copied out of the emulator, into a reused buffer of shape
+        (keep_last, 240, 256, 3) ordered oldest to newest. This buffer is overwritten by the next call.
+        If the episode ends, or fewer than `keep_last` frames are run, every slot holds the last frame.
+
+        Args:
+            action (int): Index into the action map, held for all `n` frames.
+            n (int): The number of frames to advance.
+            keep_last (int): The number of trailing frames to return. Defaults to 2 for max-pooling.
+
+        Returns:
+            tuple: (frames, total_reward, done, truncated, info)
+        '''
+        if self.done: raise ValueError('Cannot step in a done environment! Call `reset` first.')
+        if n < 1: raise ValueError(f'Cannot step {n} frames, `n` must be at least 1.')
+
+        if self._frame_buffer is None or self._frame_buffer.shape[0] != keep_last:
+            self._frame_buffer = np.empty((keep_last, *self.observation_space.shape), dtype=np.uint8)
+
+        first_kept = n - keep_last
+        total_reward = 0.0
+        frames_run = 0
+
+        for t in range(n):
+            frame, reward = self._run_frame(action)
+            total_reward += reward
+            frames_run += 1
+
+            if t >= first_kept:
+                self._frame_buffer[t - first_kept] = frame
+
+            self._did_step()
+
+            if self.done:
+                break
+
+        # Fill the slots which were never written with the final frame
+        if self.done or frames_run < keep_last:
+            self._frame_buffer[:] = frame
+
+        if self.fps_limit > 0: self._limit_fps(frames_run)
+
+        return self._frame_buffer, total_reward, self.done, False, {}
     
     def read_mult_byte(self, locations:list, endian:str = "big", ram_selection:np.array = None) -> int:
         if ram_selection is None: ram_selection = self.current_ram
@@ -0,0 +1,433 @@
+"""
+Batched vector environments for NES games.
+
+Unlike `gym.vector.AsyncVectorEnv` wrapped around `ObsPreprocessing` and `FrameStackObservation`, these envs own
+the emulators directly and write preprocessed, frame-stacked observations into one preallocated
+(num_envs, framestack, screen_size, screen_size) uint8 array, so nothing is pickled or re-stacked per step.
+
+- `NESBatchEnv` runs every emulator in the calling process.
+- `NESSharedMemoryEnv` splits the emulators over worker processes which write their slice of the batch into a
+  `multiprocessing.shared_memory` block, and are driven by single-byte pipe signals.
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import traceback
+
+import cv2
+import numpy as np
+import gymnasium as gym
+from gymnasium.spaces import Box
+from gymnasium.vector import AutoresetMode
+from gymnasium.vector.utils import batch_space
+
+
+def make_game_env(game_name: str, render_mode: str = "rgb_array"):
+    """Create the bare (unwrapped) NES environment registered as `NES/{game_name}-v1`."""
+    return gym.make(f"NES/{game_name}-v1", render_mode=render_mode, disable_env_checker=True).unwrapped
+
+
+class FramePreprocessor:
+    """
+    Turns the last two raw frames of a skipped step into one observation, matching `ObsPreprocessing`:
+    max-pool the two RGB frames, convert to grayscale, then resize with nearest-exact interpolation.
+    All intermediate results live in reused scratch buffers.
+    """
+    def __init__(self, frame_shape: tuple, screen_size: int = 84):
+        self.screen_size = screen_size
+        self.pooled = np.empty(frame_shape, dtype=np.uint8)
+        self.gray = np.empty(frame_shape[:2], dtype=np.uint8)
+
+    def __call__(self, frames: np.ndarray, out: np.ndarray) -> None:
+        """Write the observation for `frames` (shape (2, H, W, 3), oldest first) into `out` (screen_size x screen_size)."""
+        np.maximum(frames[-2], frames[-1], out=self.pooled)
+        cv2.cvtColor(self.pooled, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        cv2.resize(self.gray, (self.screen_size, self.screen_size), dst=out, interpolation=cv2.INTER_NEAREST_EXACT)
+
+    def single(self, frame: np.ndarray, out: np.ndarray) -> None:
+        """Write the observation for a single frame, as for the frame returned by `reset` or a truncated step."""
+        cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        cv2.resize(self.gray, (self.screen_size, self.screen_size), dst=out, interpolation=cv2.INTER_NEAREST_EXACT)
+
+
+def batch_buffer_specs(num_envs: int, framestack: int, screen_size: int, ram_size: int) -> dict:
+    """Shapes and dtypes of the arrays a group of envs writes into. Observations are double buffered."""
+    stack_shape = (framestack, screen_size, screen_size)
+    return {
+        "obs": ((2, num_envs, *stack_shape), np.uint8),
+        "final_obs": ((num_envs, *stack_shape), np.uint8),
+        "final_mask": ((num_envs,), np.bool_),
+        "rewards": ((num_envs,), np.float64),
+        "terminations": ((num_envs,), np.bool_),
+        "truncations": ((num_envs,), np.bool_),
+        "actions": ((num_envs,), np.int64),
+        "ram": ((num_envs, ram_size), np.uint8),
+    }
+
+
+def buffer_layout(specs: dict, align: int = 64) -> tuple:
+    """Byte offsets of each array when packed into one block. Returns (offsets, total size)."""
+    offsets = {}
+    size = 0
+    for name, (shape, dtype) in specs.items():
+        offsets[name] = size
+        size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        size = -(-size // align) * align
+    return offsets, size
+
+
+def buffer_views(specs: dict, buffer=None) -> dict:
+    """Numpy arrays for every spec, backed by `buffer` (e.g. a SharedMemory.buf) or by a fresh allocation."""
+    offsets, size = buffer_layout(specs)
+    if buffer is None:
+        buffer = bytearray(size)
+    return {name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offsets[name])
+            for name, (shape, dtype) in specs.items()}
+
+
+class NESEnvGroup:
+    """
+    A set of emulators which write their results into slices of the batched buffers.
+
+    Used for all envs by `NESBatchEnv`, and for one contiguous slice of envs inside each `NESSharedMemoryEnv` worker.
+    """
+    def __init__(self, envs: list, buffers: dict, frame_skip: int = 4, screen_size: int = 84,
+                 max_episode_steps: int = 10000):
+        self.envs = envs
+        self.frame_skip = frame_skip
+        self.max_episode_steps = max_episode_steps
+        self.preprocess = FramePreprocessor(envs[0].observation_space.shape, screen_size)
+        self.elapsed_frames = np.zeros(len(envs), dtype=np.int64)
+
+        for name, array in buffers.items():
+            setattr(self, name, array)
+
+    def _reset_env(self, i: int, obs: np.ndarray, seed=None) -> None:
+        """Reset env `i` and fill its whole frame stack with the first frame."""
+        frame, _ = self.envs[i].reset(seed=seed)
+        self.preprocess.single(frame, obs[i, -1])
+        obs[i, :-1] = obs[i, -1]
+        self.elapsed_frames[i] = 0
+
+    def reset(self, obs_index: int, seeds: list) -> None:
+        obs = self.obs[obs_index]
+        for i in range(len(self.envs)):
+            self._reset_env(i, obs, seed=seeds[i])
+            self.ram[i] = self.envs[i].current_ram
+        self.final_mask[:] = False
+
+    def _frames_this_step(self, i: int) -> int:
+        if self.max_episode_steps < 0:
+            return self.frame_skip
+        return min(self.frame_skip, self.max_episode_steps - self.elapsed_frames[i])
+
+    def step(self, obs_index: int) -> None:
+        """Step every env with `self.actions`, writing into observation buffer `obs_index`."""
+        obs = self.obs[obs_index]
+
+        # Shift every stack by one frame in a single copy, the newest frame is written per env below
+        obs[:, :-1] = self.obs[obs_index ^ 1][:, 1:]
+
+        for i, env in enumerate(self.envs):
+            n = self._frames_this_step(i)
+            frames, reward, terminated, _, _ = env.step_n(int(self.actions[i]), n, keep_last=2)
+            self.elapsed_frames[i] += n
+            truncated = 0 <= self.max_episode_steps <= self.elapsed_frames[i]
+
+            if truncated:
+                # ObsPreprocessing pools the last frame with itself when the time limit ends the episode
+                self.preprocess.single(frames[-1], obs[i, -1])
+            else:
+                self.preprocess(frames, obs[i, -1])
+            self.rewards[i] = reward
+            self.terminations[i] = terminated
+            self.truncations[i] = truncated
+            self.final_mask[i] = terminated or truncated
+
+            if terminated or truncated:
+                self.final_obs[i] = obs[i]
+                self._reset_env(i, obs)
+
+            self.ram[i] = env.current_ram
+
+    def close(self) -> None:
+        for env in self.envs:
+            env.close()
+
+
+class _BatchedNESVectorEnv(gym.vector.VectorEnv):
+    """Spaces, seeding and result packing shared by the NES vector envs."""
+    metadata = {"render_modes": ["rgb_array"], "autoreset_mode": AutoresetMode.SAME_STEP}
+
+    def _setup(self, probe_env, num_envs: int, framestack: int, screen_size: int) -> None:
+        self.num_envs = num_envs
+        self.single_observation_space = Box(low=0, high=255, shape=(framestack, screen_size, screen_size), dtype=np.uint8)
+        self.single_action_space = probe_env.action_space
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.ram_size = probe_env.current_ram.size
+        self._obs_index = 0
+
+    def _seeds(self, seed) -> list:
+        """`seed` may be None, an int (env i gets seed + i) or a list of seeds."""
+        if seed is None or isinstance(seed, int):
+            return [None if seed is None else seed + i for i in range(self.num_envs)]
+        return list(seed)
+
+    @property
+    def ram(self) -> np.ndarray:
+        """RAM of every emulator after the last step, shape (num_envs, ram_size). Overwritten by the next step."""
+        return self.buffers["ram"]
+
+    def _results(self):
+        b = self.buffers
+        info = {}
+        if b["final_mask"].any():
+            final_obs = np.full(self.num_envs, None, dtype=object)
+            for i in np.flatnonzero(b["final_mask"]):
+                final_obs[i] = b["final_obs"][i].copy()
+            # SAME_STEP keys, and the older ones the training loop reads
+            info["final_obs"] = info["final_observation"] = final_obs
+            info["_final_obs"] = b["final_mask"].copy()
+            info["_final_observation"] = info["_final_obs"]
+
+        return (b["obs"][self._obs_index], b["rewards"].copy(), b["terminations"].copy(),
+                b["truncations"].copy(), info)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+
+class NESBatchEnv(_BatchedNESVectorEnv):
+    """
+    In-process vector env holding `num_envs` NES emulators.
+
+    Each step runs `frame_skip` frames per env through `NESEnv.step_n` and writes the preprocessed frame straight
+    into a shared observation array. Finished envs are reset in the same step (`AutoresetMode.SAME_STEP`), so the
+    observation returned for them is the first of the next episode. The observation they ended on is in
+    `info["final_obs"]`, and also in `info["final_observation"]`, which the training loop reads.
+
+    Two observation arrays are used alternately, so an observation returned by `step_wait` stays valid until the
+    step after next. This lets the caller keep the previous observation around for `store_transition`.
+    """
+    def __init__(self, game_name: str, num_envs: int, framestack: int = 4, frame_skip: int = 4,
+                 screen_size: int = 84, max_episode_steps: int = 10000, render_mode: str = "rgb_array"):
+        """
+        Create the emulators and the batched observation buffers.
+
+        Args:
+            game_name (str): Name of a registered game, e.g. "Tetris" for `NES/Tetris-v1`.
+            num_envs (int): The number of emulators.
+            framestack (int): The number of frames stacked into one observation. Defaults to 4
+            frame_skip (int): The number of emulator frames per agent step. Defaults to 4
+            screen_size (int): Side length of the resized square frames. Defaults to 84
+            max_episode_steps (int): Episode length in emulator frames before truncation, negative for unlimited. Defaults to 10000
+            render_mode (str): Render mode passed to each game environment. Defaults to "rgb_array"
+        """
+        self.render_mode = render_mode
+        envs = [make_game_env(game_name, render_mode=render_mode) for _ in range(num_envs)]
+        self._setup(envs[0], num_envs, framestack, screen_size)
+
+        self.buffers = buffer_views(batch_buffer_specs(num_envs, framestack, screen_size, self.ram_size))
+        self.group = NESEnvGroup(envs, self.buffers, frame_skip=frame_skip, screen_size=screen_size,
+                                 max_episode_steps=max_episode_steps)
+
+    @property
+    def envs(self) -> list:
+        return self.group.envs
+
+    def reset(self, *, seed=None, options=None):
+        self.group.reset(self._obs_index, self._seeds(seed))
+        return self.buffers["obs"][self._obs_index], {}
+
+    def step_async(self, actions) -> None:
+        self.buffers["actions"][:] = actions
+
+    def step_wait(self):
+        self._obs_index ^= 1
+        self.group.step(self._obs_index)
+        return self._results()
+
+    def close_extras(self, **kwargs) -> None:
+        self.group.close()
+
+
+# Pipe signals between NESSharedMemoryEnv and its workers
+_RESET, _STEP, _CLOSE, _OK, _ERROR = b"r", b"s", b"c", b"k", b"e"
+
+
+def _shared_memory_worker(game_name: str, render_mode: str, start: int, stop: int, specs: dict, shm_name: str,
+                          frame_skip: int, screen_size: int, max_episode_steps: int, conn) -> None:
+    """
+    Worker loop of `NESSharedMemoryEnv`, owning envs [start, stop).
+
+    Commands are single bytes, followed by the observation buffer index (and seeds for reset); the reply is a
+    single `_OK` byte, or `_ERROR` followed by the formatted traceback.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    group = None
+    try:
+        buffers = {name: array[:, start:stop] if name == "obs" else array[start:stop]
+                   for name, array in buffer_views(specs, shm.buf).items()}
+        envs = [make_game_env(game_name, render_mode=render_mode) for _ in range(stop - start)]
+        group = NESEnvGroup(envs, buffers, frame_skip=frame_skip, screen_size=screen_size,
+                            max_episode_steps=max_episode_steps)
+        del buffers
+        conn.send_bytes(_OK)
+
+        while True:
+            message = conn.recv_bytes()
+            command, obs_index = message[:1], message[1]
+            try:
+                if command == _STEP:
+                    group.step(obs_index)
+                elif command == _RESET:
+                    seeds = np.frombuffer(message[2:], dtype=np.int64)
+                    group.reset(obs_index, [None if s < 0 else int(s) for s in seeds[start:stop]])
+                elif command == _CLOSE:
+                    break
+                conn.send_bytes(_OK)
+            except Exception:
+                conn.send_bytes(_ERROR + traceback.format_exc().encode())
+    except Exception:
+        conn.send_bytes(_ERROR + traceback.format_exc().encode())
+    finally:
+        if group is not None:
+            group.close()
+        group = None
+        conn.close()
+        try:
+            shm.close()
+        except BufferError:
+            # A traceback may still reference the views, the block is released when the process exits
+            pass
+
+
+class NESSharedMemoryEnv(_BatchedNESVectorEnv):
+    """
+    Vector env whose emulators run in a pool of worker processes.
+
+    Every worker owns a contiguous slice of the envs and writes observations, rewards, dones and RAM for that slice
+    into one `multiprocessing.shared_memory` block. `step_async` only writes the actions and sends each worker a
+    two byte signal, `step_wait` waits for one byte back, so no observations are pickled. Autoreset and the double
+    buffered observations behave as in `NESBatchEnv`.
+    """
+    def __init__(self, game_name: str, num_envs: int, num_workers: int = None, framestack: int = 4,
+                 frame_skip: int = 4, screen_size: int = 84, max_episode_steps: int = 10000,
+                 render_mode: str = "rgb_array", context: str = "spawn"):
+        """
+        Start the workers and the shared buffers.
+
+        Args:
+            game_name (str): Name of a registered game, e.g. "Tetris" for `NES/Tetris-v1`.
+            num_envs (int): The number of emulators.
+            num_workers (int): The number of worker processes. Defaults to one per CPU, at most `num_envs`
+            framestack (int): The number of frames stacked into one observation. Defaults to 4
+            frame_skip (int): The number of emulator frames per agent step. Defaults to 4
+            screen_size (int): Side length of the resized square frames. Defaults to 84
+            max_episode_steps (int): Episode length in emulator frames before truncation, negative for unlimited. Defaults to 10000
+            render_mode (str): Render mode passed to each game environment. Defaults to "rgb_array"
+            context (str): Multiprocessing start method. Defaults to "spawn"
+        """
+        self.render_mode = render_mode
+        self.closed = False
+        self._waiting = False
+
+        probe_env = make_game_env(game_name, render_mode="rgb_array")
+        self._setup(probe_env, num_envs, framestack, screen_size)
+        probe_env.close()
+
+        specs = batch_buffer_specs(num_envs, framestack, screen_size, self.ram_size)
+        _, size = buffer_layout(specs)
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self.buffers = buffer_views(specs, self._shm.buf)
+
+        num_workers = min(num_workers or mp.cpu_count(), num_envs)
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+
+        ctx = mp.get_context(context)
+        self.conns = []
+        self.processes = []
+        try:
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                parent_conn, child_conn = ctx.Pipe()
+                self.conns.append(parent_conn)
+                process = ctx.Process(target=_shared_memory_worker, daemon=True,
+                                      args=(game_name, render_mode, int(start), int(stop), specs, self._shm.name,
+                                            frame_skip, screen_size, max_episode_steps, child_conn))
+                process.start()
+                child_conn.close()
+                self.processes.append(process)
+
+            self._wait_all()
+        except BaseException:
+            self._abort_start()
+            raise
+
+    def _abort_start(self) -> None:
+        """Stop the workers which did start and free the shared memory after a worker failed to start."""
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for conn in self.conns:
+            conn.close()
+
+        self.buffers = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        self._shm.unlink()
+        self.closed = True
+
+    def _signal_all(self, message: bytes) -> None:
+        for conn in self.conns:
+            conn.send_bytes(message)
+
+    def _wait_all(self) -> None:
+        errors = []
+        for conn in self.conns:
+            reply = conn.recv_bytes()
+            if reply[:1] == _ERROR:
+                errors.append(reply[1:].decode())
+        if errors:
+            raise RuntimeError("NES worker failed:\n" + "\n".join(errors))
+
+    def reset(self, *, seed=None, options=None):
+        seeds = np.array([-1 if s is None else s for s in self._seeds(seed)], dtype=np.int64)
+        self._signal_all(_RESET + bytes([self._obs_index]) + seeds.tobytes())
+        self._wait_all()
+        return self.buffers["obs"][self._obs_index], {}
+
+    def step_async(self, actions) -> None:
+        self.buffers["actions"][:] = actions
+        self._obs_index ^= 1
+        self._signal_all(_STEP + bytes([self._obs_index]))
+        self._waiting = True
+
+    def step_wait(self):
+        self._wait_all()
+        self._waiting = False
+        return self._results()
+
+    def close_extras(self, **kwargs) -> None:
+        if self._waiting:
+            self._wait_all()
+        for conn in self.conns:
+            try:
+                conn.send_bytes(_CLOSE + b"\x00")
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
+
+        # Views must be released before the block can be closed, observations still held by the caller keep it mapped
+        self.buffers = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        self._shm.unlink()
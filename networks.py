@@ -1,7 +1,7 @@
 """
 This file defines all the neural network architectures available to use.
 """
-from functools import partial
+from functools import partial, wraps
 from math import sqrt
 import math
 
@@ -13,6 +13,59 @@ import numpy as np
 import time
 #from torchvision.utils import save_image
 
+def mixed_precision(method):
+    """
+    Runs a network method under bfloat16 autocast when the network's mixed_precision flag is set.
+    Floating point outputs are returned as fp32, so losses and targets computed from them stay in full precision.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not getattr(self, "mixed_precision", False):
+            return method(self, *args, **kwargs)
+
+        with torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16):
+            out = method(self, *args, **kwargs)
+
+        if isinstance(out, tuple):
+            return tuple(o.float() if o.is_floating_point() else o for o in out)
+        return out.float()
+
+    return wrapper
+
+
+def tau_generator(device):
+    """
+    The generator IQN networks draw their taus from, on the network's device. It is seeded from torch's global RNG,
+    so torch.manual_seed still makes runs repeatable.
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(torch.randint(2 ** 62, (1,))))
+    return generator
+
+
+# the fixed tau embedding is cached on the python side, which torch.compile should not try to trace
+compiler_disable = torch.compiler.disable if hasattr(torch, "compiler") and hasattr(torch.compiler, "disable") \
+    else (lambda fn: fn)
+
+
+@compiler_disable
+def fixed_tau_embedding(net):
+    """
+    relu(cos_embedding) of num_tau evenly spaced taus for an IQN network, shape (num_tau, conv_out_size), and those
+    taus. It is computed once and kept until the cos_embedding weights change, so qvals, which only needs the mean
+    over taus, does not rerun the embedding for every row of every batch.
+    """
+    key = (net.cos_embedding.weight._version, net.cos_embedding.bias._version, getattr(net, "mixed_precision", False))
+    if getattr(net, "fixed_embedding_key", None) != key:
+        taus = (torch.arange(net.num_tau, device=net.device) + 0.5) / net.num_tau
+        with torch.no_grad():
+            cos = torch.cos(taus.unsqueeze(-1) * net.pis.view(1, net.n_cos))
+            net.fixed_embedding = torch.relu(net.cos_embedding(cos))
+        net.fixed_embedding_taus = taus.view(1, net.num_tau, 1)
+        net.fixed_embedding_key = key
+    return net.fixed_embedding, net.fixed_embedding_taus
+
+
 class NoisyLinear(nn.Module):
   def __init__(self, in_features, out_features, std_init=0.5):
     super(NoisyLinear, self).__init__()
@@ -62,12 +115,12 @@ class FactorizedNoisyLinear(nn.Module):
         self.out_features = out_features
         self.sigma_0 = sigma_0
 
-        # weight: w = \mu^w + \sigma^w . \epsilon^w
+        # weight: w = \mu^w + \sigma^w . \epsilon^w, where \epsilon^w = \epsilon^out \otimes \epsilon^in is never stored
         self.weight_mu = nn.Parameter(torch.empty(out_features, in_features))
         self.weight_sigma = nn.Parameter(torch.empty(out_features, in_features))
-        self.register_buffer('weight_epsilon', torch.empty(out_features, in_features))
+        self.register_buffer('epsilon_in', torch.empty(in_features))
 
-        # bias: b = \mu^b + \sigma^b . \epsilon^b
+        # bias: b = \mu^b + \sigma^b . \epsilon^b, where \epsilon^b = \epsilon^out
         self.bias_mu = nn.Parameter(torch.empty(out_features))
         self.bias_sigma = nn.Parameter(torch.empty(out_features))
         self.register_buffer('bias_epsilon', torch.empty(out_features))
@@ -110,23 +163,64 @@ class FactorizedNoisyLinear(nn.Module):
     @torch.no_grad()
     def reset_noise(self) -> None:
         # like in eq 10 and 11 of the paper
-        epsilon_in = self._get_noise(self.in_features)
-        epsilon_out = self._get_noise(self.out_features)
-        self.weight_epsilon.copy_(epsilon_out.outer(epsilon_in))
-        self.bias_epsilon.copy_(epsilon_out)
+        self.epsilon_in.copy_(self._get_noise(self.in_features))
+        self.bias_epsilon.copy_(self._get_noise(self.out_features))
 
     @torch.no_grad()
     def disable_noise(self) -> None:
-        self.weight_epsilon[:] = 0
+        self.epsilon_in[:] = 0
         self.bias_epsilon[:] = 0
 
     def forward(self, input: Tensor) -> Tensor:
         # y = wx + d, where
-        # w = \mu^w + \sigma^w * \epsilon^w
-        # b = \mu^b + \sigma^b * \epsilon^b
-        return F.linear(input,
-                        self.weight_mu + self.weight_sigma*self.weight_epsilon,
-                        self.bias_mu + self.bias_sigma*self.bias_epsilon)
+        # w = \mu^w + \sigma^w * (\epsilon^out \otimes \epsilon^in)
+        # b = \mu^b + \sigma^b * \epsilon^out
+        weight = (self.weight_sigma * self.epsilon_in).mul_(self.bias_epsilon.unsqueeze(1)).add_(self.weight_mu)
+        return F.linear(input, weight, torch.addcmul(self.bias_mu, self.bias_sigma, self.bias_epsilon))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store the full weight_epsilon matrix, any row with a non-zero \epsilon^out gives \epsilon^in
+        weight_epsilon = state_dict.pop(prefix + 'weight_epsilon', None)
+        if weight_epsilon is not None and prefix + 'epsilon_in' not in state_dict:
+            epsilon_out = state_dict[prefix + 'bias_epsilon']
+            row = epsilon_out.abs().argmax()
+            if epsilon_out[row] != 0:
+                state_dict[prefix + 'epsilon_in'] = weight_epsilon[row] / epsilon_out[row]
+            else:
+                state_dict[prefix + 'epsilon_in'] = torch.zeros_like(weight_epsilon[row])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class NoiseManager:
+    """
+    Resets or disables the noise of every FactorizedNoisyLinear in a network at once.
+
+    The layers are found once, and their epsilon vectors are made views into one flat buffer, so a reset is a single
+    randn call. Create it after the network has been moved to its device.
+    """
+    def __init__(self, net):
+        self.layers = [m for m in net.modules() if isinstance(m, FactorizedNoisyLinear)]
+        sizes = [size for m in self.layers for size in (m.in_features, m.out_features)]
+        device = self.layers[0].epsilon_in.device if self.layers else None
+        self.noise = torch.zeros(sum(sizes), device=device)
+
+        views = self.noise.split(sizes)
+        for m, epsilon_in, epsilon_out in zip(self.layers, views[0::2], views[1::2]):
+            epsilon_in.copy_(m.epsilon_in)
+            epsilon_out.copy_(m.bias_epsilon)
+            m.epsilon_in = epsilon_in
+            m.bias_epsilon = epsilon_out
+
+    @torch.no_grad()
+    def reset_noise(self) -> None:
+        self.noise.normal_()
+        # f(x) = sgn(x)sqrt(|x|)
+        sign = self.noise.sign()
+        self.noise.abs_().sqrt_().mul_(sign)
+
+    @torch.no_grad()
+    def disable_noise(self) -> None:
+        self.noise.zero_()
 
 class NatureIQN(nn.Module):
     """
@@ -153,6 +247,7 @@ class NatureIQN(nn.Module):
 
         self.n_cos = 64
         self.pis = torch.FloatTensor([np.pi * i for i in range(self.n_cos)]).view(1, 1, self.n_cos).to(device)
+        self.tau_generator = tau_generator(device)
 
         self.conv = nn.Sequential(
             nn.Conv2d(in_channels=in_depth, out_channels=32, kernel_size=8, stride=4),
@@ -189,7 +284,7 @@ class NatureIQN(nn.Module):
         o = self.conv(torch.zeros(1, *shape))
         return int(np.prod(o.size()))
 
-    def forward(self, input, advantages_only=False):
+    def forward(self, input, advantages_only=False, fixed_taus=False):
         """
         Quantile Calculation depending on the number of tau
 
@@ -197,6 +292,13 @@ class NatureIQN(nn.Module):
         quantiles [ shape of (batch_size, num_tau, action_size)]
         taus [shape of ((batch_size, num_tau, 1))]
 
+        """
+        return self.head(self.encode(input), advantages_only=advantages_only, fixed_taus=fixed_taus)
+
+    @mixed_precision
+    def encode(self, input):
+        """
+        Convolutional features of a batch of images, shape (batch_size, conv_out_size)
         """
         input = input.float() / 255
         # input is a batch of images
@@ -204,19 +306,33 @@ class NatureIQN(nn.Module):
 
         # put input through convolutional layers
         x = self.conv(input)
-        x = x.view(batch_size, -1)
+        return x.view(batch_size, -1)
 
-        # generate taus (random uniform [0-1])
-        taus = torch.rand(batch_size, self.num_tau).to(self.device).unsqueeze(-1)  # (batch_size, n_tau, 1)
+    @mixed_precision
+    def head(self, x, advantages_only=False, fixed_taus=False):
+        """
+        Quantiles from features given by encode, with freshly sampled taus, or the cached evenly spaced ones if
+        fixed_taus. Same returns as forward
+        """
+        batch_size = x.size()[0]
 
-        # put taus through cosine function before inserting into network
-        # All this really does is change the range from [0 to 1] to [-1 to 1]
-        cos = torch.cos(taus * self.pis)
+        if fixed_taus:
+            cos_x, taus = fixed_tau_embedding(self)
+            cos_x = cos_x.unsqueeze(0)  # (1, n_tau, layer)
+            taus = taus.expand(batch_size, -1, -1)
+        else:
+            # generate taus (random uniform [0-1]) on the device
+            taus = torch.rand(batch_size, self.num_tau, 1, device=self.device,
+                              generator=self.tau_generator)  # (batch_size, n_tau, 1)
+
+            # put taus through cosine function before inserting into network
+            # All this really does is change the range from [0 to 1] to [-1 to 1]
+            cos = torch.cos(taus * self.pis)
 
-        cos = cos.view(batch_size * self.num_tau, self.n_cos)
+            cos = cos.view(batch_size * self.num_tau, self.n_cos)
 
-        # apply cos embedding weights, then put values through relu and reshape
-        cos_x = torch.relu(self.cos_embedding(cos)).view(batch_size, self.num_tau, self.conv_out_size)  # (batch, n_tau, layer)
+            # apply cos embedding weights, then put values through relu and reshape
+            cos_x = torch.relu(self.cos_embedding(cos)).view(batch_size, self.num_tau, self.conv_out_size)  # (batch, n_tau, layer)
 
         # multiply output of conv layers by output of cosine/tau function
         x = (x.unsqueeze(1) * cos_x).view(batch_size * self.num_tau, self.conv_out_size)
@@ -233,8 +349,8 @@ class NatureIQN(nn.Module):
 
         return out.view(batch_size, self.num_tau, self.actions), taus
 
-    def qvals(self, inputs, advantages_only=False):
-        quantiles, _ = self.forward(inputs, advantages_only=advantages_only)
+    def qvals(self, inputs, advantages_only=False, fixed_taus=False):
+        quantiles, _ = self.forward(inputs, advantages_only=advantages_only, fixed_taus=fixed_taus)
         actions = quantiles.mean(dim=1)
         return actions
 
@@ -447,6 +563,7 @@ class ImpalaCNNLarge(nn.Module):
     def qvals(self, x, advantages_only=False):
         return self.forward(x, advantages_only)
 
+    @mixed_precision
     def forward(self, x, advantages_only=False):
         """if test:
             save_image(x[0], 'img1.png')
@@ -548,6 +665,7 @@ class NatureC51(nn.Module):
 
         return x
 
+    @mixed_precision
     def forward(self, x):
         batch_size = x.size()[0]
         fx = x.float() / 255
@@ -663,6 +781,7 @@ class ImpalaCNNLargeC51(nn.Module):
 
         return x
 
+    @mixed_precision
     def forward(self, x):
         batch_size = x.size()[0]
         fx = x.float() / 255
@@ -742,6 +861,7 @@ class ImpalaCNNLargeIQN(nn.Module):
 
         self.n_cos = ncos
         self.pis = torch.FloatTensor([np.pi * i for i in range(self.n_cos)]).view(1, 1, self.n_cos).to(device)
+        self.tau_generator = tau_generator(device)
         self.arch = arch
 
         if noisy:
@@ -823,8 +943,7 @@ class ImpalaCNNLargeIQN(nn.Module):
         o = self.conv(torch.zeros(1, *shape))
         return int(np.prod(o.size()))
 
-    #@torch.autocast('cuda')
-    def forward(self, inputt, advantages_only=False):
+    def forward(self, inputt, advantages_only=False, fixed_taus=False):
         """
         Quantile Calculation depending on the number of tau
 
@@ -832,6 +951,13 @@ class ImpalaCNNLargeIQN(nn.Module):
         quantiles [ shape of (batch_size, num_tau, action_size)]
         taus [shape of ((batch_size, num_tau, 1))]
 
+        """
+        return self.head(self.encode(inputt), advantages_only=advantages_only, fixed_taus=fixed_taus)
+
+    @mixed_precision
+    def encode(self, inputt):
+        """
+        Convolutional features of a batch of images, shape (batch_size, conv_out_size)
         """
         batch_size = inputt.size()[0]
         if self.arch == "each_frame":
@@ -847,11 +973,24 @@ class ImpalaCNNLargeIQN(nn.Module):
             x = self.pool(x)
 
         #print(x.device)
-        x = x.view(batch_size, -1)
+        return x.view(batch_size, -1)
 
-        cos, taus = self.calc_cos(batch_size, self.num_tau)  # cos shape (batch, num_tau, layer_size)
-        cos = cos.view(batch_size * self.num_tau, self.n_cos)
-        cos_x = torch.relu(self.cos_embedding(cos)).view(batch_size, self.num_tau, self.conv_out_size)  # (batch, n_tau, layer)
+    @mixed_precision
+    def head(self, x, advantages_only=False, fixed_taus=False):
+        """
+        Quantiles from features given by encode, with freshly sampled taus, or the cached evenly spaced ones if
+        fixed_taus. Same returns as forward
+        """
+        batch_size = x.size()[0]
+
+        if fixed_taus:
+            cos_x, taus = fixed_tau_embedding(self)
+            cos_x = cos_x.unsqueeze(0)  # (1, n_tau, layer)
+            taus = taus.expand(batch_size, -1, -1)
+        else:
+            cos, taus = self.calc_cos(batch_size, self.num_tau)  # cos shape (batch, num_tau, layer_size)
+            cos = cos.view(batch_size * self.num_tau, self.n_cos)
+            cos_x = torch.relu(self.cos_embedding(cos)).view(batch_size, self.num_tau, self.conv_out_size)  # (batch, n_tau, layer)
 
         # x has shape (batch, layer_size) for multiplication –> reshape to (batch, 1, layer)
         x = (x.unsqueeze(1) * cos_x).view(batch_size * self.num_tau, self.conv_out_size)
@@ -864,8 +1003,8 @@ class ImpalaCNNLargeIQN(nn.Module):
         #print(out.device)
         return out.view(batch_size, self.num_tau, self.actions), taus
 
-    def qvals(self, inputs, advantages_only=False):
-        quantiles, _ = self.forward(inputs, advantages_only)
+    def qvals(self, inputs, advantages_only=False, fixed_taus=False):
+        quantiles, _ = self.forward(inputs, advantages_only, fixed_taus)
 
         actions = quantiles.mean(dim=1)
 
@@ -875,7 +1014,7 @@ class ImpalaCNNLargeIQN(nn.Module):
         """
         Calculating the cosinus values depending on the number of tau samples
         """
-        taus = torch.rand(batch_size, n_tau).to(self.device).unsqueeze(-1) #(batch_size, n_tau, 1)
+        taus = torch.rand(batch_size, n_tau, 1, device=self.device, generator=self.tau_generator) #(batch_size, n_tau, 1)
         cos = torch.cos(taus*self.pis)
 
         #assert cos.shape == (batch_size, n_tau, self.n_cos), "cos shape is incorrect"